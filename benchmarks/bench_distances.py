@@ -0,0 +1,78 @@
+import os
+import sys
+import time
+import argparse
+import numpy as np
+from datetime import datetime
+from scipy.spatial.distance import cdist
+
+# Run from the repository root like the app: python benchmarks/bench_distances.py
+sys.path.insert(1, os.path.join(os.getcwd(), 'streamlit'))
+from distance_kernels import PlaylistDistances, rtol, atol
+from spotipy_client import feature_cols
+from bench_utils import summarize, save_results
+
+metrics = ['cityblock', 'euclidean', 'sqeuclidean', 'cosine', 'chebyshev']
+
+def time_repeats(func, repeats):
+    seconds = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = func()
+        seconds.append(time.perf_counter() - start)
+    return result, seconds
+
+def bench_size(n_playlists, batch_sizes, repeats, top_n=10, seed=0):
+    """
+    cdist on float64 playlists against PlaylistDistances for every metric and batch size, on standard normal
+    features like the scaled data. The kernels are checked against cdist: largest absolute error, and the share
+    of the top_n nearest playlists of each query found by both.
+    :return: dict of '<metric>/<batch>' -> timings and checks
+    """
+    rng = np.random.RandomState(seed)
+    data = rng.standard_normal((n_playlists, len(feature_cols)))
+    start = time.perf_counter()
+    distances = PlaylistDistances(data)
+    build_seconds = time.perf_counter() - start
+    print('{} playlists: index built in {:.3f}s, {:.1f} MB against {:.1f} MB of float64 data'.format(
+        n_playlists, build_seconds, distances.nbytes / 2**20, data.nbytes / 2**20))
+
+    results = {'build_seconds': build_seconds, 'index_mb': distances.nbytes / 2**20, 'data_mb': data.nbytes / 2**20}
+    print('{:<24}{:>12}{:>12}{:>10}{:>12}{:>10}'.format('metric/batch', 'cdist ms', 'kernel ms', 'speedup', 'max error', 'top_n'))
+    for batch in batch_sizes:
+        queries = rng.standard_normal((batch, len(feature_cols)))
+        for metric in metrics:
+            expected, cdist_seconds = time_repeats(lambda: cdist(data, queries, metric=metric), repeats)
+            found, kernel_seconds = time_repeats(lambda: distances.distances(queries, metric), repeats)
+            error = np.abs(found - expected)
+            within = bool(np.all(error <= atol + rtol * np.abs(expected)))
+            expected_top = np.argsort(expected, axis=0)[:top_n]
+            found_top = np.argsort(found, axis=0)[:top_n]
+            overlap = np.mean([len(np.intersect1d(expected_top[:, i], found_top[:, i])) / top_n for i in range(batch)])
+            cdist_summary, kernel_summary = summarize(cdist_seconds), summarize(kernel_seconds)
+            speedup = cdist_summary['p50_ms'] / kernel_summary['p50_ms'] if kernel_summary['p50_ms'] > 0 else float('inf')
+            results['{}/{}'.format(metric, batch)] = {'cdist': cdist_summary, 'kernel': kernel_summary, 'speedup': speedup,
+                                                      'max_error': float(error.max()), 'within_tolerance': within,
+                                                      'top_n_overlap': float(overlap)}
+            print('{:<24}{:>12.2f}{:>12.2f}{:>10.1f}{:>12.2e}{:>10.2f}{}'.format(
+                '{}/{}'.format(metric, batch), cdist_summary['p50_ms'], kernel_summary['p50_ms'], speedup,
+                error.max(), overlap, '' if within else '  <- out of tolerance'))
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Distance search of distance_kernels.py against cdist')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[20000, 1000000], help='playlists in the index')
+    parser.add_argument('--batches', type=int, nargs='+', default=[1, 64], help='queries per call')
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help='results file, benchmarks/results/distances_<date>_<revision>.json by default')
+    args = parser.parse_args()
+
+    start_time = datetime.now()
+    results = {'args': vars(args)}
+    for size in args.sizes:
+        results[str(size)] = bench_size(size, args.batches, args.repeats, seed=args.seed)
+        print()
+    path = save_results('distances', results, args.output)
+    print('Saved results to', path)
+    print('Total Time:', datetime.now() - start_time)
@@ -0,0 +1,103 @@
+import os
+import sys
+import time
+import shutil
+import sqlite3
+import argparse
+import tempfile
+import numpy as np
+from datetime import datetime
+
+# Run from the repository root like the app: python benchmarks/bench_ratings_layouts.py
+sys.path.insert(1, os.path.join(os.getcwd(), 'streamlit'))
+sys.path.insert(1, os.path.join(os.getcwd(), 'code'))
+from db_access import connect_readonly, read_row_playlist, read_packed_playlist, read_row_ratings, read_packed_ratings
+from pack_ratings import pack_ratings
+from bench_utils import summarize, save_results, print_summaries
+
+db_file = 'data/spotify_20K_playlists.db'
+readers = {'rows': (read_row_playlist, read_row_ratings), 'packed': (read_packed_playlist, read_packed_ratings)}
+
+def write_layouts(src_db, directory):
+    """
+    The ratings of src_db alone in one database per layout, so the size of each is the size of its file:
+        - rows: the ratings table in (pid, pos) order with its pid index, like the app database
+        - packed: the packed_ratings table of code/pack_ratings.py
+    :return: dict of layout -> database path
+    """
+    paths = {layout: os.path.join(directory, layout + '.db') for layout in readers}
+    conn = sqlite3.connect(paths['rows'])
+    conn.execute('ATTACH DATABASE ? AS src', (src_db,))
+    conn.execute('CREATE TABLE ratings AS SELECT pid, track_id, pos, num_followers FROM src.ratings ORDER BY pid, pos')
+    conn.execute('CREATE INDEX ratings_pid ON ratings (pid)')
+    conn.commit()
+    conn.execute('DETACH DATABASE src')
+    conn.execute('VACUUM')
+    conn.close()
+
+    conn = sqlite3.connect(src_db)
+    out_conn = sqlite3.connect(paths['packed'])
+    pack_ratings(conn, out_conn)
+    out_conn.execute('VACUUM')
+    out_conn.close()
+    conn.close()
+    return paths
+
+def time_calls(func, args_list):
+    seconds, results = [], []
+    for args in args_list:
+        start = time.perf_counter()
+        results.append(func(*args))
+        seconds.append(time.perf_counter() - start)
+    return results, seconds
+
+def bench_layouts(paths, n_playlists, repeats, seed=0):
+    """
+    Size of each layout, reading n_playlists random full playlists one at a time and reading all the ratings
+    into the arrays SPR_ML_Model keeps. Every layout must return the same track_ids.
+    """
+    conns = {layout: connect_readonly(path) for layout, path in paths.items()}
+    pids = np.array([row[0] for row in conns['packed'].execute('SELECT pid FROM packed_ratings').fetchall()])
+    pids = np.random.RandomState(seed).choice(pids, min(n_playlists, len(pids)), replace=False)
+    n_ratings = conns['packed'].execute('SELECT SUM(num_tracks) FROM packed_ratings').fetchone()[0]
+
+    results, summaries, tracks = {}, {}, {}
+    for layout, (read_playlist, read_ratings) in readers.items():
+        size = os.path.getsize(paths[layout])
+        playlists, seconds = time_calls(read_playlist, [(conns[layout], pid) for pid in pids])
+        summaries[layout + '/playlist'] = summarize(seconds)
+        arrays, seconds = time_calls(read_ratings, [(conns[layout],)] * repeats)
+        summaries[layout + '/all_ratings'] = summarize(seconds)
+        tracks[layout] = (playlists, arrays[0])
+        results[layout] = {'size_mb': size / 2**20, 'bytes_per_rating': size / n_ratings}
+        print('{:<8} {:8.2f} MB  {:6.2f} bytes per rating'.format(layout, size / 2**20, size / n_ratings))
+
+    same = all(np.array_equal(a, b) for a, b in zip(tracks['rows'][0], tracks['packed'][0])) and \
+        all(np.array_equal(a, b) for a, b in zip(tracks['rows'][1], tracks['packed'][1]))
+    print('Same track_ids in both layouts:', same)
+    print_summaries(summaries)
+    for conn in conns.values():
+        conn.close()
+    return dict(results, summaries=summaries, same_track_ids=same, ratings=int(n_ratings), playlists_read=len(pids))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Disk size and read time of the row and packed layouts of the ratings')
+    parser.add_argument('--db', default=db_file)
+    parser.add_argument('--playlists', type=int, default=2000, help='random playlists read one at a time')
+    parser.add_argument('--repeats', type=int, default=3, help='reads of all the ratings')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help='results file, benchmarks/results/ratings_layouts_<date>_<revision>.json by default')
+    args = parser.parse_args()
+
+    start_time = datetime.now()
+    directory = tempfile.mkdtemp()
+    try:
+        paths = write_layouts(args.db, directory)
+        print('Layouts written in', datetime.now() - start_time)
+        results = bench_layouts(paths, args.playlists, args.repeats, args.seed)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    results['args'] = vars(args)
+    path = save_results('ratings_layouts', results, args.output)
+    print('Saved results to', path)
+    print('Total Time:', datetime.now() - start_time)
@@ -0,0 +1,186 @@
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+# Run from the repository root like the app: python benchmarks/bench_recommender.py
+sys.path.insert(1, os.path.join(os.getcwd(), 'streamlit'))
+from spotipy_client import SPR_ML_Model, SpotifyRecommendations, feature_cols
+from spotify_clients import StubSpotify, ReplaySpotify, record_fixtures, feature_ranges, integer_features, random_uris
+from bench_utils import summarize, save_results, load_results, print_summaries, compare_results
+
+fixtures_file = 'benchmarks/fixtures/recommender_fixtures.json'
+user_kinds = ['vector', 'tracks', 'playlist']
+stage_order = ['fetch_tracks', 'audio_features', 'scale', 'predict_cluster', 'top_playlists', 'song_ranking', 'end_to_end',
+               'fig_genre_wordcloud', 'fig_playlist_wordcloud', 'fig_user_cluster_all', 'fig_user_cluster_single']
+
+def make_users(ml_model, n_users=300, tracks_per_user=50, unknown_fraction=0.1, seed=0, playlist_ids=None):
+    """
+    Synthetic users, one third of each kind:
+        - vector: random raw audio features within the Spotify ranges
+        - tracks: a list of track uris from the database with unknown_fraction of tracks that are not in it
+        - playlist: a playlist id answered by StubSpotify, or one of playlist_ids when recording from Spotify
+    :return: list of dict, json serializable
+    """
+    rng = np.random.RandomState(seed)
+    users = []
+    for i in range(n_users):
+        kind = user_kinds[i % len(user_kinds)]
+        if kind == 'vector':
+            features = []
+            for col in feature_cols:
+                low, high = feature_ranges[col]
+                features.append(int(rng.randint(low, high + 1)) if col in integer_features else float(rng.uniform(low, high)))
+            users.append({'kind': kind, 'features': features})
+        elif kind == 'tracks':
+            n_tracks = rng.randint(max(1, tracks_per_user // 2), tracks_per_user * 3 // 2 + 1)
+            n_unknown = int(round(n_tracks * unknown_fraction))
+            rows = rng.choice(len(ml_model.track_uris), n_tracks - n_unknown, replace=False)
+            users.append({'kind': kind, 'track_uris': ml_model.get_track_uris(rows).tolist() + random_uris(rng, n_unknown)})
+        else:
+            playlist_id = playlist_ids[i // len(user_kinds) % len(playlist_ids)] if playlist_ids else 'bench_playlist_{}_{}'.format(seed, i)
+            users.append({'kind': kind, 'playlist_id': playlist_id})
+    return users
+
+def build_fixtures(ml_model, users, sp):
+    "Record from sp everything the users need, the users are stored with the responses"
+    playlist_ids = list(dict.fromkeys(user['playlist_id'] for user in users if user['kind'] == 'playlist'))
+    track_uris = [uri for user in users if user['kind'] == 'tracks' for uri in user['track_uris']]
+    rows = ml_model.get_track_rows(track_uris)
+    artist_ids = ml_model.artist_uris[rows[rows >= 0]].astype(str).tolist()
+    fixtures = record_fixtures(sp, playlist_ids, track_uris, artist_ids)
+    fixtures['users'] = users
+    return fixtures
+
+def time_call(timings, stage, func):
+    start = time.perf_counter()
+    result = func()
+    timings.setdefault(stage, []).append(time.perf_counter() - start)
+    return result
+
+def run_user(ml_model, sp, user, n_playlists=10, n_songs=30, figures=False):
+    """
+    Recommendations for one user with every stage timed separately. Each stage reuses the cached results
+    of the stages before it, so a timing only covers its own work.
+    :return: dict of stage -> list of seconds
+    """
+    timings = {}
+    spr = SpotifyRecommendations(playlist_uri=user.get('playlist_id'), sp=sp, track_uris=user.get('track_uris'),
+                                 feature_vector=user.get('features'))
+    spr.log_output = lambda text: None
+    spr.set_ml_model(ml_model)
+
+    start = time.perf_counter()
+    if user['kind'] != 'vector':
+        time_call(timings, 'fetch_tracks', spr.get_tracks_from_playlist_or_user_favorites)
+        time_call(timings, 'audio_features', spr.get_tracks_audio_features)
+    time_call(timings, 'scale', spr.get_scaled_y_vector)
+    time_call(timings, 'predict_cluster', spr.get_user_cluster)
+    time_call(timings, 'top_playlists', lambda: spr.get_top_n_playlists(n_playlists))
+    time_call(timings, 'song_ranking', lambda: spr.get_songs_recommendations(n_songs))
+    timings['end_to_end'] = [time.perf_counter() - start]
+
+    if figures:
+        if user['kind'] != 'vector':
+            time_call(timings, 'fig_genre_wordcloud', spr.get_genre_wordcloud_fig)
+        time_call(timings, 'fig_playlist_wordcloud', spr.get_playlist_wordcloud_fig)
+        time_call(timings, 'fig_user_cluster_all', spr.get_user_cluster_all_fig)
+        time_call(timings, 'fig_user_cluster_single', spr.get_user_cluster_single_fig)
+    return timings
+
+def merge_timings(timings, user_timings):
+    for stage, seconds in user_timings.items():
+        timings.setdefault(stage, []).extend(seconds)
+
+def run_benchmark(ml_model, sp, users, n_playlists=10, n_songs=30, figure_users=10, concurrency=8, warmup=3):
+    """
+    Run every user once sequentially, with the figures for the first figure_users users, then all users again
+    from concurrency threads sharing the model and the client.
+    :return: dict of stage -> summary
+    """
+    for user in users[:warmup]:
+        run_user(ml_model, sp, user, n_playlists, n_songs)
+
+    timings = {}
+    for i, user in enumerate(users):
+        merge_timings(timings, run_user(ml_model, sp, user, n_playlists, n_songs, figures=i < figure_users))
+    summaries = {stage: summarize(timings[stage]) for stage in stage_order if stage in timings}
+    for kind in user_kinds:
+        seconds = [t for user, t in zip(users, timings['end_to_end']) if user['kind'] == kind]
+        summaries['end_to_end_' + kind] = summarize(seconds)
+
+    concurrent_timings = {}
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for user_timings in pool.map(lambda user: run_user(ml_model, sp, user, n_playlists, n_songs), users):
+            merge_timings(concurrent_timings, user_timings)
+    summaries['end_to_end_concurrent_{}'.format(concurrency)] = summarize(concurrent_timings['end_to_end'],
+                                                                          wall_seconds=time.perf_counter() - start)
+    return summaries
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Latency and throughput of each recommendation stage with replayed Spotify fixtures')
+    parser.add_argument('--users', type=int, default=300)
+    parser.add_argument('--tracks-per-user', type=int, default=50)
+    parser.add_argument('--unknown-fraction', type=float, default=0.1, help='share of user tracks that are not in the database')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--n-playlists', type=int, default=10)
+    parser.add_argument('--n-songs', type=int, default=30)
+    parser.add_argument('--figure-users', type=int, default=10, help='users whose figures are also built and timed')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--load-repeats', type=int, default=1, help='times the model is loaded for its timing')
+    parser.add_argument('--fixtures', default=fixtures_file)
+    parser.add_argument('--record', action='store_true', help='record new fixtures even if the file exists')
+    parser.add_argument('--live', action='store_true', help='record the fixtures from the Spotify API instead of StubSpotify')
+    parser.add_argument('--playlist-uris', nargs='*', default=None, help='real playlists for the playlist users when recording with --live')
+    parser.add_argument('--output', default=None, help='results file, benchmarks/results/recommender_<date>_<revision>.json by default')
+    parser.add_argument('--baseline', default=None, help='results file of an earlier run to compare p95 latencies with')
+    parser.add_argument('--tolerance', type=float, default=1.2, help='p95 ratio to the baseline that counts as a regression')
+    args = parser.parse_args()
+
+    start_time = datetime.now()
+    load_seconds = []
+    for _ in range(args.load_repeats):
+        start = time.perf_counter()
+        ml_model = SPR_ML_Model()
+        load_seconds.append(time.perf_counter() - start)
+    print('Loaded ML Model in {:.2f}s'.format(load_seconds[-1]))
+
+    if args.record or not os.path.exists(args.fixtures):
+        if args.live:
+            import spotipy
+            from spotipy.oauth2 import SpotifyClientCredentials
+            recorder = spotipy.Spotify(client_credentials_manager=SpotifyClientCredentials())
+        else:
+            recorder = StubSpotify(ml_model)
+        users = make_users(ml_model, args.users, args.tracks_per_user, args.unknown_fraction, args.seed, args.playlist_uris)
+        fixtures = build_fixtures(ml_model, users, recorder)
+        os.makedirs(os.path.dirname(args.fixtures) or '.', exist_ok=True)
+        with open(args.fixtures, 'w') as ff:
+            json.dump(fixtures, ff)
+        print('Recorded fixtures for', len(users), 'users in', args.fixtures)
+    else:
+        with open(args.fixtures) as ff:
+            fixtures = json.load(ff)
+        print('Replaying fixtures for', len(fixtures['users']), 'users from', args.fixtures)
+
+    summaries = {'load_model': summarize(load_seconds)}
+    summaries.update(run_benchmark(ml_model, ReplaySpotify(fixtures), fixtures['users'], args.n_playlists, args.n_songs,
+                                   args.figure_users, args.concurrency))
+    print()
+    print_summaries(summaries)
+    path = save_results('recommender', {'args': vars(args), 'playlists': len(ml_model.playlists_df),
+                                        'summaries': summaries}, args.output)
+    print('\nSaved results to', path)
+
+    if args.baseline:
+        print()
+        regressions = compare_results(summaries, load_results(args.baseline)['summaries'], args.tolerance)
+        if regressions:
+            print('\nRegressions:', ', '.join(regressions))
+            sys.exit(1)
+    print('Total Time:', datetime.now() - start_time)
@@ -0,0 +1,121 @@
+import os
+import sys
+import time
+import shutil
+import argparse
+import subprocess
+import numpy as np
+from datetime import datetime
+
+# Run from the repository root like the app: python benchmarks/bench_shared_memory.py
+sys.path.insert(1, os.path.join(os.getcwd(), 'streamlit'))
+from bench_utils import save_results
+
+# Memory of a process in /proc/<pid>/smaps_rollup (Linux), in kB
+memory_fields = ['Rss', 'Pss', 'Shared_Clean', 'Private_Clean', 'Private_Dirty']
+
+def read_memory(pid):
+    """
+    Memory of a process in MB:
+        - rss: resident pages, the pages shared with other processes are counted in full by each of them
+        - pss: resident pages with the shared ones divided by the number of processes mapping them,
+          the sum over the workers is the memory they use together
+        - uss: pages mapped by this process only, with a single worker it includes the libraries and arrays
+          the other workers would share
+    """
+    memory = {}
+    with open('/proc/{}/smaps_rollup'.format(pid)) as f:
+        for line in f:
+            field, _, value = line.partition(':')
+            if field in memory_fields:
+                memory[field] = int(value.split()[0]) / 1024
+    return {'rss_mb': memory['Rss'], 'pss_mb': memory['Pss'], 'uss_mb': memory['Private_Clean'] + memory['Private_Dirty'],
+            'shared_mb': memory['Shared_Clean']}
+
+def run_worker(shared_dir):
+    """
+    Load the model like an app or rec_service process, touch every page of its arrays as a long running worker
+    eventually does, answer one recommendation, then wait for the parent to read the memory and close stdin
+    """
+    from spotipy_client import SPR_ML_Model, SpotifyRecommendations
+    from spotify_clients import StubSpotify
+    start = time.perf_counter()
+    ml_model = SPR_ML_Model(shared_dir=shared_dir)
+    load_seconds = time.perf_counter() - start
+    touched = 0
+    for array in ml_model.get_arrays().values():
+        touched += int(np.ascontiguousarray(array).reshape(-1).view(np.uint8)[::4096].sum())
+    spr = SpotifyRecommendations(sp=StubSpotify(ml_model), feature_vector=ml_model.track_features[ml_model.has_features][0])
+    spr.log_output = lambda text: None
+    spr.set_ml_model(ml_model)
+    spr.get_songs_recommendations(n=10)
+    print('ready {:.3f}'.format(load_seconds), flush=True)
+    sys.stdin.readline()
+
+def start_workers(n_workers, shared_dir):
+    # An empty --shared-dir makes the worker load its own arrays
+    args = [sys.executable, __file__, '--worker', '--shared-dir', shared_dir or '']
+    return [subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, universal_newlines=True) for _ in range(n_workers)]
+
+def stop_workers(workers):
+    for worker in workers:
+        worker.stdin.close()
+    for worker in workers:
+        worker.wait()
+
+def measure(n_workers, shared_dir):
+    """
+    Start n_workers processes and read their memory once they all have loaded the model
+    :return: dict with the memory of each worker, their load time and the totals
+    """
+    workers = start_workers(n_workers, shared_dir)
+    try:
+        load_seconds = []
+        for worker in workers:
+            line = worker.stdout.readline().split()
+            if not line or line[0] != 'ready':
+                raise RuntimeError('Worker {} failed to load the model'.format(worker.pid))
+            load_seconds.append(float(line[1]))
+        memory = [read_memory(worker.pid) for worker in workers]
+    finally:
+        stop_workers(workers)
+    result = {'workers': memory, 'load_seconds': load_seconds}
+    for key in ['rss_mb', 'pss_mb', 'uss_mb']:
+        result['mean_' + key] = float(np.mean([m[key] for m in memory]))
+        result['total_' + key] = float(np.sum([m[key] for m in memory]))
+    return result
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Memory of worker processes with private and shared model arrays')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 8], help='worker processes of each run')
+    parser.add_argument('--shared-dir', default=os.path.join('data', 'model_arrays_bench'),
+                        help='directory of the shared arrays, removed before the shared runs')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--output', default=None, help='results file, benchmarks/results/shared_memory_<date>_<revision>.json by default')
+    args = parser.parse_args()
+    if args.worker:
+        run_worker(args.shared_dir or None)
+        sys.exit(0)
+
+    start_time = datetime.now()
+    results = {'args': vars(args)}
+    shutil.rmtree(args.shared_dir, ignore_errors=True)
+    # One worker builds and publishes the shared arrays, the measured runs only attach to them
+    measure(1, args.shared_dir)
+    print('{:<8}{:>9}{:>12}{:>12}{:>12}{:>14}{:>10}'.format('arrays', 'workers', 'RSS MB', 'PSS MB', 'USS MB', 'total PSS MB', 'load s'))
+    for mode, shared_dir in [('private', None), ('shared', args.shared_dir)]:
+        for n_workers in args.workers:
+            result = measure(n_workers, shared_dir)
+            results['{}/{}'.format(mode, n_workers)] = result
+            print('{:<8}{:>9}{:>12.1f}{:>12.1f}{:>12.1f}{:>14.1f}{:>10.2f}'.format(
+                mode, n_workers, result['mean_rss_mb'], result['mean_pss_mb'], result['mean_uss_mb'], result['total_pss_mb'],
+                float(np.mean(result['load_seconds']))))
+        if len(args.workers) > 1:
+            low, high = min(args.workers), max(args.workers)
+            extra = (results['{}/{}'.format(mode, high)]['total_pss_mb'] - results['{}/{}'.format(mode, low)]['total_pss_mb']) / (high - low)
+            results[mode + '/extra_worker_mb'] = extra
+            print('{:<8} each worker above {} adds {:.1f} MB'.format(mode, low, extra))
+    shutil.rmtree(args.shared_dir, ignore_errors=True)
+    path = save_results('shared_memory', results, args.output)
+    print('Saved results to', path)
+    print('Total Time:', datetime.now() - start_time)
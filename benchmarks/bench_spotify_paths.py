@@ -0,0 +1,213 @@
+import os
+import sys
+import json
+import time
+import argparse
+import requests
+import numpy as np
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+# Run from the repository root like the app: python benchmarks/bench_spotify_paths.py
+sys.path.insert(1, os.path.join(os.getcwd(), 'streamlit'))
+from spotipy_client import SPR_ML_Model, SpotifyRecommendations, SpotifyAPI
+from spotify_clients import (StubSpotify, StubHTTP, RecordingSpotify, RecordingHTTP, ReplaySpotify, ReplayHTTP,
+                             empty_fixtures, random_uris, make_session, start_stub_server)
+from bench_utils import summarize, save_results, load_results, print_summaries, compare_results
+
+fixtures_file = 'benchmarks/fixtures/spotify_paths_fixtures.json'
+search_queries = ['chill', 'workout', 'party', 'sleep', 'focus', 'road trip', 'rainy day', 'throwback', 'summer', 'study']
+
+def make_spr(ml_model, sp, playlist_uri=None):
+    spr = SpotifyRecommendations(playlist_uri=playlist_uri, sp=sp)
+    spr.log_output = lambda text: None
+    spr.set_ml_model(ml_model)
+    return spr
+
+def bench_playlist_ids(n_playlists, seed=0):
+    return ['bench_paths_playlist_{}_{}'.format(seed, i) for i in range(n_playlists)]
+
+def make_scenarios(ml_model, n_playlists=20, n_track_lists=20, tracks_per_list=300, saved_tracks=True, playlist_ids=None, seed=0):
+    """
+    Operations on every network-bound path, each one a (path, function of (sp, http)) pair:
+        - playlist_pagination: all the pages of a playlist (fetch_tracks)
+        - saved_tracks_pagination: all the pages of the saved tracks, 20 per page (fetch_tracks for user favorites)
+        - audio_features: features of tracks_per_list tracks that are not in the database, 100 per call
+        - artist_genres: genres of the artists of a playlist, 50 per call
+        - search: one page of playlists for a query with SpotifyAPI
+        - search_all_pages: every page of tracks for a query, 50 per call, fetched concurrently
+    """
+    rng = np.random.RandomState(seed)
+    playlist_ids = playlist_ids or bench_playlist_ids(n_playlists, seed)
+    scenarios = []
+    for playlist_id in playlist_ids:
+        scenarios.append(('playlist_pagination', lambda sp, http, playlist_id=playlist_id: make_spr(ml_model, sp, playlist_id).fetch_tracks()))
+    if saved_tracks:
+        scenarios.append(('saved_tracks_pagination', lambda sp, http: make_spr(ml_model, sp).fetch_tracks()))
+    for _ in range(n_track_lists):
+        uris = random_uris(rng, tracks_per_list)
+        scenarios.append(('audio_features', lambda sp, http, uris=uris: make_spr(ml_model, sp).get_audio_features_df(track_uris_list=uris)))
+    for playlist_id in playlist_ids:
+        scenarios.append(('artist_genres', lambda sp, http, playlist_id=playlist_id: make_spr(ml_model, sp, playlist_id).get_artist_genres()))
+    for query in search_queries:
+        scenarios.append(('search', lambda sp, http, query=query: SpotifyAPI('bench', 'bench', http=http).search(query)))
+    for query in search_queries:
+        scenarios.append(('search_all_pages', lambda sp, http, query=query:
+                          SpotifyAPI('bench', 'bench', http=http).search_all(query, search_type='track')))
+    return scenarios
+
+def record(ml_model, scenarios, sp, http):
+    "Run every scenario once through recording clients"
+    fixtures = empty_fixtures()
+    recorder = RecordingSpotify(sp, fixtures=fixtures)
+    http_recorder = RecordingHTTP(http, fixtures=fixtures)
+    for path, operation in scenarios:
+        operation(recorder, http_recorder)
+    return fixtures
+
+def pages(sp, first_page):
+    "Every page of a paginated response, from the first one"
+    result = [first_page]
+    while result[-1]['next']:
+        result.append(sp.next(result[-1]))
+    return result
+
+def check_round_trip(sp, fixtures, playlist_ids, saved_tracks=True):
+    """
+    The pages of the playlists and of the saved tracks replayed from the fixtures must be the pages of the recorded
+    client, e.g. not a first page grown by fetch_tracks while recording
+    :return: list of the playlist ids (and saved_tracks) whose replayed pages differ
+    """
+    replay_sp = ReplaySpotify(fixtures)
+    calls = [(playlist_id, lambda client, playlist_id=playlist_id: client.playlist(playlist_id)['tracks']) for playlist_id in playlist_ids]
+    if saved_tracks:
+        calls.append(('saved_tracks', lambda client: client.current_user_saved_tracks()))
+    return [name for name, call in calls if pages(sp, call(sp)) != pages(replay_sp, call(replay_sp))]
+
+def replay(scenarios, fixtures, repeats=5, concurrency=1, **network):
+    """
+    Replay the scenarios repeats times from concurrency threads against clients with the simulated network
+    :return: dict of path -> summary with the calls per operation, and the replay clients
+    """
+    sp = ReplaySpotify(fixtures, **network)
+    http = ReplayHTTP(fixtures, **network)
+    timings = {}
+    calls = {}
+
+    def run(scenario):
+        path, operation = scenario
+        start = time.perf_counter()
+        operation(sp, http)
+        return path, time.perf_counter() - start
+
+    runs = [scenario for _ in range(repeats) for scenario in scenarios]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for path, seconds in pool.map(run, runs):
+            timings.setdefault(path, []).append(seconds)
+    wall_seconds = time.perf_counter() - start
+
+    # Calls per operation from one sequential pass on clients without latency
+    for path, operation in scenarios:
+        counter = ReplaySpotify(fixtures), ReplayHTTP(fixtures)
+        operation(*counter)
+        calls.setdefault(path, []).append(counter[0].calls + counter[1].calls)
+
+    summaries = {}
+    for path, seconds in timings.items():
+        summaries[path] = dict(summarize(seconds), calls_per_op=float(np.mean(calls[path])))
+    summaries['all_paths'] = dict(summarize(sum(timings.values(), []), wall_seconds=wall_seconds),
+                                  rate_limited=sp.rate_limited + http.rate_limited)
+    return summaries
+
+def stub_server_search(repeats=5, concurrency=1, **network):
+    """
+    search_all over real local connections to start_stub_server(), once with the pooled session of make_session()
+    and once with requests, which opens a new connection for every call
+    :return: dict of search_pooled_session and search_new_connections -> summary
+    """
+    server = start_stub_server(**network)
+    summaries = {}
+    for name, http in [('search_pooled_session', make_session()), ('search_new_connections', requests)]:
+        api = SpotifyAPI('bench_' + name, 'bench', http=http, api_url=server.api_url, token_url=server.token_url)
+        api.get_access_token()
+
+        def run(query):
+            start = time.perf_counter()
+            api.search_all(query, search_type='track')
+            return time.perf_counter() - start
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            seconds = list(pool.map(run, search_queries * repeats))
+        summaries[name] = summarize(seconds, wall_seconds=time.perf_counter() - start)
+    server.shutdown()
+    return summaries
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Latency and throughput of the Spotify network paths replayed from recorded fixtures')
+    parser.add_argument('--playlists', type=int, default=20)
+    parser.add_argument('--playlist-tracks', type=int, nargs=2, default=[150, 400], help='smallest and largest stub playlist')
+    parser.add_argument('--track-lists', type=int, default=20)
+    parser.add_argument('--tracks-per-list', type=int, default=300)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--latency', type=float, default=0.05, help='simulated seconds per call')
+    parser.add_argument('--jitter', type=float, default=0.2)
+    parser.add_argument('--rate-limit', type=float, default=None, help='simulated calls per second')
+    parser.add_argument('--burst', type=int, default=10)
+    parser.add_argument('--stub-server', action='store_true', help='also time search over connections to a local stub server')
+    parser.add_argument('--fixtures', default=fixtures_file)
+    parser.add_argument('--record', action='store_true', help='record new fixtures even if the file exists')
+    parser.add_argument('--live', action='store_true', help='record from the Spotify API instead of StubSpotify')
+    parser.add_argument('--playlist-uris', nargs='*', default=None, help='real playlists to record with --live')
+    parser.add_argument('--output', default=None)
+    parser.add_argument('--baseline', default=None)
+    parser.add_argument('--tolerance', type=float, default=1.2)
+    args = parser.parse_args()
+
+    start_time = datetime.now()
+    ml_model = SPR_ML_Model()
+    scenarios = make_scenarios(ml_model, args.playlists, args.track_lists, args.tracks_per_list,
+                               saved_tracks=not args.live, playlist_ids=args.playlist_uris)
+    if args.record or not os.path.exists(args.fixtures):
+        if args.live:
+            import spotipy
+            from spotipy.oauth2 import SpotifyClientCredentials
+            sp, http = spotipy.Spotify(client_credentials_manager=SpotifyClientCredentials()), make_session()
+        else:
+            sp = StubSpotify(ml_model, playlist_tracks=tuple(args.playlist_tracks))
+            http = StubHTTP(StubSpotify(ml_model))
+        fixtures = record(ml_model, scenarios, sp, http)
+        playlist_ids = args.playlist_uris or bench_playlist_ids(args.playlists)
+        mismatches = check_round_trip(sp, fixtures, playlist_ids, saved_tracks=not args.live)
+        if mismatches:
+            print('Replayed pages differ from the recorded ones for:', ', '.join(mismatches))
+            sys.exit(1)
+        os.makedirs(os.path.dirname(args.fixtures) or '.', exist_ok=True)
+        with open(args.fixtures, 'w') as ff:
+            json.dump(fixtures, ff)
+        print('Recorded', len(scenarios), 'operations in', args.fixtures)
+    else:
+        with open(args.fixtures) as ff:
+            fixtures = json.load(ff)
+        print('Replaying', len(scenarios), 'operations from', args.fixtures)
+
+    network = {'latency': args.latency, 'jitter': args.jitter, 'rate_limit': args.rate_limit, 'burst': args.burst}
+    summaries = replay(scenarios, fixtures, args.repeats, args.concurrency, **network)
+    if args.stub_server:
+        summaries.update(stub_server_search(args.repeats, args.concurrency, **network))
+    print()
+    print_summaries(summaries)
+    print('\ncalls per operation:', {path: summary['calls_per_op'] for path, summary in summaries.items() if 'calls_per_op' in summary})
+    print('rate limited calls:', summaries['all_paths']['rate_limited'])
+    path = save_results('spotify_paths', {'args': vars(args), 'summaries': summaries}, args.output)
+    print('\nSaved results to', path)
+
+    if args.baseline:
+        print()
+        regressions = compare_results(summaries, load_results(args.baseline)['summaries'], args.tolerance)
+        if regressions:
+            print('\nRegressions:', ', '.join(regressions))
+            sys.exit(1)
+    print('Total Time:', datetime.now() - start_time)
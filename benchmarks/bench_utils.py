@@ -0,0 +1,80 @@
+import os
+import json
+import platform
+import subprocess
+import numpy as np
+from datetime import datetime
+
+results_dir = 'benchmarks/results'
+
+def summarize(seconds, wall_seconds=None):
+    """
+    Latency percentiles in milliseconds of a list of timings in seconds
+    :param wall_seconds: wall time of the whole run, throughput is computed from it when given
+    :return: dict with count, mean, p50, p95, p99, max and throughput per second
+    """
+    ms = np.asarray(seconds, dtype=np.float64) * 1000
+    if len(ms) == 0:
+        return {'count': 0}
+    summary = {'count': len(ms), 'mean_ms': ms.mean(), 'p50_ms': np.percentile(ms, 50), 'p95_ms': np.percentile(ms, 95),
+               'p99_ms': np.percentile(ms, 99), 'max_ms': ms.max()}
+    total = wall_seconds if wall_seconds is not None else ms.sum() / 1000
+    summary['per_second'] = len(ms) / total if total > 0 else float('inf')
+    return {key: round(float(value), 3) if key != 'count' else value for key, value in summary.items()}
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_info():
+    return {'date': datetime.now().isoformat(timespec='seconds'), 'revision': git_revision(),
+            'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine(),
+            'cpus': os.cpu_count()}
+
+def save_results(name, results, path=None):
+    """
+    Write results with the run info to benchmarks/results/<name>_<date>_<revision>.json unless path is given
+    :return: path of the file
+    """
+    results = dict(results, info=run_info())
+    if path is None:
+        os.makedirs(results_dir, exist_ok=True)
+        stamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        path = os.path.join(results_dir, '{}_{}_{}.json'.format(name, stamp, results['info']['revision'] or 'norev'))
+    with open(path, 'w') as rf:
+        json.dump(results, rf, indent=2)
+    return path
+
+def load_results(path):
+    with open(path) as rf:
+        return json.load(rf)
+
+def print_summaries(summaries):
+    print('{:<28}{:>8}{:>11}{:>11}{:>11}{:>11}{:>12}'.format('stage', 'count', 'mean ms', 'p50 ms', 'p95 ms', 'p99 ms', 'per sec'))
+    for stage, summary in summaries.items():
+        if summary['count'] == 0:
+            continue
+        print('{:<28}{:>8}{:>11.2f}{:>11.2f}{:>11.2f}{:>11.2f}{:>12.1f}'.format(
+            stage, summary['count'], summary['mean_ms'], summary['p50_ms'], summary['p95_ms'], summary['p99_ms'], summary['per_second']))
+
+def compare_results(current, baseline, tolerance=1.2, key='p95_ms'):
+    """
+    Print the change of key for every stage in both summaries
+    :param tolerance: ratio to the baseline above which a stage counts as a regression
+    :return: list of the stages that regressed
+    """
+    regressions = []
+    print('{:<28}{:>14}{:>14}{:>9}'.format('stage', 'baseline ' + key[:3], 'current ' + key[:3], 'ratio'))
+    for stage, summary in current.items():
+        base = baseline.get(stage)
+        if not base or not base.get('count') or not summary.get('count'):
+            continue
+        ratio = summary[key] / base[key] if base[key] > 0 else float('inf')
+        flag = ''
+        if ratio > tolerance:
+            regressions.append(stage)
+            flag = '  <- regression'
+        print('{:<28}{:>14.2f}{:>14.2f}{:>9.2f}{}'.format(stage, base[key], summary[key], ratio, flag))
+    return regressions
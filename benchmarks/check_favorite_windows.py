@@ -0,0 +1,76 @@
+import os
+import sys
+import argparse
+import numpy as np
+import pandas as pd
+
+# Run from the repository root like the app: python benchmarks/check_favorite_windows.py
+sys.path.insert(1, os.path.join(os.getcwd(), 'streamlit'))
+from spotipy_client import favorite_windows, window_start
+
+def last_rows(df, offset):
+    """
+    Rows of DataFrame.last(offset), the windows of the favorites before window_start. pandas 3 removed last(),
+    its pandas 1.2.5 implementation is used then.
+    """
+    if hasattr(df, 'last'):
+        return len(df.last(offset))
+    start = df.index.searchsorted(df.index[-1] - offset, side='right')
+    return len(df.iloc[start:])
+
+def end_times():
+    "Last added_at of the favorites: every month end of two years at several times of day, plus some other days"
+    month_ends = pd.date_range('2020-01-31', '2021-12-31', freq=pd.offsets.MonthEnd(1))
+    days = month_ends.append(month_ends - pd.Timedelta(days=1)).append(month_ends + pd.Timedelta(days=1))
+    days = days.append(pd.DatetimeIndex(['2021-06-15', '2020-02-29', '2021-03-01']))
+    return [day + pd.Timedelta(hours=hours) for day in days for hours in [0, 12, 23.99]]
+
+# Day of the first added_at kept by DataFrame.last of pandas 1.2.5 for daily favorites ending at end, on month ends too
+known_starts = [('2021-06-30 12:00', 'last_month', '2021-06-01'), ('2021-06-30 12:00', '6_months', '2021-01-01'),
+                ('2021-06-30', 'last_month', '2021-06-01'), ('2021-06-15', 'last_month', '2021-06-01'),
+                ('2021-03-31 12:00', 'last_month', '2021-03-01'), ('2021-02-28 12:00', 'last_month', '2021-02-01'),
+                ('2021-12-31 12:00', '6_months', '2021-07-01')]
+
+def check_known_starts():
+    ":return: list of (end, window, first added_at, expected) that differ from known_starts"
+    mismatches = []
+    for end, window, expected in known_starts:
+        added_at = pd.date_range(pd.Timestamp(end) - pd.Timedelta(days=400), end, freq='D')
+        first = added_at[window_start(added_at, favorite_windows[window])].normalize()
+        if first != pd.Timestamp(expected):
+            mismatches.append((end, window, first, expected))
+    return mismatches
+
+def check_windows(n_tracks=300, seed=0):
+    """
+    window_start against DataFrame.last on sorted favorites added over the year before each end time
+    :return: list of (end, window, window_start rows, last rows) that differ
+    """
+    rng = np.random.RandomState(seed)
+    mismatches = []
+    for end in end_times():
+        # Daily added_at on both sides of the month ends before end, and end itself
+        added_at = pd.DatetimeIndex(np.sort(end - pd.to_timedelta(rng.uniform(0, 400, n_tracks), unit='D'))).append(pd.DatetimeIndex([end]))
+        df = pd.DataFrame({'uri': np.arange(len(added_at))}, index=added_at)
+        for window, offset in favorite_windows.items():
+            rows = len(added_at) - window_start(added_at, offset)
+            expected = last_rows(df, offset)
+            if rows != expected:
+                mismatches.append((end, window, rows, expected))
+    return mismatches
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check the favorite time windows against DataFrame.last, month ends included')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    mismatches = check_windows(seed=args.seed)
+    print('pandas', pd.__version__, 'DataFrame.last' if hasattr(pd.DataFrame, 'last') else 'pandas 1.2.5 last()')
+    print('End times checked:', len(end_times()), 'windows:', list(favorite_windows))
+    for end, window, rows, expected in mismatches[:20]:
+        print('Mismatch: end {} {} window_start {} rows, last {} rows'.format(end, window, rows, expected))
+    known = check_known_starts()
+    for end, window, first, expected in known:
+        print('Mismatch: end {} {} starts {}, expected {}'.format(end, window, first, expected))
+    print('Mismatches:', len(mismatches) + len(known))
+    sys.exit(1 if mismatches or known else 0)
@@ -0,0 +1,128 @@
+import os
+import json
+import pickle
+import sqlite3
+import argparse
+import numpy as np
+from datetime import datetime
+
+db_file = 'data/spotify_20K_playlists.db'
+model_file = 'models/KMeans_K17_20000_sample_model.sav'
+scaled_data_file = 'data/scaled_data.csv'
+shards_dir = 'data/shards'
+
+feature_cols = ['danceability', 'energy', 'key', 'loudness', 'mode', 'speechiness', 'acousticness', 'instrumentalness',
+                'liveness', 'valence', 'tempo', 'duration_ms', 'time_signature']
+
+def load_scaled_data(path):
+    if path.endswith('.npy'):
+        return np.load(path, mmap_mode='r')
+    return np.loadtxt(path, delimiter=',')
+
+def get_columns(conn, table):
+    return [row[1] for row in conn.execute('pragma src.table_info({})'.format(table))]
+
+def select_columns(columns, alias):
+    "Column list of a shard table, with the track_id renumbered to the local id of the shard"
+    return ', '.join('m.local_id AS track_id' if col == 'track_id' else '{}.{}'.format(alias, col) for col in columns)
+
+def write_shard(db_path, shard_path, cluster, pids, scaled_data):
+    """
+    Write one cluster's shard: a database with the same tables as the app database holding only the playlists of
+    the cluster, their ratings and the tracks and features they use, plus shard.npz with the cluster, the pids
+    and the scaled features of the playlists in the same order.
+    Track ids are renumbered from 0 within the shard, so the arrays SPR_ML_Model addresses by track_id stay as
+    small as the shard. Playlists keep their pid.
+    :return: dict with the counts of the shard
+    """
+    os.makedirs(shard_path, exist_ok=True)
+    shard_db = os.path.join(shard_path, 'playlists.db')
+    if os.path.exists(shard_db):
+        os.remove(shard_db)
+    conn = sqlite3.connect(shard_db)
+    conn.execute('ATTACH DATABASE ? AS src', (db_path,))
+    conn.execute('CREATE TEMP TABLE shard_pids (pid INTEGER PRIMARY KEY)')
+    conn.executemany('INSERT INTO shard_pids VALUES (?)', [(int(pid),) for pid in pids])
+    conn.execute('CREATE TEMP TABLE track_map AS SELECT track_id AS global_id, ROW_NUMBER() OVER (ORDER BY track_id) - 1 AS local_id '
+                 'FROM (SELECT DISTINCT track_id FROM src.ratings WHERE pid IN (SELECT pid FROM shard_pids))')
+    conn.execute('CREATE INDEX temp.track_map_global ON track_map (global_id)')
+
+    # Same row order as the source, which is the order of the labels and the scaled data
+    conn.execute('CREATE TABLE playlists AS SELECT * FROM src.playlists WHERE pid IN (SELECT pid FROM shard_pids) ORDER BY rowid')
+    conn.execute('CREATE TABLE ratings AS SELECT {} FROM src.ratings r JOIN track_map m ON r.track_id = m.global_id '
+                 'WHERE r.pid IN (SELECT pid FROM shard_pids) ORDER BY r.pid, r.pos'.format(select_columns(get_columns(conn, 'ratings'), 'r')))
+    conn.execute('CREATE TABLE tracks AS SELECT {} FROM src.tracks t JOIN track_map m ON t.track_id = m.global_id '
+                 'ORDER BY m.local_id'.format(select_columns(get_columns(conn, 'tracks'), 't')))
+    conn.execute('CREATE TABLE features AS SELECT {} FROM src.features f JOIN track_map m ON f.track_id = m.global_id '
+                 'ORDER BY m.local_id'.format(select_columns(get_columns(conn, 'features'), 'f')))
+    conn.commit()
+    counts = {table: conn.execute('select count(*) from {}'.format(table)).fetchone()[0]
+              for table in ['playlists', 'ratings', 'tracks', 'features']}
+    conn.close()
+
+    np.savez(os.path.join(shard_path, 'shard.npz'), cluster=cluster, pids=pids, scaled_data=scaled_data)
+    return counts
+
+def write_router_index(conn, path):
+    """
+    Audio features of every track sorted by uri, so the router computes the user vector of a list of tracks
+    without the database: track_uris (S22), features (float32, NaN without features)
+    """
+    cur = conn.cursor()
+    cur.execute('select t.track_uri, ' + ', '.join('f.' + col for col in feature_cols) +
+                ' from tracks t left join features f on t.track_id = f.track_id')
+    uris, features = [], []
+    while True:
+        rows = cur.fetchmany(100000)
+        if not rows:
+            break
+        uris.append(np.array([row[0] for row in rows], dtype='S22'))
+        features.append(np.array([row[1:] for row in rows], dtype=np.float32))
+    uris, features = np.concatenate(uris), np.concatenate(features)
+    order = np.argsort(uris, kind='stable')
+    np.savez(path, track_uris=uris[order], features=features[order])
+    return len(uris)
+
+def build_shards(db_path=db_file, model_path=model_file, scaled_data_path=scaled_data_file, output_dir=shards_dir):
+    """
+    Partition the serving data by the cluster of each playlist, one shard directory per cluster, plus the
+    router index and shards.json describing them
+    :return: the shards.json content
+    """
+    with open(model_path, 'rb') as mf:
+        labels = pickle.load(mf).labels_
+    scaled_data = load_scaled_data(scaled_data_path)
+    conn = sqlite3.connect(db_path)
+    conn.execute('CREATE INDEX IF NOT EXISTS ratings_pid ON ratings (pid)')
+    pids = np.array([row[0] for row in conn.execute('select pid from playlists')], dtype=np.int64)
+    if not len(pids) == len(labels) == len(scaled_data):
+        raise ValueError('{} playlists, {} labels and {} scaled rows do not match'.format(len(pids), len(labels), len(scaled_data)))
+
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = {'model': model_path, 'db': db_path, 'shards': {}}
+    for cluster in np.unique(labels):
+        start_time = datetime.now()
+        rows = np.flatnonzero(labels == cluster)
+        name = 'cluster_{:02d}'.format(int(cluster))
+        counts = write_shard(db_path, os.path.join(output_dir, name), int(cluster), pids[rows], np.asarray(scaled_data[rows]))
+        manifest['shards'][str(int(cluster))] = dict(counts, path=name)
+        print('Shard', name, counts, 'in', datetime.now() - start_time)
+
+    manifest['router_tracks'] = write_router_index(conn, os.path.join(output_dir, 'router.npz'))
+    conn.close()
+    with open(os.path.join(output_dir, 'shards.json'), 'w') as mf:
+        json.dump(manifest, mf, indent=2)
+    return manifest
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Partition the serving data into one shard per cluster for shard_router.py')
+    parser.add_argument('--db', default=db_file)
+    parser.add_argument('--model', default=model_file)
+    parser.add_argument('--scaled-data', default=scaled_data_file)
+    parser.add_argument('--output', default=shards_dir)
+    args = parser.parse_args()
+
+    start_time = datetime.now()
+    manifest = build_shards(args.db, args.model, args.scaled_data, args.output)
+    print('Shards:', len(manifest['shards']), 'router tracks:', manifest['router_tracks'])
+    print('Total Time:', datetime.now() - start_time)
@@ -0,0 +1,144 @@
+import sqlite3
+import argparse
+import numpy as np
+from datetime import datetime
+from scipy.sparse import csr_matrix, vstack, save_npz
+
+# Same database as the app, so the track_ids of the neighbours are the ones SPR_ML_Model loads
+db_file = 'data/spotify_20K_playlists.db'
+cooccurrence_file = 'data/cooccurrence_topk.npz'
+
+def get_num_tracks(conn):
+    cur = conn.cursor()
+    cur.execute('select max(track_id) from tracks')
+    max_track_id = cur.fetchone()[0]
+    cur.execute('select max(track_id) from ratings')
+    return max(max_track_id, cur.fetchone()[0]) + 1
+
+def load_playlist_index(conn, chunk_size=50000, exclude_pids=None):
+    """
+    Binary playlist x track_id CSR matrix of the ratings, a track counts once per playlist.
+    Ratings are read chunk_size playlists at a time and only the CSR arrays of the chunks are kept.
+    :param exclude_pids: playlists left out, e.g. the held-out playlists of code/evaluate_recommender.py
+    :return: csr_matrix (float32) of shape (n_playlists, n_tracks)
+    """
+    n_tracks = get_num_tracks(conn)
+    cur = conn.cursor()
+    cur.execute('select pid from playlists order by pid')
+    pids = np.array([row[0] for row in cur.fetchall()], dtype=np.int64)
+    if exclude_pids is not None:
+        pids = pids[~np.isin(pids, exclude_pids)]
+    chunks = []
+    for start in range(0, len(pids), chunk_size):
+        chunk_pids = pids[start:start + chunk_size]
+        cur.execute('select pid, track_id from ratings where pid >= ? and pid <= ?',
+                    (int(chunk_pids[0]), int(chunk_pids[-1])))
+        rows = np.array(cur.fetchall(), dtype=np.int64).reshape(-1, 2)
+        # Excluded playlists within the pid range of the chunk are dropped here
+        positions = np.minimum(np.searchsorted(chunk_pids, rows[:, 0]), len(chunk_pids) - 1)
+        found = chunk_pids[positions] == rows[:, 0]
+        chunk = csr_matrix((np.ones(int(found.sum()), dtype=np.float32), (positions[found], rows[found, 1])),
+                           shape=(len(chunk_pids), n_tracks))
+        chunk.sum_duplicates()
+        chunk.data[:] = 1
+        chunks.append(chunk)
+    return vstack(chunks, format='csr')
+
+def track_blocks(track_playlists, playlist_index, max_pairs):
+    """
+    Split the tracks into consecutive blocks whose co-occurrence product has at most max_pairs entries,
+    bounded by the summed length of the playlists of each track. A track above the bound gets a block of its own.
+    :return: list of (start, end) track ranges
+    """
+    playlist_lengths = np.diff(playlist_index.indptr).astype(np.float64)
+    pairs = track_playlists @ playlist_lengths
+    blocks = []
+    start = 0
+    total = 0
+    for track in range(len(pairs)):
+        if track > start and total + pairs[track] > max_pairs:
+            blocks.append((start, track))
+            start, total = track, 0
+        total += pairs[track]
+    blocks.append((start, len(pairs)))
+    return blocks
+
+def top_k_rows(rows, cols, scores, k):
+    "Mask of the k highest scores of each row"
+    order = np.lexsort((-scores, rows))
+    sorted_rows = rows[order]
+    rank = np.arange(len(order)) - np.searchsorted(sorted_rows, sorted_rows)
+    keep = np.zeros(len(order), dtype=bool)
+    keep[order[rank < k]] = True
+    return keep
+
+def compute_cooccurrence(playlist_index, k=100, min_count=2, weight='cosine', max_pairs=50000000):
+    """
+    Top-k co-occurrence neighbours of every track, from P^T P of the binary playlist x track matrix P.
+    The product is computed for blocks of tracks at a time (see track_blocks), and only the k best neighbours
+    of each track are kept before the next block, so memory is bounded by P, one block product and the result.
+    :param min_count: playlists two tracks must share to be neighbours
+    :param weight: 'count' scores by the playlists shared, 'cosine' divides that by the square root of the
+                   product of the playlists of each track so popular tracks do not dominate
+    :return: csr_matrix (float32) of shape (n_tracks, n_tracks), row i has the neighbours of track_id i
+    """
+    track_playlists = playlist_index.T.tocsr()
+    popularity = np.diff(track_playlists.indptr).astype(np.float32)
+    n_tracks = track_playlists.shape[0]
+    blocks = track_blocks(track_playlists, playlist_index, max_pairs)
+    print('Tracks:', n_tracks, 'in playlists:', int((popularity > 0).sum()), 'blocks:', len(blocks))
+
+    all_rows, all_cols, all_scores = [], [], []
+    for i, (start, end) in enumerate(blocks):
+        block = (track_playlists[start:end] @ playlist_index).tocoo()
+        rows = block.row.astype(np.int64) + start
+        keep = (rows != block.col) & (block.data >= min_count)
+        rows, cols, counts = rows[keep], block.col[keep], block.data[keep]
+        scores = counts / np.sqrt(popularity[rows] * popularity[cols]) if weight == 'cosine' else counts
+        keep = top_k_rows(rows, cols, scores, k)
+        all_rows.append(rows[keep].astype(np.int32))
+        all_cols.append(cols[keep].astype(np.int32))
+        all_scores.append(scores[keep].astype(np.float32))
+        if (i + 1) % 100 == 0:
+            print('Blocks done:', i + 1, 'of', len(blocks), datetime.now())
+
+    rows, cols, scores = np.concatenate(all_rows), np.concatenate(all_cols), np.concatenate(all_scores)
+    return csr_matrix((scores, (rows, cols)), shape=(n_tracks, n_tracks), dtype=np.float32)
+
+def save_cooccurrence(path, cooccurrence, exclude_pids=None):
+    """
+    save_npz of the matrix with the pids it leaves out in an extra excluded_pids array, which load_npz ignores
+    and evaluate_recommender.py checks against its held-out playlists
+    """
+    save_npz(path, cooccurrence)
+    with np.load(path) as saved:
+        arrays = dict(saved)
+    arrays['excluded_pids'] = np.sort(np.asarray(exclude_pids if exclude_pids is not None else [], dtype=np.int64))
+    np.savez_compressed(path, **arrays)
+
+def load_excluded_pids(path):
+    "pids left out of the matrix of path, empty for a matrix built from all playlists"
+    with np.load(path) as saved:
+        return saved['excluded_pids'] if 'excluded_pids' in saved.files else np.array([], dtype=np.int64)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compute the top-k track to track co-occurrence of the playlists')
+    parser.add_argument('--db', default=db_file)
+    parser.add_argument('--output', default=cooccurrence_file)
+    parser.add_argument('-k', type=int, default=100, help='neighbours kept per track')
+    parser.add_argument('--min-count', type=int, default=2, help='playlists two tracks must share to be neighbours')
+    parser.add_argument('--weight', choices=['cosine', 'count'], default='cosine')
+    parser.add_argument('--max-pairs', type=int, default=50000000, help='bound of the entries of one block product')
+    parser.add_argument('--exclude-pids', default=None, help='.npy of playlists to leave out, e.g. data/eval_holdout_pids.npy')
+    args = parser.parse_args()
+
+    start_time = datetime.now()
+    conn = sqlite3.connect(args.db)
+    exclude_pids = np.load(args.exclude_pids) if args.exclude_pids else None
+    playlist_index = load_playlist_index(conn, exclude_pids=exclude_pids)
+    conn.close()
+    print('Playlists:', playlist_index.shape[0], 'ratings:', playlist_index.nnz, 'loaded in', datetime.now() - start_time)
+    cooccurrence = compute_cooccurrence(playlist_index, args.k, args.min_count, args.weight, args.max_pairs)
+    save_cooccurrence(args.output, cooccurrence, exclude_pids)
+    print('Neighbours:', cooccurrence.nnz, 'tracks with neighbours:', int((np.diff(cooccurrence.indptr) > 0).sum()))
+    print('Total Time:', datetime.now() - start_time)
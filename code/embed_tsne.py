@@ -0,0 +1,132 @@
+import os
+import json
+import pickle
+import argparse
+import numpy as np
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import openTSNE
+
+scaled_data_file = 'data/scaled_data_MPD.csv'
+transformer_file = 'models/openTSNETransformer_MPD.sav'
+embedding_file = 'data/openTSNE_MPD.npy'
+
+# Set in every worker by init_worker
+worker_data = {}
+
+def load_scaled_data(path):
+    if path.endswith('.npy'):
+        return np.load(path, mmap_mode='r')
+    return np.loadtxt(path, delimiter=',')
+
+def scaled_data_npy(data_path):
+    """
+    The scaled data as .npy, converted once next to the csv and reused while it is newer than the csv, so the
+    parent and every worker memory map it instead of each parsing the csv into its own copy
+    :return: path of the .npy
+    """
+    if data_path.endswith('.npy'):
+        return data_path
+    npy_path = os.path.splitext(data_path)[0] + '.npy'
+    if not os.path.exists(npy_path) or os.path.getmtime(npy_path) < os.path.getmtime(data_path):
+        start_time = datetime.now()
+        tmp_path = npy_path + '.tmp.npy'
+        np.save(tmp_path, np.loadtxt(data_path, delimiter=','))
+        os.replace(tmp_path, npy_path)
+        print('Converted', data_path, 'to', npy_path, 'in', datetime.now() - start_time)
+    return npy_path
+
+def progress_paths(embedding_path):
+    base = os.path.splitext(embedding_path)[0]
+    return base + '_sample.npy', base + '_done.npy', base + '_run.json'
+
+def fit_reference(data, sample_size, seed, n_jobs, transformer_path):
+    """
+    Fit the reference t-SNE embedding on a random sample of playlists and pickle it as the transformer
+    :return: sample indices, TSNEEmbedding
+    """
+    sample = np.sort(np.random.RandomState(seed).choice(len(data), min(sample_size, len(data)), replace=False))
+    embedding = openTSNE.TSNE(n_jobs=n_jobs, random_state=seed).fit(np.asarray(data[sample]))
+    with open(transformer_path, 'wb') as tf:
+        pickle.dump(embedding, tf)
+    return sample, embedding
+
+def init_worker(data_path, transformer_path):
+    worker_data['data'] = load_scaled_data(data_path)
+    with open(transformer_path, 'rb') as tf:
+        worker_data['embedding'] = pickle.load(tf)
+
+def transform_chunk(chunk_idx, rows):
+    return chunk_idx, worker_data['embedding'].transform(np.asarray(worker_data['data'][rows])).astype(np.float32)
+
+def embed_all(data_path, sample_size=20000, chunk_size=10000, seed=0, n_workers=None, n_jobs=8,
+              transformer_path=transformer_file, embedding_path=embedding_file):
+    """
+    Embed every playlist: fit on a sample, then place the remaining playlists chunk by chunk with the
+    fitted embedding's transform in a process pool. Coordinates are written to a memory mapped .npy of shape
+    (n_playlists, 2) in the row order of the data. The sample and a per-chunk done flag are saved next to it,
+    so an interrupted run only redoes the chunks that were not written. It is resumed with the same data, chunk
+    size, sample size and seed only.
+    """
+    data_path = scaled_data_npy(data_path)
+    data = load_scaled_data(data_path)
+    sample_path, done_path, run_path = progress_paths(embedding_path)
+    run = {'data': os.path.abspath(data_path), 'rows': len(data), 'chunk_size': chunk_size, 'sample_size': sample_size, 'seed': seed}
+
+    if os.path.exists(done_path):
+        saved_run = None
+        if os.path.exists(run_path):
+            with open(run_path) as rf:
+                saved_run = json.load(rf)
+        if saved_run != run:
+            raise ValueError('Progress of {} was saved by another run, remove {} to start over: {} instead of {}'.format(
+                embedding_path, done_path, saved_run, run))
+        print('Resuming', embedding_path)
+        sample = np.load(sample_path)
+        done = np.load(done_path)
+        coords = np.lib.format.open_memmap(embedding_path, mode='r+')
+    else:
+        start_time = datetime.now()
+        sample, embedding = fit_reference(data, sample_size, seed, n_jobs, transformer_path)
+        print('Fitted reference embedding on', len(sample), 'playlists in', datetime.now() - start_time)
+        coords = np.lib.format.open_memmap(embedding_path, mode='w+', dtype=np.float32, shape=(len(data), 2))
+        coords[sample] = np.asarray(embedding, dtype=np.float32)
+        coords.flush()
+        np.save(sample_path, sample)
+        with open(run_path, 'w') as rf:
+            json.dump(run, rf)
+        done = np.zeros(int(np.ceil((len(data) - len(sample)) / chunk_size)), dtype=bool)
+        np.save(done_path, done)
+
+    remaining = np.setdiff1d(np.arange(len(data)), sample)
+    chunks = [remaining[start:start + chunk_size] for start in range(0, len(remaining), chunk_size)]
+    todo = [chunk_idx for chunk_idx in range(len(chunks)) if not done[chunk_idx]]
+    print('Chunks to embed:', len(todo), 'of', len(chunks))
+
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=init_worker, initargs=(data_path, transformer_path)) as pool:
+        futures = [pool.submit(transform_chunk, chunk_idx, chunks[chunk_idx]) for chunk_idx in todo]
+        for future in as_completed(futures):
+            chunk_idx, chunk_coords = future.result()
+            coords[chunks[chunk_idx]] = chunk_coords
+            coords.flush()
+            done[chunk_idx] = True
+            np.save(done_path, done)
+            print('Embedded chunk', chunk_idx + 1, 'of', len(chunks), '({} done)'.format(int(done.sum())))
+    return coords
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Embed all playlists in 2D with openTSNE fitted on a sample')
+    parser.add_argument('--data', default=scaled_data_file)
+    parser.add_argument('--sample-size', type=int, default=20000)
+    parser.add_argument('--chunk-size', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--n-jobs', type=int, default=8, help='threads used by openTSNE to fit the reference')
+    parser.add_argument('--transformer', default=transformer_file)
+    parser.add_argument('--embedding', default=embedding_file)
+    args = parser.parse_args()
+
+    start_time = datetime.now()
+    embed_all(args.data, sample_size=args.sample_size, chunk_size=args.chunk_size, seed=args.seed,
+              n_workers=args.workers, n_jobs=args.n_jobs, transformer_path=args.transformer, embedding_path=args.embedding)
+    print('Total Time:', datetime.now() - start_time)
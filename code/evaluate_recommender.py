@@ -0,0 +1,203 @@
+import os
+import sys
+import time
+import sqlite3
+import argparse
+import numpy as np
+import pandas as pd
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# Run from the repository root like the app: python code/evaluate_recommender.py
+sys.path.insert(1, os.path.join(os.getcwd(), 'streamlit'))
+import spotipy_client
+from spotify_clients import StubSpotify
+from build_cooccurrence import load_excluded_pids
+
+db_file = 'data/spotify_20K_playlists.db'
+holdout_file = 'data/eval_holdout_pids.npy'
+report_file = 'data/recommender_evaluation.csv'
+
+# Set in every worker by init_worker
+worker_data = {}
+
+def sample_holdout(conn, n_playlists=1000, min_tracks=10, seed_fraction=0.5, split='first', seed=0):
+    """
+    Held-out queries: a random sample of playlists with at least min_tracks tracks, each split into seed tracks
+    given to the recommender and hidden tracks it should find. The sample only depends on seed, so variants run
+    in different invocations are evaluated on the same queries.
+    :param split: 'first' keeps the first seed_fraction of the tracks by position as seeds like the Million Playlist
+                  Dataset challenge, 'random' picks them at random
+    :return: list of dict with pid, seeds and hidden track uris
+    """
+    cur = conn.cursor()
+    cur.execute('select pid from playlists where num_tracks >= ? order by pid', (min_tracks,))
+    pids = np.array([row[0] for row in cur.fetchall()], dtype=np.int64)
+    rng = np.random.RandomState(seed)
+    pids = np.sort(rng.choice(pids, min(n_playlists, len(pids)), replace=False))
+
+    tracks = {}
+    for start in range(0, len(pids), 500):
+        chunk = [int(pid) for pid in pids[start:start + 500]]
+        cur.execute('select r.pid, t.track_uri from ratings r join tracks t on r.track_id = t.track_id '
+                    'where r.pid in ({}) order by r.pid, r.pos'.format(','.join('?' * len(chunk))), chunk)
+        for pid, uri in cur.fetchall():
+            tracks.setdefault(pid, []).append(uri)
+
+    queries = []
+    for pid in pids:
+        uris = list(dict.fromkeys(tracks.get(int(pid), [])))
+        n_seeds = int(len(uris) * seed_fraction)
+        if n_seeds < 1 or n_seeds >= len(uris):
+            continue
+        if split == 'random':
+            uris = [uris[i] for i in rng.permutation(len(uris))]
+        queries.append({'pid': int(pid), 'seeds': uris[:n_seeds], 'hidden': uris[n_seeds:]})
+    return queries
+
+def r_precision(recommended, hidden):
+    "Share of the hidden tracks among the first len(hidden) recommendations"
+    return len(set(recommended[:len(hidden)]) & hidden) / len(hidden)
+
+def ndcg(recommended, hidden):
+    "Normalized discounted cumulative gain of the recommendations with the hidden tracks as relevant"
+    gains = np.array([uri in hidden for uri in recommended], dtype=np.float64)
+    discounts = 1 / np.log2(np.arange(2, len(recommended) + 2))
+    ideal = discounts[:min(len(hidden), len(recommended))].sum()
+    return float((gains * discounts).sum() / ideal) if ideal > 0 else 0.0
+
+def init_worker(model_path, scaled_data_path, cooccurrence_path):
+    "Load the model once per worker process, with the files of the variant instead of the app's"
+    if model_path:
+        spotipy_client.model_path = model_path
+    if scaled_data_path:
+        spotipy_client.train_data_scaled_path = scaled_data_path
+    if cooccurrence_path:
+        spotipy_client.cooccurrence_path = cooccurrence_path
+    ml_model = spotipy_client.SPR_ML_Model()
+    worker_data['ml_model'] = ml_model
+    # All the tracks of the database have their features in it, the stub only answers the ones that do not
+    worker_data['sp'] = StubSpotify(ml_model)
+
+def evaluate_query(query, variant):
+    """
+    Recommend n_songs for the seeds of the query with one variant, the query playlist is excluded from the
+    nearest playlists and the seeds from the songs
+    :return: dict of metrics and seconds
+    """
+    ml_model = worker_data['ml_model']
+    if variant['rec_method'] == 'cooccurrence' and ml_model.cooccurrence is None:
+        # The recommender would fall back to the clusters and the report would credit them to cooccurrence
+        raise RuntimeError('rec_method cooccurrence needs the co-occurrence matrix, {} is missing or built for '
+                           'another database'.format(spotipy_client.cooccurrence_path))
+    start = time.perf_counter()
+    spr = spotipy_client.SpotifyRecommendations(sp=worker_data['sp'], track_uris=query['seeds'], rec_method=variant['rec_method'])
+    spr.log_output = lambda text: None
+    spr.set_ml_model(ml_model)
+    spr.excluded_pids = (query['pid'],)
+    top_playlists = spr.get_top_n_playlists(variant['n_playlists'], variant['metric'])
+    seeds = set(query['seeds'])
+    song_uris = spr.get_songs_recommendations(variant['n_songs'] + len(seeds))
+    recommended = [uri for uri in song_uris if uri not in seeds][:variant['n_songs']]
+    seconds = time.perf_counter() - start
+
+    hidden = set(query['hidden'])
+    playlist_tracks = [ml_model.get_playlist_track_ids([pid]) for pid in top_playlists]
+    hidden_rows = ml_model.get_track_rows(query['hidden'])
+    hidden_ids = ml_model.tracks_df['track_id'].to_numpy()[hidden_rows[hidden_rows >= 0]]
+    return {'r_precision': r_precision(recommended, hidden), 'ndcg': ndcg(recommended, hidden),
+            'hit_rate': float(len(hidden.intersection(recommended)) > 0),
+            'playlist_precision': float(np.mean([np.isin(ids, hidden_ids).any() for ids in playlist_tracks])) if playlist_tracks else 0.0,
+            'songs': len(recommended), 'seconds': seconds}
+
+def evaluate_chunk(queries, variants):
+    return [dict(evaluate_query(query, variant), variant=i, pid=query['pid'])
+            for query in queries for i, variant in enumerate(variants)]
+
+def evaluate(queries, variants, model_path=None, scaled_data_path=None, cooccurrence_path=None, n_workers=None, chunk_size=20):
+    """
+    Run every variant on every query in a process pool, chunk_size queries per task
+    :return: DataFrame with one row per query and variant
+    """
+    chunks = [queries[start:start + chunk_size] for start in range(0, len(queries), chunk_size)]
+    results = []
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=init_worker,
+                             initargs=(model_path, scaled_data_path, cooccurrence_path)) as pool:
+        futures = [pool.submit(evaluate_chunk, chunk, variants) for chunk in chunks]
+        for i, future in enumerate(as_completed(futures)):
+            results.extend(future.result())
+            if (i + 1) % 10 == 0:
+                print('Chunks done:', i + 1, 'of', len(chunks), datetime.now())
+    return pd.DataFrame(results)
+
+def summarize(results_df, variants, wall_seconds):
+    """
+    One report row per variant: mean of the quality metrics over the queries and latency percentiles in ms,
+    total_queries_per_s is the throughput of all the variants together
+    :return: DataFrame
+    """
+    rows = []
+    for i, variant in enumerate(variants):
+        df = results_df[results_df['variant'] == i]
+        ms = df['seconds'].to_numpy() * 1000
+        rows.append(dict(variant, queries=len(df), r_precision=df['r_precision'].mean(), ndcg=df['ndcg'].mean(),
+                         hit_rate=df['hit_rate'].mean(), playlist_precision=df['playlist_precision'].mean(),
+                         mean_ms=ms.mean(), p50_ms=np.percentile(ms, 50), p95_ms=np.percentile(ms, 95), p99_ms=np.percentile(ms, 99),
+                         total_queries_per_s=len(results_df) / wall_seconds))
+    return pd.DataFrame(rows).round(4)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Evaluate recommender variants on held-out playlists of the database')
+    parser.add_argument('--db', default=db_file)
+    parser.add_argument('--playlists', type=int, default=1000, help='playlists to hold out')
+    parser.add_argument('--min-tracks', type=int, default=10)
+    parser.add_argument('--seed-fraction', type=float, default=0.5, help='share of the tracks of a playlist given as seeds')
+    parser.add_argument('--split', choices=['first', 'random'], default='first')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--rec-methods', nargs='+', default=['clusters'], choices=['clusters', 'cooccurrence'])
+    parser.add_argument('--metrics', nargs='+', default=['cityblock'])
+    parser.add_argument('--n-playlists', type=int, nargs='+', default=[10])
+    parser.add_argument('--n-songs', type=int, default=100)
+    parser.add_argument('--model', default=None, help='cluster model to evaluate instead of the app model')
+    parser.add_argument('--scaled-data', default=None, help='scaled playlist features of --model')
+    parser.add_argument('--cooccurrence', default=None, help='co-occurrence matrix built with --exclude-pids of the holdout file')
+    parser.add_argument('--workers', type=int, default=None, help='processes, each loads the model')
+    parser.add_argument('--chunk-size', type=int, default=20, help='queries per task')
+    parser.add_argument('--holdout-file', default=holdout_file, help='where the held-out pids are saved for build_cooccurrence.py')
+    parser.add_argument('--output', default=report_file, help='csv the report rows are appended to')
+    parser.add_argument('--details', default=None, help='csv for the metrics of every query')
+    args = parser.parse_args()
+
+    start_time = datetime.now()
+    conn = sqlite3.connect(args.db)
+    queries = sample_holdout(conn, args.playlists, args.min_tracks, args.seed_fraction, args.split, args.seed)
+    conn.close()
+    np.save(args.holdout_file, np.array([query['pid'] for query in queries], dtype=np.int64))
+    print('Held out', len(queries), 'playlists, pids saved in', args.holdout_file)
+    if 'cooccurrence' in args.rec_methods and (args.cooccurrence is None or not os.path.exists(args.cooccurrence)):
+        # The app's matrix is built from all playlists, the seeds would score the hidden tracks of their own playlist
+        parser.error('rec method cooccurrence needs --cooccurrence, a matrix built with code/build_cooccurrence.py '
+                     '--exclude-pids {}'.format(args.holdout_file))
+    if 'cooccurrence' in args.rec_methods:
+        leaked = np.setdiff1d([query['pid'] for query in queries], load_excluded_pids(args.cooccurrence))
+        if len(leaked):
+            parser.error('{} of the {} held-out playlists are in {}, rebuild it with code/build_cooccurrence.py '
+                         '--exclude-pids {}'.format(len(leaked), len(queries), args.cooccurrence, args.holdout_file))
+
+    variants = [{'rec_method': rec_method, 'metric': metric, 'n_playlists': n_playlists, 'n_songs': args.n_songs}
+                for rec_method in args.rec_methods for metric in args.metrics for n_playlists in args.n_playlists]
+    start = time.perf_counter()
+    results_df = evaluate(queries, variants, args.model, args.scaled_data, args.cooccurrence, args.workers, args.chunk_size)
+    report_df = summarize(results_df, variants, time.perf_counter() - start)
+    report_df.insert(0, 'date', start_time.strftime('%Y-%m-%d %H:%M:%S'))
+    report_df['model'] = args.model or spotipy_client.model_path
+    report_df['seed_fraction'] = args.seed_fraction
+    report_df['split'] = args.split
+
+    print()
+    print(report_df.drop(columns=['date', 'model']).to_string(index=False))
+    report_df.to_csv(args.output, mode='a', header=not os.path.exists(args.output), index=False)
+    print('\nReport appended to', args.output)
+    if args.details:
+        results_df.to_csv(args.details, index=False)
+    print('Total Time:', datetime.now() - start_time)
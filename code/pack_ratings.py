@@ -0,0 +1,85 @@
+import os
+import sys
+import sqlite3
+import argparse
+import numpy as np
+from datetime import datetime
+
+sys.path.insert(1, os.path.join(os.getcwd(), 'streamlit'))
+from db_access import sql_create_packed_ratings_table, pack_playlists
+
+db_file = 'data/spotify_20K_playlists.db'
+
+def get_followers(conn):
+    "num_followers of each playlist by pid, -1 for missing pids"
+    rows = np.array(conn.execute('select pid, num_followers from playlists').fetchall(), dtype=np.int64).reshape(-1, 2)
+    followers = np.full(int(rows[:, 0].max()) + 1 if len(rows) else 0, -1, dtype=np.int64)
+    followers[rows[:, 0]] = rows[:, 1]
+    return followers
+
+def pack_ratings(conn, out_conn, chunk_size=50000):
+    """
+    Write the packed_ratings table of out_conn from the ratings table of conn, chunk_size playlists at a time:
+    one row per playlist with its track_ids in position order as varints of their zigzag encoded differences.
+    num_followers is not copied, it is the same for every track of a playlist and kept in the playlists table,
+    the ratings whose num_followers differs from their playlist's are counted.
+    :return: dict with the playlists and ratings packed, the mismatched num_followers and the bytes of the track_ids
+    """
+    out_conn.execute('DROP TABLE IF EXISTS packed_ratings')
+    out_conn.execute(sql_create_packed_ratings_table)
+    followers = get_followers(conn)
+    cur = conn.cursor()
+    cur.execute('select max(pid) from ratings')
+    max_pid = cur.fetchone()[0]
+    stats = {'playlists': 0, 'ratings': 0, 'followers_mismatch': 0, 'track_ids_bytes': 0}
+    for start in range(0, (max_pid if max_pid is not None else -1) + 1, chunk_size):
+        cur.execute('select pid, pos, track_id, num_followers from ratings where pid >= ? and pid < ?', (start, start + chunk_size))
+        rows = np.array(cur.fetchall(), dtype=np.int64).reshape(-1, 4)
+        if len(rows) == 0:
+            continue
+        rows = rows[np.lexsort((rows[:, 1], rows[:, 0]))]
+        known = rows[:, 0] < len(followers)
+        stats['followers_mismatch'] += int((~known).sum() + (followers[rows[known, 0]] != rows[known, 3]).sum())
+        packed = pack_playlists(rows[:, 0], rows[:, 2])
+        out_conn.executemany('INSERT INTO packed_ratings (pid, num_tracks, track_ids) VALUES (?, ?, ?)', packed)
+        out_conn.commit()
+        stats['playlists'] += len(packed)
+        stats['ratings'] += len(rows)
+        stats['track_ids_bytes'] += sum(len(row[2]) for row in packed)
+        print('Packed playlists:', stats['playlists'], 'ratings:', stats['ratings'], datetime.now())
+    return stats
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pack the ratings table into one row per playlist with varint encoded track_ids')
+    parser.add_argument('--db', default=db_file)
+    parser.add_argument('--output', default=None, help='database of the packed_ratings table, --db by default')
+    parser.add_argument('--chunk-size', type=int, default=50000, help='playlists read at a time')
+    parser.add_argument('--drop-ratings', action='store_true',
+                        help='drop the ratings table of --db once packed and vacuum it. The app reads the packed layout, '
+                             'but build_cooccurrence.py, playlist_features.py, build_cluster_shards.py and '
+                             'evaluate_recommender.py still read the ratings table')
+    args = parser.parse_args()
+
+    start_time = datetime.now()
+    conn = sqlite3.connect(args.db)
+    out_conn = sqlite3.connect(args.output) if args.output else conn
+    stats = pack_ratings(conn, out_conn, args.chunk_size)
+    print('Playlists:', stats['playlists'], 'ratings:', stats['ratings'],
+          'track_ids: {:.2f} MB, {:.2f} bytes per rating'.format(stats['track_ids_bytes'] / 2**20,
+                                                                 stats['track_ids_bytes'] / max(stats['ratings'], 1)))
+    if stats['followers_mismatch']:
+        print('Ratings whose num_followers differs from their playlist:', stats['followers_mismatch'])
+    if args.drop_ratings:
+        if stats['followers_mismatch']:
+            print('Keeping the ratings table, num_followers of some ratings would be lost')
+        elif out_conn is not conn:
+            print('Keeping the ratings table, packed_ratings is in another database')
+        else:
+            conn.execute('DROP TABLE ratings')
+            conn.commit()
+            conn.execute('VACUUM')
+            print('Dropped the ratings table, database size: {:.2f} MB'.format(os.path.getsize(args.db) / 2**20))
+    if out_conn is not conn:
+        out_conn.close()
+    conn.close()
+    print('Total Time:', datetime.now() - start_time)
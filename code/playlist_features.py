@@ -0,0 +1,145 @@
+import sqlite3
+import argparse
+import numpy as np
+from datetime import datetime
+from scipy.sparse import csr_matrix
+
+db_file = 'data/spotify_million_playlists.db'
+pids_file = 'data/playlist_pids.npy'
+mean_file = 'data/playlist_features_mean.npy'
+var_file = 'data/playlist_features_var.npy'
+
+feature_cols = ['danceability', 'energy', 'key', 'loudness', 'mode', 'speechiness', 'acousticness', 'instrumentalness',
+                'liveness', 'valence', 'tempo', 'duration_ms', 'time_signature']
+
+def create_indexes(conn):
+    """ index the join columns so the aggregates scan ratings in pid order
+    :param conn: Connection object
+    :return:
+    """
+    cur = conn.cursor()
+    cur.execute('CREATE INDEX IF NOT EXISTS ratings_pid ON ratings (pid)')
+    cur.execute('CREATE INDEX IF NOT EXISTS features_track_id ON features (track_id)')
+    conn.commit()
+
+def get_all_pids(conn):
+    cur = conn.cursor()
+    cur.execute('select pid from playlists order by pid')
+    return np.array([row[0] for row in cur.fetchall()], dtype=np.int32)
+
+def compute_sql(conn, variance=False, fetch_size=100000):
+    """
+    Per-playlist mean (and variance) of the track audio features as one grouped aggregate over ratings join features.
+    Rows follow the pid order of the playlists table, playlists without any track features are NaN.
+    :param conn: the Connection object
+    :param variance: also compute the population variance
+    :return: pids (int32), mean (float32), var (float32 or None)
+    """
+    pids = get_all_pids(conn)
+    n_feats = len(feature_cols)
+    mean = np.full((len(pids), n_feats), np.nan, dtype=np.float32)
+    var = np.full((len(pids), n_feats), np.nan, dtype=np.float32) if variance else None
+
+    aggregates = ['avg(f.' + col + ')' for col in feature_cols]
+    if variance:
+        aggregates += ['avg(f.' + col + ' * f.' + col + ')' for col in feature_cols]
+    cur = conn.cursor()
+    cur.execute('select r.pid, ' + ', '.join(aggregates) + ' from ratings r join features f on r.track_id = f.track_id '
+                'group by r.pid order by r.pid')
+    while True:
+        rows = cur.fetchmany(fetch_size)
+        if not rows:
+            break
+        rows = np.array(rows, dtype=np.float64)
+        idx = np.searchsorted(pids, rows[:, 0].astype(np.int32))
+        mean[idx] = rows[:, 1:n_feats + 1]
+        if variance:
+            var[idx] = np.maximum(rows[:, n_feats + 1:] - np.square(rows[:, 1:n_feats + 1]), 0)
+    return pids, mean, var
+
+def get_features_array(conn):
+    """
+    Dense features array addressed by track_id, with a mask of the track_ids that have features
+    :return: features (float64, NaN replaced by 0), has_features (bool)
+    """
+    cur = conn.cursor()
+    cur.execute('select max(track_id) from tracks')
+    max_track_id = cur.fetchone()[0]
+    features = np.zeros((max_track_id + 1, len(feature_cols)))
+    has_features = np.zeros(max_track_id + 1, dtype=bool)
+    cur.execute('select track_id, ' + ', '.join(feature_cols) + ' from features')
+    while True:
+        rows = cur.fetchmany(100000)
+        if not rows:
+            break
+        rows = np.array(rows, dtype=np.float64)
+        track_ids = rows[:, 0].astype(np.int64)
+        features[track_ids] = np.nan_to_num(rows[:, 1:])
+        has_features[track_ids] = True
+    return features, has_features
+
+def compute_sparse(conn, variance=False, chunk_size=50000):
+    """
+    Same result as compute_sql, as sparse products of a CSR playlist x track index with the dense features array.
+    Ratings are read chunk_size playlists at a time so memory is bounded by the features array plus one chunk.
+    :return: pids (int32), mean (float32), var (float32 or None)
+    """
+    pids = get_all_pids(conn)
+    features, has_features = get_features_array(conn)
+    n_tracks = len(has_features)
+    mean = np.full((len(pids), len(feature_cols)), np.nan, dtype=np.float32)
+    var = np.full((len(pids), len(feature_cols)), np.nan, dtype=np.float32) if variance else None
+
+    cur = conn.cursor()
+    for start in range(0, len(pids), chunk_size):
+        chunk_pids = pids[start:start + chunk_size]
+        cur.execute('select pid, track_id from ratings where pid >= ? and pid <= ?',
+                    (int(chunk_pids[0]), int(chunk_pids[-1])))
+        rows = np.array(cur.fetchall(), dtype=np.int64).reshape(-1, 2)
+        rows = rows[has_features[rows[:, 1]]]
+        playlist_index = csr_matrix((np.ones(len(rows)), (np.searchsorted(chunk_pids, rows[:, 0]), rows[:, 1])),
+                                    shape=(len(chunk_pids), n_tracks))
+        counts = np.asarray(playlist_index.sum(axis=1)).ravel()
+        found = counts > 0
+        sums = playlist_index @ features
+        chunk_mean = sums[found] / counts[found, None]
+        mean[start:start + chunk_size][found] = chunk_mean
+        if variance:
+            squares = playlist_index @ np.square(features)
+            var[start:start + chunk_size][found] = np.maximum(squares[found] / counts[found, None] - np.square(chunk_mean), 0)
+    return pids, mean, var
+
+def save_playlist_features(pids, mean, var=None, pids_path=pids_file, mean_path=mean_file, var_path=var_file):
+    np.save(pids_path, pids)
+    np.save(mean_path, mean)
+    if var is not None:
+        np.save(var_path, var)
+
+def load_playlist_features(pids_path=pids_file, mean_path=mean_file, mmap_mode='r'):
+    """
+    Load the arrays written by save_playlist_features, memory mapped by default
+    :return: pids, mean
+    """
+    return np.load(pids_path, mmap_mode=mmap_mode), np.load(mean_path, mmap_mode=mmap_mode)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compute average audio features of every playlist')
+    parser.add_argument('--db', default=db_file)
+    parser.add_argument('--method', choices=['sql', 'sparse'], default='sql')
+    parser.add_argument('--variance', action='store_true')
+    parser.add_argument('--pids-output', default=pids_file, help='pids of the rows, pass it to train_kmeans_minibatch.py --pids')
+    parser.add_argument('--mean-output', default=mean_file)
+    parser.add_argument('--var-output', default=var_file)
+    args = parser.parse_args()
+
+    start_time = datetime.now()
+    conn = sqlite3.connect(args.db)
+    create_indexes(conn)
+    if args.method == 'sql':
+        pids, mean, var = compute_sql(conn, variance=args.variance)
+    else:
+        pids, mean, var = compute_sparse(conn, variance=args.variance)
+    conn.close()
+    save_playlist_features(pids, mean, var, args.pids_output, args.mean_output, args.var_output)
+    print('Playlists:', len(pids), 'without features:', int(np.isnan(mean[:, 0]).sum()))
+    print('Total Time:', datetime.now() - start_time)
@@ -1,8 +1,11 @@
 import os
-import re
 import sys
+import csv
 import json
+import time
 import pprint
+import logging
+from logging.handlers import MemoryHandler
 import pandas as pd
 import sqlite3
 from sqlite3 import Error
@@ -18,17 +21,79 @@ pd.set_option('display.max_rows', None)
 zip_file = 'data/spotify_million_playlist_dataset.zip'
 db_file = 'data/spotify_million_playlists.db'
 log_file = 'data/read_spotify_mpd_log.txt'
+metrics_file = 'data/read_spotify_mpd_metrics.csv'
+metrics_columns = ['slice_start', 'slice_end', 'num_playlists', 'num_ratings', 'existing_tracks', 'new_tracks', 'seconds', 'ratings_per_sec']
 
 sys.path.insert(1, os.getcwd())
 import config
+sys.path.insert(1, os.path.join(os.getcwd(), 'streamlit'))
+from spotify_clients import make_client
+from dataset_stats import normalize_name, normalize_names, add_normalized_names, to_date
+from dataset_stats import compute_dataset_stats, format_stats, save_stats, stats_file, stats_text_file
 # Spotify credentials
 os.environ["SPOTIPY_CLIENT_ID"] = config.SPOTIPY_CLIENT_ID
 os.environ["SPOTIPY_CLIENT_SECRET"] = config.SPOTIPY_CLIENT_SECRET
 os.environ['SPOTIPY_REDIRECT_URI'] = config.SPOTIPY_REDIRECT_URI
 
+# Buffer log lines in memory and write them in batches, errors and interpreter exit flush the buffer
+log_handler = logging.FileHandler(log_file, delay=True)
+log_handler.setFormatter(logging.Formatter('%(message)s'))
+logger = logging.getLogger('read_spotify_mpd')
+logger.setLevel(logging.INFO)
+logger.addHandler(MemoryHandler(capacity=1000, flushLevel=logging.ERROR, target=log_handler))
+logger.propagate = False
+
 def write_log(text):
-    with open(log_file, 'a') as lf:
-        lf.write(str(text) + '\n')
+    logger.info(str(text))
+
+def write_metrics(metrics):
+    """ append one row of per-slice ingestion metrics to metrics_file
+    :param metrics: dict with the keys in metrics_columns
+    :return:
+    """
+    write_header = not os.path.exists(metrics_file)
+    with open(metrics_file, 'a', newline='') as mf:
+        writer = csv.DictWriter(mf, fieldnames=metrics_columns)
+        if write_header:
+            writer.writeheader()
+        writer.writerow(metrics)
+
+def log_to_metrics(log_file=log_file, metrics_file=metrics_file):
+    """ backfill metrics_file from a text log written before metrics were recorded
+    Values are keyed by the slice of the last 'File:' line, so a missing line leaves a gap instead of
+    shifting every later slice. Timings were never logged per slice and are left empty.
+    :param log_file: ingestion log
+    :param metrics_file: csv file to create
+    :return: number of slices written
+    """
+    slices = {}
+    metrics = None
+    with open(log_file) as lf:
+        for line in lf:
+            line = line.strip()
+            if line.startswith('File: ') and 'mpd.slice.' in line:
+                slice_start, slice_end = line.split('.')[-2].split('-')
+                metrics = dict.fromkeys(metrics_columns, '')
+                metrics['slice_start'], metrics['slice_end'] = int(slice_start), int(slice_end)
+                slices[metrics['slice_start']] = metrics
+            elif metrics is None:
+                continue
+            elif line.startswith('Adding playlists: '):
+                pid_min, pid_max = line.split(':')[1].strip().split('-')
+                metrics['num_playlists'] = int(pid_max) - int(pid_min) + 1
+            elif line.startswith('Total tracks/ratings in this file'):
+                metrics['num_ratings'] = int(line.split(':')[1])
+            elif line.startswith('Tracks already exist'):
+                metrics['existing_tracks'] = int(line.split(':')[1])
+            elif line.startswith('Created new track_ids'):
+                metrics['new_tracks'] = int(line.split(':')[1])
+
+    with open(metrics_file, 'w', newline='') as mf:
+        writer = csv.DictWriter(mf, fieldnames=metrics_columns)
+        writer.writeheader()
+        for slice_start in sorted(slices):
+            writer.writerow(slices[slice_start])
+    return len(slices)
 
 def create_connection(db_file):
     """ create a database connection to the SQLite database specified by db_file
@@ -79,7 +144,8 @@ def create_all_tables():
                                     num_followers integer,
                                     num_edits integer,
                                     duration_ms integer,
-                                    num_artists integer
+                                    num_artists integer,
+                                    nname text
                                 );"""
 
     sql_create_ratings_table = """CREATE TABLE IF NOT EXISTS ratings (
@@ -116,8 +182,9 @@ def create_all_tables():
         # create tracks table
         create_table(conn, sql_create_tracks_table, 'tracks')
 
-        # create playlists table
+        # create playlists table, databases ingested before nname get the column and their titles normalized
         create_table(conn, sql_create_playlists_table, 'playlists')
+        add_normalized_names(conn)
 
         # create ratings table
         create_table(conn, sql_create_ratings_table, 'ratings')
@@ -203,17 +270,22 @@ def get_table_df(conn, table_name):
     return table_df
 
 def get_average_audio_features(conn, pid):
-    track_ids_df = pd.read_sql('select track_id from ratings where pid=' + str(pid), conn)
-    features_df = get_table_df(conn, 'features')
-    features_df = features_df.merge(track_ids_df, on='track_id')
+    # Join in SQL so only the features of this playlist's tracks are read, use code/playlist_features.py for all pids
+    features_df = pd.read_sql('select f.* from ratings r join features f on r.track_id = f.track_id where r.pid = ?', conn, params=(pid,))
     print('Playlist ', pid, 'has', len(features_df), 'tracks')
     average_df = features_df.drop(columns='track_id').mean()
     print(average_df)
     return average_df
 
-def create_audio_features(cnt_uris=100):
+def create_audio_features(cnt_uris=100, sp=None):
+    """ get the audio features of the tracks that do not have them yet
+    :param cnt_uris: tracks per request
+    :param sp: Spotify client, make_client() by default so SPR_SPOTIFY_MODE=record/replay works offline
+    :return:
+    """
     conn = create_connection(db_file)
-    sp = spotipy.Spotify(client_credentials_manager=SpotifyClientCredentials())
+    if sp is None:
+        sp = make_client(spotipy.Spotify(client_credentials_manager=SpotifyClientCredentials()))
     max_track_id = get_max_track_id(conn, 'tracks')
     min_track_id = get_max_track_id(conn, 'features')
 
@@ -252,62 +324,29 @@ def create_audio_features(cnt_uris=100):
     if conn:
         conn.close()
 
-def normalize_name(name):
-    name = name.lower()
-    name = re.sub(r"[.,\/#!$%\^\*;:{}=\_`~()@]", " ", name)
-    name = re.sub(r"\s+", " ", name).strip()
-    return name
-
-def to_date(epoch):
-    return datetime.fromtimestamp(epoch).strftime("%Y-%m-%d")
-
-def print_most_common(txt, df, col, num, is_date=False):
-    print()
-    print(txt)
-    print("%s %s" % ('  count', col))
-    for name, count in df[col].value_counts()[:num].items():
-        if is_date:
-            print("%7d %s" % (count, to_date(name)))
-        else:
-            print("%7d %s" % (count, name))
-
-def show_summary():
+def show_summary(approximate=False):
+    """ print the summary statistics of the database and save them to data/stats.json and data/stats.txt
+    Computed in one chunked pass by code/dataset_stats.py instead of loading the tables, see compute_dataset_stats
+    :param approximate: HyperLogLog distinct counts instead of exact ones
+    :return: dict of the statistics
+    """
     write_log('Printing Summary Statistics')
-    playlists_df, tracks_df, features_df = read_all_tables()
-    total_playlists = len(playlists_df)
-    #total_tracks = len(tracks_df)
-    total_tracks = playlists_df['num_tracks'].sum()
-    #total_descriptions = len(playlists_df[playlists_df['description'].notna()])
-
-    titles = set(playlists_df["name"].tolist())
-    playlists_df["nname"] = playlists_df["name"].map(normalize_name)
-    ntitles = set(playlists_df["nname"].tolist())
-
-    albums = set(tracks_df["album_uri"].tolist())
-    tracks = set(tracks_df["track_uri"].tolist())
-    artists = set(tracks_df["artist_uri"].tolist())
-
-    print()
-    print("number of playlists", total_playlists)
-    print("number of tracks", total_tracks)
-    print("number of unique tracks", len(tracks))
-    print("number of unique features", len(features_df))
-    print("number of unique albums", len(albums))
-    print("number of unique artists", len(artists))
-    print("number of unique titles", len(titles))
-    #print("number of playlists with descriptions", total_descriptions)
-    print("number of unique normalized titles", len(ntitles))
-    print("avg playlist length", float(total_tracks) / total_playlists)
-    print_most_common("top playlist titles", playlists_df, "nname", 20)
-    tracks_df['full_name'] = tracks_df["track_name"] + " by " + tracks_df["artist_name"]
-    print_most_common("top tracks", tracks_df, 'full_name', 20)
-    print_most_common("top artists", tracks_df, "artist_name", 20)
-    print_most_common("numedits histogram", playlists_df, "num_edits", 20)
-    print_most_common("last modified histogram", playlists_df, "modified_at", 20, True)
-    print_most_common("playlist length histogram", playlists_df, "num_tracks", 20)
-    print_most_common("num followers histogram", playlists_df, "num_followers", 20)
+    conn = create_connection(db_file)
+    stats = compute_dataset_stats(conn, approximate=approximate)
+    if conn:
+        conn.close()
+    stats['db'] = db_file
+    save_stats(stats, stats_file, stats_text_file)
+    print(format_stats(stats))
+    return stats
 
 def process_json_data(json_data, num_playlists):
+    """
+    Add the playlists, ratings and new tracks of one MPD slice to the database
+    :param json_data: parsed slice file
+    :param num_playlists: add only this many playlists if > 0
+    :return: dict of counts for the metrics table, None if nothing was added
+    """
     conn = create_connection(db_file)
 
     # Get Max track_id in tracks table
@@ -317,6 +356,7 @@ def process_json_data(json_data, num_playlists):
     # Get all playlists in the file
     playlists_df = pd.json_normalize(json_data['playlists'])
     playlists_df.drop(['tracks', 'description'], axis=1, inplace=True)
+    playlists_df['nname'] = normalize_names(playlists_df['name'])
     #print(playlists_df.head())
 
     # Remove playlists if they are in database
@@ -326,7 +366,7 @@ def process_json_data(json_data, num_playlists):
         playlists_df = playlists_df.iloc[:num_playlists]
     if len(playlists_df) == 0:
         print('All playlists from this file are in database')
-        return
+        return None
     #print(playlists_df.head(10))
     print('Adding playlists to database:', playlists_df['pid'].min(), playlists_df['pid'].max())
     write_log('Adding all playlists to database from file: ')
@@ -349,14 +389,16 @@ def process_json_data(json_data, num_playlists):
     tracks_df = tracks_df.merge(all_tracks_df, how='left', on='track_uri').fillna(0)
     #print('Total tracks after merge: ', len(tracks_df))
     #print(tracks_df.head(100))
-    print('Tracks already exist', len(tracks_df[tracks_df['track_id'] != 0]['track_uri'].unique()))
-    write_log('Tracks already exist: ' + str(len(tracks_df[tracks_df['track_id'] != 0]['track_uri'].unique())))
+    existing_tracks = len(tracks_df[tracks_df['track_id'] != 0]['track_uri'].unique())
+    print('Tracks already exist', existing_tracks)
+    write_log('Tracks already exist: ' + str(existing_tracks))
     tracks_df['track_id1'] = tracks_df[tracks_df["track_id"] == 0][['track_uri']].groupby('track_uri').ngroup()+max_track_id+1
     tracks_df['track_id'] = tracks_df['track_id'] + tracks_df['track_id1'].fillna(0)
     tracks_df['track_id'] = tracks_df['track_id'].astype('int64')
     #print('Total tracks with new track_id: ', len(tracks_df))
-    print('Created new track_ids', len(tracks_df[tracks_df['track_id1'].notna()]['track_uri'].unique()))
-    write_log('Created new track_ids: ' + str(len(tracks_df[tracks_df['track_id1'].notna()]['track_uri'].unique())))
+    new_tracks = len(tracks_df[tracks_df['track_id1'].notna()]['track_uri'].unique())
+    print('Created new track_ids', new_tracks)
+    write_log('Created new track_ids: ' + str(new_tracks))
 
     # Save ratings to the database
     ratings_df = tracks_df[['pid', 'track_id', 'pos', 'num_followers']]
@@ -377,6 +419,8 @@ def process_json_data(json_data, num_playlists):
 
     if conn:
         conn.close()
+    return {'num_playlists': len(playlists_df), 'num_ratings': len(ratings_df),
+            'existing_tracks': existing_tracks, 'new_tracks': new_tracks}
 
 def extract_mpd_dataset(zip_file, num_files=0, num_playlists=0):
     with ZipFile(zip_file) as zipfiles:
@@ -396,10 +440,19 @@ def extract_mpd_dataset(zip_file, num_files=0, num_playlists=0):
             print('\nFile: ' + filename)
             write_log('\nFile: ' + filename)
 
+            start = time.perf_counter()
             with zipfiles.open(filename) as json_file:
                 json_data = json.loads(json_file.read())
-                process_json_data(json_data, num_playlists)
+                metrics = process_json_data(json_data, num_playlists)
                 #pool.apply(process_json_data, args=(filename, num_playlists))
+            seconds = time.perf_counter() - start
+
+            if metrics is not None:
+                slice_start, slice_end = filename.split('.')[-2].split('-')
+                metrics['slice_start'], metrics['slice_end'] = int(slice_start), int(slice_end)
+                metrics['seconds'] = round(seconds, 3)
+                metrics['ratings_per_sec'] = round(metrics['num_ratings'] / seconds, 1)
+                write_metrics(metrics)
 
             if (cnt == num_files) and (num_files > 0):
                 break
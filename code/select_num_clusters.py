@@ -0,0 +1,127 @@
+import os
+import time
+import argparse
+import numpy as np
+import pandas as pd
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.metrics import pairwise_distances, silhouette_score, davies_bouldin_score, calinski_harabasz_score
+
+scaled_data_file = 'data/scaled_data.csv'
+cache_dir = 'data/cluster_sweep_cache'
+report_file = 'data/cluster_sweep.csv'
+
+# Set in every worker by init_worker so the arrays are loaded once per process, not once per k
+worker_data = {}
+
+def load_scaled_data(path):
+    """
+    Scaled playlist features as written for SPR_ML_Model (csv) or by playlist_features.py/np.save (npy)
+    :return: np.array of shape (n_playlists, n_features)
+    """
+    if path.endswith('.npy'):
+        return np.load(path, mmap_mode='r')
+    return np.loadtxt(path, delimiter=',')
+
+def prepare_cache(data_path, sample_size, seed, cache_path=cache_dir):
+    """
+    Write the arrays shared by all workers: the data as .npy, the silhouette sample indices and the pairwise
+    distances of the sample. Silhouette on all n playlists is O(n^2), on the sample it is O(sample_size^2) and
+    the distances do not depend on k, so they are computed once and reused by every k and every later run.
+    :return: dict of file paths
+    """
+    os.makedirs(cache_path, exist_ok=True)
+    name = os.path.splitext(os.path.basename(data_path))[0]
+    paths = {'data': os.path.join(cache_path, name + '.npy'),
+             'sample': os.path.join(cache_path, '{}_sample_{}_{}.npy'.format(name, sample_size, seed)),
+             'distances': os.path.join(cache_path, '{}_distances_{}_{}.npy'.format(name, sample_size, seed))}
+    if not os.path.exists(paths['data']):
+        np.save(paths['data'], np.asarray(load_scaled_data(data_path), dtype=np.float64))
+    data = np.load(paths['data'], mmap_mode='r')
+
+    if not os.path.exists(paths['distances']):
+        start = time.perf_counter()
+        sample = np.sort(np.random.RandomState(seed).choice(len(data), min(sample_size, len(data)), replace=False))
+        distances = pairwise_distances(data[sample], n_jobs=-1).astype(np.float32)
+        np.save(paths['sample'], sample)
+        np.save(paths['distances'], distances)
+        print('Computed silhouette sample distances in {:.1f}s'.format(time.perf_counter() - start))
+    else:
+        print('Using cached silhouette sample distances', paths['distances'])
+    return paths
+
+def init_worker(paths):
+    worker_data['data'] = np.load(paths['data'], mmap_mode='r')
+    worker_data['sample'] = np.load(paths['sample'])
+    worker_data['distances'] = np.load(paths['distances'], mmap_mode='r')
+
+def evaluate_k(k, minibatch=False, random_state=0):
+    """
+    Fit the model for one k and compute the three indices
+    :return: dict with the scores and the wall time of each step
+    """
+    data = np.asarray(worker_data['data'])
+    start = time.perf_counter()
+    if minibatch:
+        model = MiniBatchKMeans(n_clusters=k, batch_size=4096, random_state=random_state)
+    else:
+        model = KMeans(n_clusters=k, random_state=random_state)
+    labels = model.fit_predict(data)
+    fit_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    sample_labels = labels[worker_data['sample']]
+    silhouette = np.nan
+    if len(np.unique(sample_labels)) > 1:
+        silhouette = silhouette_score(np.asarray(worker_data['distances']), sample_labels, metric='precomputed')
+    davies_bouldin = davies_bouldin_score(data, labels)
+    calinski_harabasz = calinski_harabasz_score(data, labels)
+    score_seconds = time.perf_counter() - start
+    return {'k': k, 'silhouette': silhouette, 'davies_bouldin': davies_bouldin, 'calinski_harabasz': calinski_harabasz,
+            'inertia': model.inertia_, 'fit_seconds': fit_seconds, 'score_seconds': score_seconds}
+
+def sweep(paths, k_values, n_workers=None, minibatch=False):
+    """
+    Evaluate every k in k_values in a process pool
+    :return: DataFrame with one row per k
+    """
+    results = []
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=init_worker, initargs=(paths,)) as pool:
+        futures = [pool.submit(evaluate_k, k, minibatch) for k in k_values]
+        for future in as_completed(futures):
+            result = future.result()
+            print('k={k}: silhouette {silhouette:.4f}, davies-bouldin {davies_bouldin:.4f}, '
+                  'calinski-harabasz {calinski_harabasz:.1f} ({fit_seconds:.1f}s fit, {score_seconds:.1f}s score)'.format(**result))
+            results.append(result)
+    return pd.DataFrame(results).sort_values('k').reset_index(drop=True)
+
+def print_comparison(report_df):
+    # Silhouette and Calinski-Harabasz are better when higher, Davies-Bouldin when lower
+    best = {'silhouette': report_df.loc[report_df['silhouette'].idxmax(), 'k'],
+            'davies_bouldin': report_df.loc[report_df['davies_bouldin'].idxmin(), 'k'],
+            'calinski_harabasz': report_df.loc[report_df['calinski_harabasz'].idxmax(), 'k']}
+    print()
+    print(report_df.to_string(index=False, float_format='{:.4f}'.format))
+    print()
+    for index, k in best.items():
+        print('best k by {}: {}'.format(index, k))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare cluster counts with Silhouette, Davies-Bouldin and Calinski-Harabasz')
+    parser.add_argument('--data', default=scaled_data_file)
+    parser.add_argument('--k-min', type=int, default=5)
+    parser.add_argument('--k-max', type=int, default=30)
+    parser.add_argument('--sample-size', type=int, default=10000, help='playlists used for the silhouette score')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--minibatch', action='store_true', help='use MiniBatchKMeans, for the full 1M playlists')
+    parser.add_argument('--report', default=report_file)
+    args = parser.parse_args()
+
+    start_time = datetime.now()
+    paths = prepare_cache(args.data, args.sample_size, args.seed)
+    report_df = sweep(paths, range(args.k_min, args.k_max + 1), n_workers=args.workers, minibatch=args.minibatch)
+    report_df.to_csv(args.report, index=False)
+    print_comparison(report_df)
+    print('Total Time:', datetime.now() - start_time)
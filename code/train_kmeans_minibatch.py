@@ -0,0 +1,188 @@
+import os
+import pickle
+import sqlite3
+import argparse
+import numpy as np
+from datetime import datetime
+from sklearn.preprocessing import StandardScaler
+from sklearn.cluster import MiniBatchKMeans
+from playlist_features import feature_cols, create_indexes, load_playlist_features, pids_file
+
+db_file = 'data/spotify_million_playlists.db'
+model_file = 'models/KMeans_K17_MPD_model.sav'
+scaler_file = 'models/StdScaler_MPD.sav'
+scaled_data_file = 'data/scaled_data_MPD.csv'
+checkpoint_file = 'models/KMeans_K17_MPD_checkpoint.sav'
+
+class PlaylistFeatureChunks():
+    """
+    Average audio features of all playlists in chunks of chunk_size playlists, in pid order.
+    Reads the matrix written by playlist_features.py (memory mapped) when features_path is given,
+    otherwise aggregates each pid range in the database.
+    :param pids_path: pids written with the matrix of features_path, one per row
+    """
+    def __init__(self, conn=None, features_path=None, chunk_size=20000, pids_path=pids_file):
+        self.conn = conn
+        self.chunk_size = chunk_size
+        if features_path:
+            self.pids, self.features = load_playlist_features(pids_path=pids_path, mean_path=features_path)
+            if len(self.pids) != len(self.features):
+                raise ValueError('{} has {} pids for the {} rows of {}, pass the pids written with the features'.format(
+                    pids_path, len(self.pids), len(self.features), features_path))
+            self.chunks = [(start, start + chunk_size) for start in range(0, len(self.pids), chunk_size)]
+            self.source = os.path.abspath(features_path)
+            self.rows = len(self.pids)
+        else:
+            self.pids = self.features = None
+            cur = conn.cursor()
+            cur.execute('select min(pid), max(pid), count(*) from playlists')
+            min_pid, max_pid, self.rows = cur.fetchone()
+            self.chunks = [(start, start + chunk_size) for start in range(min_pid, max_pid + 1, chunk_size)]
+            self.source = os.path.abspath(conn.execute('pragma database_list').fetchone()[2])
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def describe(self):
+        "What the chunks are read from, a checkpoint is only resumed on the same chunks"
+        return {'source': self.source, 'rows': int(self.rows), 'chunk_size': self.chunk_size, 'n_chunks': len(self.chunks)}
+
+    def read(self, chunk_idx):
+        """
+        :return: pids (np.array), features (np.array of shape (len(pids), len(feature_cols)), NaN for playlists without features)
+        """
+        start, end = self.chunks[chunk_idx]
+        if self.features is not None:
+            return np.asarray(self.pids[start:end]), np.asarray(self.features[start:end], dtype=np.float64)
+        return get_playlist_features(self.conn, start, end)
+
+def get_playlist_features(conn, pid_start, pid_end):
+    """
+    Average audio features of the playlists with pid_start <= pid < pid_end, in pid order.
+    Playlists without any track features get a row of NaN so rows stay aligned with the playlists table.
+    :param conn: the Connection object
+    :return: pids (np.array), features (np.array of shape (len(pids), len(feature_cols)))
+    """
+    cur = conn.cursor()
+    cur.execute('select pid from playlists where pid >= ? and pid < ? order by pid', (pid_start, pid_end))
+    pids = np.array([row[0] for row in cur.fetchall()], dtype=np.int64)
+    avg_cols = ', '.join(['avg(f.' + col + ')' for col in feature_cols])
+    cur.execute('select r.pid, ' + avg_cols + ' from ratings r join features f on r.track_id = f.track_id '
+                'where r.pid >= ? and r.pid < ? group by r.pid', (pid_start, pid_end))
+    rows = np.array(cur.fetchall(), dtype=np.float64).reshape(-1, len(feature_cols) + 1)
+    features = np.full((len(pids), len(feature_cols)), np.nan)
+    features[np.searchsorted(pids, rows[:, 0].astype(np.int64))] = rows[:, 1:]
+    return pids, features
+
+def scale(scaler, features):
+    # NaN rows are playlists without features, put them on the mean
+    return np.nan_to_num(scaler.transform(features))
+
+def save_checkpoint(checkpoint, path):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as cf:
+        pickle.dump(checkpoint, cf)
+    os.replace(tmp_path, path)
+
+def train(chunks, k=17, epochs=3, batch_size=4096, random_state=0, checkpoint_path=checkpoint_file):
+    """
+    Fit the scaler and MiniBatchKMeans over all playlists, reading one PlaylistFeatureChunks chunk at a time.
+    The scaler is fitted in a first pass, then every epoch visits the chunks in a new random order and feeds
+    the model shuffled mini-batches. A checkpoint is written after each epoch and an interrupted run resumes from
+    it when it trains the same k on the same chunks, it is removed once the last epoch is done.
+    :return: scaler, model
+    """
+    rng = np.random.RandomState(random_state)
+    run = dict(chunks.describe(), k=k, batch_size=batch_size, random_state=random_state)
+    checkpoint = None
+    if checkpoint_path and os.path.exists(checkpoint_path):
+        with open(checkpoint_path, 'rb') as cf:
+            checkpoint = pickle.load(cf)
+        if checkpoint.get('run') != run:
+            raise ValueError('Checkpoint {} was written by another run, remove it to start over: {} instead of {}'.format(
+                checkpoint_path, checkpoint.get('run'), run))
+        print('Resuming from checkpoint after epoch', checkpoint['epoch'])
+
+    if checkpoint is None:
+        scaler = StandardScaler()
+        for chunk_idx in range(len(chunks)):
+            pids, features = chunks.read(chunk_idx)
+            if len(pids) > 0:
+                scaler.partial_fit(features)
+        model = MiniBatchKMeans(n_clusters=k, batch_size=batch_size, random_state=random_state)
+        checkpoint = {'scaler': scaler, 'model': model, 'epoch': 0, 'rng': rng, 'run': run}
+        if checkpoint_path:
+            save_checkpoint(checkpoint, checkpoint_path)
+    scaler, model, rng = checkpoint['scaler'], checkpoint['model'], checkpoint['rng']
+
+    for epoch in range(checkpoint['epoch'], epochs):
+        start_time = datetime.now()
+        for chunk_idx in rng.permutation(len(chunks)):
+            pids, features = chunks.read(chunk_idx)
+            if len(pids) == 0:
+                continue
+            scaled = scale(scaler, features)
+            order = rng.permutation(len(scaled))
+            for batch_start in range(0, len(order), batch_size):
+                batch = scaled[order[batch_start:batch_start + batch_size]]
+                # The first batch initialises the centers and needs at least k samples
+                if len(batch) >= k or hasattr(model, 'cluster_centers_'):
+                    model.partial_fit(batch)
+        checkpoint.update({'scaler': scaler, 'model': model, 'epoch': epoch + 1, 'rng': rng})
+        if checkpoint_path:
+            save_checkpoint(checkpoint, checkpoint_path)
+        print('Epoch', epoch + 1, 'of', epochs, 'took', datetime.now() - start_time)
+    if checkpoint_path and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    return scaler, model
+
+def write_artifacts(chunks, scaler, model, model_path=model_file, scaler_path=scaler_file,
+                    scaled_data_path=scaled_data_file):
+    """
+    Write the scaler, the model with labels_ for every playlist and the scaled data in the files SPR_ML_Model loads.
+    Rows of the scaled data and labels_ follow the pid order of the playlists table.
+    """
+    labels = []
+    with open(scaled_data_path, 'w') as sf:
+        for chunk_idx in range(len(chunks)):
+            pids, features = chunks.read(chunk_idx)
+            if len(pids) == 0:
+                continue
+            scaled = scale(scaler, features)
+            labels.append(model.predict(scaled).astype(np.int32))
+            np.savetxt(sf, scaled, delimiter=',')
+    model.labels_ = np.concatenate(labels)
+    print('Cluster sizes:', np.bincount(model.labels_, minlength=model.n_clusters))
+    with open(model_path, 'wb') as mf:
+        pickle.dump(model, mf)
+    with open(scaler_path, 'wb') as sf:
+        pickle.dump(scaler, sf)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Train MiniBatchKMeans on the average audio features of all playlists')
+    parser.add_argument('--db', default=db_file)
+    parser.add_argument('--features', default=None, help='matrix written by playlist_features.py instead of querying the db')
+    parser.add_argument('--pids', default=pids_file, help='pids written by playlist_features.py with --features')
+    parser.add_argument('--k', type=int, default=17)
+    parser.add_argument('--epochs', type=int, default=3)
+    parser.add_argument('--chunk-size', type=int, default=20000)
+    parser.add_argument('--batch-size', type=int, default=4096)
+    parser.add_argument('--checkpoint', default=checkpoint_file)
+    parser.add_argument('--model', default=model_file)
+    parser.add_argument('--scaler', default=scaler_file)
+    parser.add_argument('--scaled-data', default=scaled_data_file)
+    args = parser.parse_args()
+
+    start_time = datetime.now()
+    conn = None
+    if args.features is None:
+        conn = sqlite3.connect(args.db)
+        create_indexes(conn)
+    chunks = PlaylistFeatureChunks(conn, features_path=args.features, chunk_size=args.chunk_size, pids_path=args.pids)
+    scaler, model = train(chunks, k=args.k, epochs=args.epochs, batch_size=args.batch_size,
+                          checkpoint_path=args.checkpoint)
+    write_artifacts(chunks, scaler, model, model_path=args.model,
+                    scaler_path=args.scaler, scaled_data_path=args.scaled_data)
+    if conn:
+        conn.close()
+    print('Total Time:', datetime.now() - start_time)
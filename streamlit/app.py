@@ -8,6 +8,9 @@ import pandas as pd
 # Plot
 import altair as alt
 import os
+import time
+import queue
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # Get the current working directory
 cwd = os.getcwd()
@@ -15,6 +18,11 @@ css_file = os.path.join(cwd, 'streamlit', 'style.css')
 
 # Spotipy
 from spotipy_client import *
+from tracing import tracer, span, start_metrics_server
+
+# Export the tracing spans for a local Prometheus when a port is given
+if os.environ.get('SPR_METRICS_PORT'):
+    start_metrics_server(int(os.environ['SPR_METRICS_PORT']))
 
 # Thanks to streamlitopedia for the following code snippet
 def img_to_bytes(img_path):
@@ -71,6 +79,11 @@ if 'user_op' not in st.session_state:
 def update_user_option():
     st.session_state.user_op = st.session_state.user_selection
 
+if 'mood_text' not in st.session_state:
+    st.session_state.mood_text = 'chill'
+def update_mood():
+    st.session_state.mood_text = st.session_state.mood
+
 if 'ml_model' not in st.session_state:
     st.session_state.ml_model = None
 if 'got_rec' not in st.session_state:
@@ -110,7 +123,9 @@ def add_feedback(feedback):
     rec_name = st.session_state.rec_type
     username = ''
     ml_model_options = ''
-    if st.session_state.rec_type != 'playlist':
+    if st.session_state.rec_type == 'mood':
+        rec_name = st.session_state.mood_text
+    elif st.session_state.rec_type != 'playlist':
         rec_type = 'favorite'
         username = st.session_state.username
     fb_list = [feedback, rec_type, rec_name, ml_model_options, username]
@@ -232,6 +247,37 @@ def dataset_page():
     """
     st.markdown("<br>", unsafe_allow_html=True)
 
+    stats = load_dataset_stats()
+    if stats is not None:
+        st.subheader('Dataset Summary')
+        counts = stats['counts']
+        c1, c2, c3, c4 = st.columns(4)
+        c1.metric('Playlists', '{:,}'.format(counts['playlists']))
+        c2.metric('Tracks', '{:,}'.format(counts['tracks']))
+        c3.metric('Unique Tracks', '{:,}'.format(counts['unique_tracks']))
+        c4.metric('Avg Playlist Length', '{:.1f}'.format(counts['avg_playlist_length']))
+        c1.metric('Unique Albums', '{:,}'.format(counts['unique_albums']))
+        c2.metric('Unique Artists', '{:,}'.format(counts['unique_artists']))
+        c3.metric('Unique Titles', '{:,}'.format(counts['unique_titles']))
+        c4.metric('Unique Normalized Titles', '{:,}'.format(counts['unique_normalized_titles']))
+        if stats.get('approximate'):
+            st.caption('Unique counts are HyperLogLog estimates')
+        _, r4c1, _, r4c2, _, r4c3, _ = st.columns([1, 4, 1, 4, 1, 4, 1])
+        with r4c1:
+            st.markdown('**Top Playlist Titles**')
+            st.dataframe(pd.DataFrame(stats['top']['playlist_titles'], columns=['title', 'playlists']))
+        with r4c2:
+            st.markdown('**Top Artists**')
+            st.dataframe(pd.DataFrame(stats['top']['artists'], columns=['artist', 'tracks']))
+        with r4c3:
+            st.markdown('**Playlist Length**')
+            st.dataframe(pd.DataFrame(stats['top']['playlist_length'], columns=['tracks', 'playlists']))
+        approximate_tops = [name for name in ['playlist_titles', 'artists', 'playlist_length'] if stats.get('top_errors', {}).get(name)]
+        if approximate_tops:
+            st.caption('Approximate top list counts, each at most this much below the true count: ' +
+                       ', '.join('{} {:,}'.format(name, stats['top_errors'][name]) for name in approximate_tops))
+        st.markdown("<br>", unsafe_allow_html=True)
+
     st.subheader('Total VS New Tracks in each json file')
     st.plotly_chart(get_num_tracks_fig('total'), use_container_width=True)
     st.subheader('Existing VS New Tracks in each json file')
@@ -315,7 +361,7 @@ def favs_page():
         st.button("Get Recommendations", key='lm', on_click=get_recommendations, args=('last_month',))
         st.markdown("<br>", unsafe_allow_html=True)
         left_songsholder = st.empty()
-        insert_songs(left_songsholder, st.session_state.fav_songs.last('1M'))
+        insert_songs(left_songsholder, st.session_state.spr.get_tracks_window('last_month')['uri'])
 
     with middle_column:
         st.subheader("6 Months")
@@ -323,7 +369,7 @@ def favs_page():
         st.button("Get Recommendations", key='6m', on_click=get_recommendations, args=('6_months',))
         st.markdown("<br>", unsafe_allow_html=True)
         middle_songsholder = st.empty()
-        insert_songs(middle_songsholder, st.session_state.fav_songs.last('6M'))
+        insert_songs(middle_songsholder, st.session_state.spr.get_tracks_window('6_months')['uri'])
 
     with right_column:
         st.subheader("All Time")
@@ -333,9 +379,22 @@ def favs_page():
         right_songsholder = st.empty()
         insert_songs(right_songsholder, st.session_state.fav_songs)
 
+def mood_page():
+    st.subheader("Playlists matching the Mood")
+    st.markdown('---')
+    spr = st.session_state.spr
+    pids, scores = spr.ml_model.title_index.search(spr.mood, spr.mood_playlists)
+    if len(pids) == 0:
+        st.warning('No playlist title matches this mood, try other words')
+        return False
+    playlists_df = spr.ml_model.db.get_playlists(pids).set_index('pid').loc[pids, ['name', 'num_tracks']].reset_index()
+    playlists_df['score'] = scores
+    st.dataframe(playlists_df)
+    return True
+
 def model_page():
     st.subheader("Select your preference")
-    Types_of_Features = ("Playlist", 'Favorites')
+    Types_of_Features = ("Playlist", 'Favorites', 'Mood')
     st.session_state.user_selection = st.session_state.user_op
     st.radio("Feature", Types_of_Features, key='user_selection', on_change=update_user_option)
 
@@ -343,7 +402,9 @@ def model_page():
         st.session_state.playlist_url = st.session_state.example_url
         st.text_input("Playlist URI", key='playlist_url', on_change=update_playlist_url)
         playlist_uri = st.session_state.playlist_url.split('/')[-1]
-        st.session_state.spr = SpotifyRecommendations(playlist_uri=playlist_uri)
+        # Keep the fetched tracks and features of the playlist across reruns
+        if 'spr' not in st.session_state or st.session_state.spr.playlist_uri != playlist_uri:
+            st.session_state.spr = SpotifyRecommendations(playlist_uri=playlist_uri)
         st.session_state.spr.log_output = log_output
         playlist_page()
         st.markdown("<br>", unsafe_allow_html=True)
@@ -357,12 +418,30 @@ def model_page():
             """)
             st.markdown("<br>", unsafe_allow_html=True)
             st.image(os.path.join(cwd, 'images', 'spotify_get_playlist_uri.png'))
+    elif st.session_state.user_selection == "Mood":
+        st.session_state.mood = st.session_state.mood_text
+        st.text_input("Mood", key='mood', on_change=update_mood)
+        if st.session_state.ml_model is None:
+            with st.spinner('Loading ML Model...'):
+                load_spr_ml_model()
+        spr = st.session_state.get('spr')
+        if spr is None or spr.mood != st.session_state.mood_text:
+            st.session_state.spr = SpotifyRecommendations(mood=st.session_state.mood_text)
+        st.session_state.spr.set_ml_model(st.session_state.ml_model)
+        st.session_state.spr.log_output = log_output
+        if mood_page():
+            st.markdown("<br>", unsafe_allow_html=True)
+            st.button("Get Recommendations", key='md', on_click=get_recommendations, args=('mood',))
     else:
         st.session_state.user = st.session_state.username
         st.text_input('Spotify Username', key='user', on_change=save_spotify_user)
         if st.session_state.authorize:
             if st.session_state.response_url == '':
-                st.session_state.spr = SpotifyRecommendations(sp_user = st.session_state.user)
+                # Keep the fetched favorites and their features across reruns, they are windowed without refetching
+                spr = st.session_state.get('spr')
+                if spr is None or spr.sp is None or spr.playlist_uri is not None or spr.sp_user != st.session_state.user:
+                    st.session_state.spr = SpotifyRecommendations(sp_user = st.session_state.user)
+                    st.session_state.fav_songs = None
                 st.session_state.spr.log_output = log_output
             if st.session_state.spr.sp:
                 favs_page()
@@ -376,6 +455,7 @@ def model_page():
 #@st.cache(suppress_st_warning=True)
 def load_spr_ml_model():
     st.session_state.ml_model = SPR_ML_Model()
+    log_output('ML Model memory footprint (MB):\n' + st.session_state.ml_model.memory_report_df.to_string())
     
 def rec_page():
     if 'spr' not in st.session_state:
@@ -384,6 +464,8 @@ def rec_page():
     
     if st.session_state.rec_type == 'playlist':
         st.subheader('Recommendations based on Playlist:')
+    elif st.session_state.rec_type == 'mood':
+        st.subheader('Recommendations based on the Mood: ' + st.session_state.mood_text)
     elif st.session_state.rec_type == 'last_month':
         st.subheader('Recommendations based on your Last Month Favorites:')
     elif st.session_state.rec_type == '6_months':
@@ -412,19 +494,22 @@ def rec_page():
     else:
         log_output('ML Model already loaded')
     
-    if st.session_state.got_rec == False:
+    figure_holders = {'genre_wordcloud_fig': genre_wordcloud_holder,
+                      'playlist_wordcloud_fig': playlist_wordcloud_holder,
+                      'user_cluster_all_fig': user_cluster_all_holder,
+                      'user_cluster_single_fig': user_cluster_single_holder}
+    got_rec = st.session_state.got_rec
+    if got_rec == False:
         spr = st.session_state.spr
         spr.set_ml_model(st.session_state.ml_model)
         with status_holder:
             with st.spinner('Getting Recommendations...'):
                 spr.len_of_favs = st.session_state.rec_type
                 spr.log_output = log_output
-                st.session_state.rec_uris = spr.get_songs_recommendations(n=10)
-                st.session_state.genre_wordcloud_fig = spr.get_genre_wordcloud_fig()
-                st.session_state.playlist_wordcloud_fig = spr.get_playlist_wordcloud_fig()
-                st.session_state.user_cluster_all_fig = spr.get_user_cluster_all_fig()
-                st.session_state.user_cluster_single_fig = spr.get_user_cluster_single_fig()
-                st.session_state.got_rec = True
+                start = time.perf_counter()
+                with span('recommendation'):
+                    st.session_state.rec_uris = spr.get_songs_recommendations(n=10)
+                log_output('Recommendations took {:.2f}s'.format(time.perf_counter() - start))
             st.success('Here are top 10 recommendations!')
     else:
         log_output('Showing already found recommendations')
@@ -454,10 +539,52 @@ def rec_page():
         except:
             pass
 
-    genre_wordcloud_holder.pyplot(st.session_state.genre_wordcloud_fig)
-    playlist_wordcloud_holder.pyplot(st.session_state.playlist_wordcloud_fig)
-    user_cluster_all_holder.pyplot(st.session_state.user_cluster_all_fig)
-    user_cluster_single_holder.pyplot(st.session_state.user_cluster_single_fig)
+    if got_rec == False:
+        build_figures(spr, figure_holders)
+        st.session_state.got_rec = True
+    else:
+        for fig_name, holder in figure_holders.items():
+            if st.session_state[fig_name] is not None:
+                holder.pyplot(st.session_state[fig_name])
+
+def build_figures(spr, figure_holders):
+    """
+    Build the four figures in a thread pool and draw each one as soon as it is ready.
+    Streamlit calls only work from the script thread, so the workers log into a queue that is drained here.
+    """
+    fig_builders = {'genre_wordcloud_fig': spr.get_genre_wordcloud_fig,
+                    'playlist_wordcloud_fig': spr.get_playlist_wordcloud_fig,
+                    'user_cluster_all_fig': spr.get_user_cluster_all_fig,
+                    'user_cluster_single_fig': spr.get_user_cluster_single_fig}
+    def timed(builder):
+        start = time.perf_counter()
+        fig = builder()
+        return fig, time.perf_counter() - start
+
+    # A figure that fails to build must not leave the previous recommendation's one for the reruns
+    for fig_name in fig_builders:
+        st.session_state[fig_name] = None
+    worker_logs = queue.Queue()
+    spr.log_output = worker_logs.put
+    try:
+        with ThreadPoolExecutor(max_workers=len(fig_builders)) as pool:
+            futures = {pool.submit(timed, builder): fig_name for fig_name, builder in fig_builders.items()}
+            for future in as_completed(futures):
+                fig_name = futures[future]
+                while not worker_logs.empty():
+                    log_output(worker_logs.get())
+                try:
+                    fig, seconds = future.result()
+                except Exception as e:
+                    log_output('Failed to build {}: {}'.format(fig_name, e))
+                    continue
+                st.session_state[fig_name] = fig
+                figure_holders[fig_name].pyplot(fig)
+                log_output('{} took {:.2f}s'.format(fig_name, seconds))
+    finally:
+        spr.log_output = log_output
+    while not worker_logs.empty():
+        log_output(worker_logs.get())
 
 def blog_page():
     st.markdown("<br>", unsafe_allow_html=True)
@@ -619,6 +746,18 @@ def home_page():
                     data=feedback_csv,
                     file_name='user_feedback.csv',
                 )
+
+                st.subheader('Tracing')
+                trace_summary = tracer.summary()
+                if trace_summary:
+                    st.dataframe(pd.DataFrame(trace_summary).set_index('span').round(2))
+                    recent_spans_df = pd.json_normalize(tracer.recent(50)[::-1])
+                    st.dataframe(recent_spans_df)
+                else:
+                    st.write('No spans recorded yet')
+                if tracer.counters:
+                    st.write(tracer.counters)
+                st.button('Reset Tracing', on_click=tracer.reset)
     with r1c3:
         st.image(os.path.join(cwd, 'images', 'Naga.jpg'), width=300)
 
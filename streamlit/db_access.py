@@ -0,0 +1,195 @@
+import os
+import json
+import sqlite3
+import threading
+import numpy as np
+import pandas as pd
+from urllib.request import pathname2url
+
+from varint_codec import encode_deltas, decode_deltas
+
+# Bytes of the playlists database read through a memory map instead of read() calls into SQLite's page cache
+mmap_size = 2**30
+
+def connect_readonly(path, mmap_size=mmap_size):
+    """
+    Read-only connection to a database that nothing writes while it is open, like the playlists database
+    once it is built. immutable=1 skips the file locks and change checks of every query, so the database
+    must not be rebuilt in place while the app runs.
+    """
+    uri = 'file:' + pathname2url(os.path.abspath(path)) + '?mode=ro&immutable=1'
+    conn = sqlite3.connect(uri, uri=True, cached_statements=256)
+    conn.execute('PRAGMA mmap_size={}'.format(int(mmap_size)))
+    conn.execute('PRAGMA query_only=1')
+    return conn
+
+def connect_wal(path):
+    """
+    Read-write connection in WAL mode, readers do not block the writer and the other way around,
+    and a commit appends to the log instead of rewriting the pages
+    """
+    conn = sqlite3.connect(path, timeout=10)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+class ConnectionPool():
+    """
+    One connection per thread to a database, opened on the first use in the thread and kept for the next ones,
+    since sqlite3 connections can not be shared between threads
+    """
+    def __init__(self, path, connect=connect_readonly, setup=None):
+        """
+        :param connect: function opening a connection to path
+        :param setup: function called with each new connection, e.g. to create the tables
+        """
+        self.path = path
+        self.connect = connect
+        self.setup = setup
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.connections = []
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.connect(self.path)
+            if self.setup is not None:
+                self.setup(conn)
+            self.local.conn = conn
+            with self.lock:
+                self.connections.append(conn)
+        return conn
+
+    def close(self):
+        "Close the connections of every thread, the next use opens new ones"
+        with self.lock:
+            for conn in self.connections:
+                conn.close()
+            self.connections = []
+        self.local = threading.local()
+
+def has_table(conn, table):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone() is not None
+
+# Layouts of the tracks of the playlists:
+#   - rows: the ratings table, one row (pid, track_id, pos, num_followers) per track of a playlist
+#   - packed: the packed_ratings table written by code/pack_ratings.py, one row per playlist with its track_ids in
+#     position order as varints of their zigzag encoded differences (encode_deltas), num_followers is in playlists
+sql_create_packed_ratings_table = """CREATE TABLE IF NOT EXISTS packed_ratings (
+                                        pid integer PRIMARY KEY,
+                                        num_tracks integer NOT NULL,
+                                        track_ids blob NOT NULL
+                                    ); """
+
+def pack_playlists(pids, track_ids):
+    """
+    Rows of packed_ratings for the tracks of some playlists
+    :param pids: pid of each track, the tracks of a playlist are consecutive and in position order
+    :param track_ids: track_id of each track
+    :return: list of (pid, num_tracks, track_ids blob)
+    """
+    pids = np.asarray(pids)
+    playlist_pids, starts, counts = np.unique(pids, return_index=True, return_counts=True)
+    order = np.argsort(starts)
+    playlist_pids, starts, counts = playlist_pids[order], starts[order], counts[order]
+    data, offsets = encode_deltas(track_ids, starts)
+    return [(int(pid), int(count), data[offsets[i]:offsets[i + 1]].tobytes())
+            for i, (pid, count) in enumerate(zip(playlist_pids, counts))]
+
+def read_row_playlist(conn, pid):
+    "track_ids of a playlist in position order from the ratings table"
+    rows = conn.execute('SELECT track_id FROM ratings WHERE pid = ? ORDER BY pos', (int(pid),)).fetchall()
+    return np.array([row[0] for row in rows], dtype=np.int64)
+
+def read_packed_playlist(conn, pid):
+    "track_ids of a playlist in position order from the packed_ratings table"
+    row = conn.execute('SELECT track_ids FROM packed_ratings WHERE pid = ?', (int(pid),)).fetchone()
+    if row is None:
+        return np.array([], dtype=np.int64)
+    return decode_deltas(np.frombuffer(row[0], dtype=np.uint8))
+
+def read_row_ratings(conn):
+    """
+    Tracks of all playlists from the ratings table
+    :return: sorted pids, offsets where offsets[i]:offsets[i + 1] are the tracks of pids[i] in track_ids,
+             track_ids (int32) in (pid, pos) order
+    """
+    ratings_df = pd.read_sql('SELECT pid, track_id, pos FROM ratings', conn)
+    order = np.lexsort((ratings_df['pos'].to_numpy(), ratings_df['pid'].to_numpy()))
+    ratings_pids = ratings_df['pid'].to_numpy()[order]
+    track_ids = ratings_df['track_id'].to_numpy()[order].astype(np.int32)
+    pids, offsets = np.unique(ratings_pids, return_index=True)
+    return pids, np.append(offsets, len(ratings_pids)), track_ids
+
+def read_packed_ratings(conn):
+    "Tracks of all playlists from the packed_ratings table, the same arrays as read_row_ratings"
+    rows = conn.execute('SELECT pid, num_tracks, track_ids FROM packed_ratings ORDER BY pid').fetchall()
+    pids = np.array([row[0] for row in rows], dtype=np.int64)
+    counts = np.array([row[1] for row in rows], dtype=np.int64)
+    data = np.frombuffer(b''.join([row[2] for row in rows]), dtype=np.uint8)
+    track_ids = decode_deltas(data, counts).astype(np.int32)
+    return pids, np.append(0, np.cumsum(counts)), track_ids
+
+def ids_param(ids):
+    "A list of ids as one query parameter, read with json_each so a query has the same text for any number of ids"
+    return json.dumps([int(i) for i in ids])
+
+class PlaylistsDB():
+    """
+    Prepared queries on the playlists database through per-thread read-only connections. Each query is
+    always executed with the same text, so sqlite3 compiles it once per connection and reuses the statement.
+    Lists of ids are passed as a single JSON parameter.
+    """
+    queries = {
+        'tracks': 'SELECT * FROM tracks',
+        'playlists': 'SELECT * FROM playlists',
+        'features': 'SELECT * FROM features',
+        'playlists_by_pid': 'SELECT * FROM playlists WHERE pid IN (SELECT value FROM json_each(?))',
+        'playlist_tracks': '''SELECT r.pid, r.pos, t.* FROM ratings r JOIN tracks t ON t.track_id = r.track_id
+                              WHERE r.pid IN (SELECT value FROM json_each(?)) ORDER BY r.pid, r.pos''',
+        'track_features': 'SELECT * FROM features WHERE track_id IN (SELECT value FROM json_each(?))',
+        'tracks_by_uri': 'SELECT * FROM tracks WHERE track_uri IN (SELECT value FROM json_each(?))',
+    }
+    ratings_readers = {'rows': (read_row_playlist, read_row_ratings), 'packed': (read_packed_playlist, read_packed_ratings)}
+
+    def __init__(self, path, mmap_size=mmap_size):
+        self.path = path
+        self.pool = ConnectionPool(path, lambda path: connect_readonly(path, mmap_size))
+        # The packed layout is read when code/pack_ratings.py has written it
+        self.ratings_layout = 'packed' if has_table(self.pool.connection(), 'packed_ratings') else 'rows'
+
+    def query(self, name, *params):
+        """
+        :param name: key of the query in queries
+        :return: DataFrame of the result
+        """
+        return pd.read_sql(self.queries[name], self.pool.connection(), params=params)
+
+    def read_table(self, table):
+        "The whole table, e.g. the tables the model keeps in memory"
+        return self.query(table)
+
+    def get_playlists(self, pids):
+        return self.query('playlists_by_pid', ids_param(pids))
+
+    def get_playlist_tracks(self, pids):
+        "Tracks of the playlists in position order, with the pid and pos of each, from the ratings table"
+        return self.query('playlist_tracks', ids_param(pids))
+
+    def get_playlist_track_ids(self, pid):
+        "track_ids of a playlist in position order, from the ratings layout of the database"
+        return self.ratings_readers[self.ratings_layout][0](self.pool.connection(), pid)
+
+    def read_ratings(self):
+        "Tracks of all playlists as arrays, see read_row_ratings"
+        return self.ratings_readers[self.ratings_layout][1](self.pool.connection())
+
+    def get_track_features(self, track_ids):
+        return self.query('track_features', ids_param(track_ids))
+
+    def get_tracks_by_uri(self, track_uris):
+        return self.query('tracks_by_uri', json.dumps([uri.split(':')[-1] for uri in track_uris]))
+
+    def close(self):
+        self.pool.close()
@@ -0,0 +1,161 @@
+import numpy as np
+from scipy.spatial.distance import cdist
+
+# Tolerance of the kernels against cdist on float64 data, the float32 storage rounds the inputs
+rtol = 1e-4
+atol = 1e-4
+
+class PlaylistDistances():
+    """
+    Scaled features of a set of playlists stored once as float32 with the row norms precomputed, so a distance
+    search only does the work that depends on the query:
+        - euclidean, sqeuclidean: |x|^2 - 2 x.y + |y|^2, one matrix product with the queries
+        - cosine: 1 - x.y on the rows normalized at build time, one matrix product
+        - cityblock, chebyshev: accumulated one feature column at a time for a few queries, cdist for batches
+          of cdist_batch queries or more, where its loop over the pairs is faster
+        - any other cdist metric: cdist
+    The features are stored by column, so a column is contiguous and the rows are a transposed view for the
+    matrix products. Rows are processed block_elements query distances at a time so the temporaries stay in
+    cache whatever the number of playlists. Results match cdist(data, queries) within rtol/atol.
+    Attributes:
+        - ids (np.array): id of each row, e.g. the pids of a cluster
+        - columns (np.array): float32 features of shape (n_dims, n_rows), data is its transposed view
+        - sq_norms (np.array): float32 squared norm of each row
+        - unit (np.array): rows divided by their norm, zero rows stay zero, a view of unit_columns
+    """
+    cdist_batch = 8
+    # Arrays that fully describe an instance, see from_arrays
+    arrays = ['columns', 'sq_norms', 'unit_columns', 'zero_rows', 'ids']
+
+    def __init__(self, data, ids=None, block_elements=2**16):
+        self.columns = np.ascontiguousarray(np.asarray(data, dtype=np.float32).T)
+        self.data = self.columns.T
+        self.ids = np.arange(len(self.data)) if ids is None else np.asarray(ids)
+        self.sq_norms = np.einsum('ij,ij->j', self.columns, self.columns)
+        norms = np.sqrt(self.sq_norms)
+        self.unit_columns = self.columns / np.where(norms > 0, norms, 1)[None, :]
+        self.unit = self.unit_columns.T
+        self.zero_rows = norms == 0
+        self.block_elements = block_elements
+
+    @classmethod
+    def from_arrays(cls, columns, sq_norms, unit_columns, zero_rows, ids, block_elements=2**16):
+        "Instance over arrays computed before, e.g. memory mapped from files, they are used as they are without a copy"
+        distances = cls.__new__(cls)
+        distances.columns = columns
+        distances.data = columns.T
+        distances.ids = ids
+        distances.sq_norms = sq_norms
+        distances.unit_columns = unit_columns
+        distances.unit = unit_columns.T
+        distances.zero_rows = zero_rows
+        distances.block_elements = block_elements
+        return distances
+
+    def __len__(self):
+        return len(self.data)
+
+    @property
+    def nbytes(self):
+        return self.columns.nbytes + self.sq_norms.nbytes + self.unit_columns.nbytes + self.zero_rows.nbytes + self.ids.nbytes
+
+    kernels = {'sqeuclidean': 'squared_euclidean', 'euclidean': 'euclidean', 'cosine': 'cosine',
+               'cityblock': 'cityblock', 'chebyshev': 'chebyshev'}
+
+    def blocks(self, n_queries):
+        "Row ranges of at most block_elements distances"
+        step = max(1, self.block_elements // max(1, n_queries))
+        return [(start, min(start + step, len(self.data))) for start in range(0, len(self.data), step)]
+
+    def distances(self, queries, metric='cityblock'):
+        """
+        Distances of every row to every query, the same as cdist(data, queries, metric)
+        :param queries: array of shape (n_queries, n_dims) or a single vector
+        :return: np.array (float32) of shape (n_rows, n_queries)
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        kernel = self.kernels.get(metric)
+        if kernel is None:
+            return cdist(self.data, queries, metric=metric).astype(np.float32)
+        return getattr(self, kernel)(queries)
+
+    def squared_euclidean(self, queries):
+        out = np.empty((len(self.data), len(queries)), dtype=np.float32)
+        query_sq_norms = np.einsum('ij,ij->i', queries, queries)
+        for start, end in self.blocks(len(queries)):
+            block = out[start:end]
+            np.dot(self.data[start:end], queries.T, out=block)
+            block *= -2
+            block += self.sq_norms[start:end, None]
+            block += query_sq_norms[None, :]
+            # The expansion can go slightly negative for rows equal to a query
+            np.maximum(block, 0, out=block)
+        return out
+
+    def euclidean(self, queries):
+        return np.sqrt(self.squared_euclidean(queries))
+
+    def cosine(self, queries):
+        norms = np.sqrt(np.einsum('ij,ij->i', queries, queries))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            unit_queries = queries / norms[:, None]
+        out = np.empty((len(self.data), len(queries)), dtype=np.float32)
+        for start, end in self.blocks(len(queries)):
+            block = out[start:end]
+            np.dot(self.unit[start:end], unit_queries.T, out=block)
+            np.subtract(1, block, out=block)
+        # Like cdist, the cosine distance with a zero vector is undefined
+        out[self.zero_rows] = np.nan
+        return out
+
+    def accumulate(self, queries, metric, reduce):
+        """
+        Distances summed (np.add) or maximized (np.maximum) over the absolute differences of each feature column,
+        without the n_rows x n_queries x n_dims array of the differences
+        """
+        if len(queries) >= self.cdist_batch:
+            return cdist(self.data, queries, metric=metric).astype(np.float32)
+        out = np.empty((len(self.data), len(queries)), dtype=np.float32)
+        blocks = self.blocks(len(queries))
+        diffs = np.empty((blocks[0][1] - blocks[0][0], len(queries)), dtype=np.float32) if blocks else None
+        for start, end in blocks:
+            block, diff = out[start:end], diffs[:end - start]
+            np.subtract(self.columns[0, start:end, None], queries[None, :, 0], out=block)
+            np.abs(block, out=block)
+            for col in range(1, self.columns.shape[0]):
+                np.subtract(self.columns[col, start:end, None], queries[None, :, col], out=diff)
+                np.abs(diff, out=diff)
+                reduce(block, diff, out=block)
+        return out
+
+    def cityblock(self, queries):
+        return self.accumulate(queries, 'cityblock', np.add)
+
+    def chebyshev(self, queries):
+        return self.accumulate(queries, 'chebyshev', np.maximum)
+
+    def nearest(self, query, n=10, metric='cityblock', similar=True, exclude_ids=None):
+        """
+        Rows of the n nearest (or farthest when not similar) ids to one query, in distance order like
+        cdist(...).argsort()[:n] (or [-n:])
+        :param exclude_ids: ids never returned
+        :return: np.array of ids
+        """
+        distances = self.distances(query, metric)[:, 0]
+        ids = self.ids
+        if exclude_ids is not None and len(exclude_ids):
+            keep = ~np.isin(ids, exclude_ids)
+            ids, distances = ids[keep], distances[keep]
+        order = np.argsort(distances, kind='stable')
+        return ids[order[:n]] if similar else ids[order[-n:]]
+
+def build_cluster_distances(scaled_data, labels, ids=None):
+    """
+    One PlaylistDistances per cluster
+    :param ids: id of each row of scaled_data, its row number when None
+    :return: dict of cluster -> PlaylistDistances
+    """
+    labels = np.asarray(labels)
+    ids = np.arange(len(labels)) if ids is None else np.asarray(ids)
+    return {int(cluster): PlaylistDistances(scaled_data[labels == cluster], ids[labels == cluster])
+            for cluster in np.unique(labels)}
@@ -0,0 +1,227 @@
+import json
+import time
+import argparse
+import spotipy
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from spotipy.oauth2 import SpotifyClientCredentials
+
+from spotipy_client import SPR_ML_Model, SpotifyRecommendations, feature_cols
+from spotify_clients import StubSpotify
+from tracing import tracer, span
+
+max_body_bytes = 1 << 20
+max_track_uris = 10000
+
+class PooledHTTPServer(HTTPServer):
+    """
+    HTTPServer that handles each connection in a fixed size thread pool instead of a new thread per connection,
+    so a burst of requests queues up instead of starting an unbounded number of threads.
+    """
+    request_queue_size = 256
+
+    def __init__(self, server_address, handler_class, workers=16):
+        super().__init__(server_address, handler_class)
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=True)
+
+class RecommendationService():
+    """
+    Recommendations for a feature vector or a list of track uris from one preloaded SPR_ML_Model shared by all requests.
+    Each request gets its own SpotifyRecommendations, which only holds references to the model tables.
+    Attributes:
+        - ml_model (SPR_ML_Model): loaded model and data
+        - sp: Spotify client shared by all requests, spotipy.Spotify or spotify_clients.StubSpotify
+        - verbose (bool): print the log of every request
+    """
+    def __init__(self, ml_model, sp, verbose=False):
+        self.ml_model = ml_model
+        self.sp = sp
+        self.verbose = verbose
+        self.playlist_names = ml_model.playlists_df.set_index('pid')['name']
+
+    def log_output(self, text):
+        if self.verbose:
+            print(text)
+
+    def health(self):
+        return {'status': 'ok', 'playlists': len(self.ml_model.playlists_df), 'tracks': len(self.ml_model.tracks_df),
+                'clusters': int(self.ml_model.model.n_clusters), 'shard_cluster': self.ml_model.shard_cluster,
+                'memory_mb': float(self.ml_model.memory_report_df.loc['total', 'after_mb'])}
+
+    def recommend(self, params, track_uris=None, feature_vector=None):
+        """
+        :param params: request options n_playlists, n_songs, metric, similar and rec_method
+        :return: dict with the cluster, the top playlists and the recommended song uris
+        """
+        start = time.perf_counter()
+        spr = SpotifyRecommendations(sp=self.sp, track_uris=track_uris, feature_vector=feature_vector,
+                                     rec_method=params['rec_method'])
+        spr.log_output = self.log_output
+        spr.set_ml_model(self.ml_model)
+        top_playlists = spr.get_top_n_playlists(params['n_playlists'], params['metric'], params['similar'])
+        song_uris = spr.get_songs_recommendations(params['n_songs'])
+        return {'cluster': int(spr.get_user_cluster()[0]),
+                'playlists': [{'pid': int(pid), 'name': str(self.playlist_names.get(pid, ''))} for pid in top_playlists],
+                'songs': [str(uri) for uri in song_uris],
+                'seconds': round(time.perf_counter() - start, 4)}
+
+def parse_params(body):
+    """
+    Validate the options shared by both recommend endpoints
+    :return: dict of options, raises ValueError for invalid values
+    """
+    params = {'n_playlists': body.get('n_playlists', 10), 'n_songs': body.get('n_songs', 30),
+              'metric': body.get('metric', 'cityblock'), 'similar': body.get('similar', True),
+              'rec_method': body.get('rec_method', 'clusters')}
+    for name in ['n_playlists', 'n_songs']:
+        if not isinstance(params[name], int) or not 0 < params[name] <= 1000:
+            raise ValueError(name + ' must be an integer between 1 and 1000')
+    if params['metric'] not in ['cityblock', 'euclidean', 'cosine', 'sqeuclidean', 'chebyshev']:
+        raise ValueError('unsupported metric: ' + str(params['metric']))
+    if not isinstance(params['similar'], bool):
+        raise ValueError('similar must be true or false')
+    if params['rec_method'] not in ['clusters', 'cooccurrence']:
+        raise ValueError('rec_method must be clusters or cooccurrence')
+    return params
+
+def parse_feature_vector(body):
+    "features as a list in feature_cols order or as a dict by feature name"
+    features = body.get('features')
+    if isinstance(features, dict):
+        missing = [col for col in feature_cols if col not in features]
+        if missing:
+            raise ValueError('missing features: ' + ', '.join(missing))
+        features = [features[col] for col in feature_cols]
+    if not isinstance(features, list) or len(features) != len(feature_cols):
+        raise ValueError('features must be a list of {} numbers: {}'.format(len(feature_cols), ', '.join(feature_cols)))
+    if not all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in features):
+        raise ValueError('features must be numbers')
+    return [float(value) for value in features]
+
+def parse_track_uris(body):
+    track_uris = body.get('track_uris')
+    if not isinstance(track_uris, list) or not track_uris or not all(isinstance(uri, str) and uri for uri in track_uris):
+        raise ValueError('track_uris must be a non empty list of track uris')
+    if len(track_uris) > max_track_uris:
+        raise ValueError('at most {} track_uris per request'.format(max_track_uris))
+    return track_uris
+
+class RecommendationHandler(BaseHTTPRequestHandler):
+    """
+    GET  /health
+    GET  /metrics           tracing spans in the Prometheus text format
+    POST /recommend/vector  {"features": [...] or {...}, "n_playlists": 10, "n_songs": 30, "metric": "cityblock", "similar": true}
+    POST /recommend/tracks  {"track_uris": [...], "n_playlists": 10, "n_songs": 30, "metric": "cityblock", "similar": true,
+                            "rec_method": "clusters" or "cooccurrence"}
+    """
+    protocol_version = 'HTTP/1.1'
+    service = None
+
+    def send_json(self, status, data):
+        payload = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > max_body_bytes:
+            raise ValueError('request body too large')
+        try:
+            body = json.loads(self.rfile.read(length) or b'{}')
+        except json.JSONDecodeError as e:
+            raise ValueError('invalid JSON: ' + str(e))
+        if not isinstance(body, dict):
+            raise ValueError('request body must be a JSON object')
+        return body
+
+    def do_GET(self):
+        if self.path == '/health':
+            self.send_json(200, self.service.health())
+        elif self.path == '/metrics':
+            payload = tracer.prometheus_text().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+        else:
+            self.send_json(404, {'error': 'not found: ' + self.path})
+
+    def do_POST(self):
+        if self.path not in ['/recommend/vector', '/recommend/tracks']:
+            # The body is not read, so the connection can not be reused
+            self.close_connection = True
+            self.send_json(404, {'error': 'not found: ' + self.path})
+            return
+        try:
+            body = self.read_json()
+            params = parse_params(body)
+            if self.path == '/recommend/vector':
+                request = {'feature_vector': parse_feature_vector(body)}
+            else:
+                request = {'track_uris': parse_track_uris(body)}
+        except ValueError as e:
+            self.close_connection = True
+            self.send_json(400, {'error': str(e)})
+            return
+        try:
+            with span('request' + self.path.replace('/', '.')):
+                result = self.service.recommend(params, **request)
+            self.send_json(200, result)
+        except Exception as e:
+            self.log_error('%s failed: %r', self.path, e)
+            self.send_json(500, {'error': 'recommendation failed'})
+
+    def log_message(self, format, *args):
+        if self.service.verbose:
+            super().log_message(format, *args)
+
+def create_server(service, host='127.0.0.1', port=8502, workers=16):
+    handler_class = type('Handler', (RecommendationHandler,), {'service': service})
+    return PooledHTTPServer((host, port), handler_class, workers=workers)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='HTTP JSON service for playlist and song recommendations')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8502)
+    parser.add_argument('--workers', type=int, default=16)
+    parser.add_argument('--stub', action='store_true', help='answer Spotify API calls locally with StubSpotify')
+    parser.add_argument('--stub-latency', type=float, default=0.0, help='seconds StubSpotify sleeps on every call')
+    parser.add_argument('--shard', default=None, help='serve only the cluster of a shard directory from code/build_cluster_shards.py')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    start_time = datetime.now()
+    ml_model = SPR_ML_Model(shard_dir=args.shard)
+    print('Loaded ML Model in', datetime.now() - start_time)
+    if args.stub:
+        sp = StubSpotify(ml_model, latency=args.stub_latency)
+    else:
+        sp = spotipy.Spotify(client_credentials_manager=SpotifyClientCredentials())
+    server = create_server(RecommendationService(ml_model, sp, verbose=args.verbose), args.host, args.port, args.workers)
+    print('Serving recommendations on http://{}:{} with {} workers'.format(args.host, args.port, args.workers))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,185 @@
+import os
+import sys
+import json
+import time
+import pickle
+import argparse
+import itertools
+import threading
+import subprocess
+import numpy as np
+import spotipy
+from datetime import datetime
+from spotipy.oauth2 import SpotifyClientCredentials
+
+from spotipy_client import scaler_path, feature_cols
+from spotify_clients import StubSpotify, make_session
+from rec_service import create_server
+from tracing import span, count
+
+cwd = os.getcwd()
+shards_dir = os.path.join(cwd, 'data', 'shards')
+
+class ShardRouter():
+    """
+    Front of the cluster shards built by code/build_cluster_shards.py, with the interface of RecommendationService
+    so rec_service.create_server serves it. A request's user vector is computed here from the router index,
+    its cluster is predicted with the model and scaler, and the vector is forwarded to /recommend/vector of a
+    rec_service instance serving that cluster's shard. The router holds no playlists, so it stays small.
+    Attributes:
+        - shard_urls (dict): base urls of the instances of each cluster, requests go round robin among them
+        - sp: Spotify client for the audio features of tracks that are not in the router index
+        - http: session with pooled connections to the shards
+    Tracks are only used for their features, so rec_method 'cooccurrence' is answered by 'clusters' on the shards.
+    """
+    def __init__(self, shard_urls, sp, shards_path=shards_dir, http=None, timeout=30, verbose=False):
+        with open(os.path.join(shards_path, 'shards.json')) as mf:
+            self.manifest = json.load(mf)
+        self.model = pickle.load(open(self.manifest['model'], 'rb'))
+        self.scaler = pickle.load(open(scaler_path, 'rb'))
+        index = np.load(os.path.join(shards_path, 'router.npz'))
+        self.track_uris = index['track_uris']
+        self.track_features = index['features']
+        self.has_features = ~np.isnan(self.track_features).any(axis=1)
+        self.sp = sp
+        self.http = http or make_session(retries=1)
+        self.timeout = timeout
+        self.verbose = verbose
+        self.shard_urls = {int(cluster): list(urls) for cluster, urls in shard_urls.items()}
+        self.next_url = {cluster: itertools.cycle(urls) for cluster, urls in self.shard_urls.items()}
+        self.lock = threading.Lock()
+
+    def health(self):
+        shards = {}
+        for cluster, urls in self.shard_urls.items():
+            for url in urls:
+                try:
+                    shards[url] = self.http.get(url + '/health', timeout=self.timeout).json()
+                except Exception as e:
+                    shards[url] = {'status': 'unreachable', 'error': str(e)}
+        status = 'ok' if all(shard.get('status') == 'ok' for shard in shards.values()) else 'degraded'
+        return {'status': status, 'tracks': len(self.track_uris), 'clusters': int(self.model.n_clusters), 'shards': shards}
+
+    def get_audio_features(self, track_uris):
+        """
+        Audio features of the tracks the way SpotifyRecommendations gets them: from the index for the known tracks,
+        from Spotify for the others, and none for known tracks without features
+        :return: np.array (float64) with a row per track that has features
+        """
+        uris = list(dict.fromkeys(uri.split(':')[-1] for uri in track_uris))
+        count('tracks', len(uris))
+        keys = np.array(uris, dtype='S22')
+        pos = np.minimum(np.searchsorted(self.track_uris, keys), len(self.track_uris) - 1)
+        known = (self.track_uris[pos] == keys) & (np.char.str_len(np.array(uris, dtype=str)) <= 22)
+        features = [self.track_features[pos[known & self.has_features[pos]]].astype(np.float64)]
+        unknown = [uri for uri, found in zip(uris, known) if not found]
+        for start in range(0, len(unknown), 100):
+            count('api_calls')
+            found = [feats for feats in self.sp.audio_features(unknown[start:start + 100]) if feats]
+            if found:
+                features.append(np.array([[feats[col] for col in feature_cols] for feats in found], dtype=np.float64))
+        return np.concatenate(features)
+
+    def route(self, feature_vector):
+        "Cluster of the raw user vector and the url of the shard instance to send it to"
+        cluster = int(self.model.predict(self.scaler.transform(np.asarray(feature_vector).reshape(1, -1)))[0])
+        urls = self.next_url.get(cluster)
+        if urls is None:
+            raise RuntimeError('no shard serves cluster {}'.format(cluster))
+        with self.lock:
+            return cluster, next(urls)
+
+    def recommend(self, params, track_uris=None, feature_vector=None):
+        start = time.perf_counter()
+        if feature_vector is None:
+            with span('router.user_vector'):
+                feature_vector = self.get_audio_features(track_uris).mean(axis=0).tolist()
+        with span('router.route'):
+            cluster, url = self.route(feature_vector)
+        with span('router.forward'):
+            r = self.http.post(url + '/recommend/vector', json=dict(params, features=feature_vector), timeout=self.timeout)
+        if r.status_code != 200:
+            raise RuntimeError('shard {} answered {}: {}'.format(url, r.status_code, r.text[:200]))
+        result = r.json()
+        result.update(shard=url, shard_seconds=result['seconds'], seconds=round(time.perf_counter() - start, 4))
+        return result
+
+def start_local_shards(shards_path=shards_dir, base_port=8600, stub=False, workers=4, clusters=None):
+    """
+    Start one rec_service process per shard on consecutive ports, a local stand-in for one node per cluster
+    :param clusters: clusters to start, all the shards when None
+    :return: dict of cluster -> [url], list of the processes
+    """
+    with open(os.path.join(shards_path, 'shards.json')) as mf:
+        manifest = json.load(mf)
+    script = os.path.join(cwd, 'streamlit', 'rec_service.py')
+    shard_urls, processes = {}, []
+    for i, (cluster, shard) in enumerate(sorted(manifest['shards'].items(), key=lambda item: int(item[0]))):
+        if clusters is not None and int(cluster) not in clusters:
+            continue
+        port = base_port + i
+        command = [sys.executable, script, '--shard', os.path.join(shards_path, shard['path']), '--port', str(port),
+                   '--workers', str(workers)]
+        if stub:
+            command.append('--stub')
+        processes.append(subprocess.Popen(command, stdout=subprocess.DEVNULL))
+        shard_urls[int(cluster)] = ['http://127.0.0.1:{}'.format(port)]
+    return shard_urls, processes
+
+def wait_for_shards(shard_urls, http, timeout=600):
+    "Block until every shard answers /health"
+    deadline = time.time() + timeout
+    for urls in shard_urls.values():
+        for url in urls:
+            while True:
+                try:
+                    if http.get(url + '/health', timeout=5).status_code == 200:
+                        break
+                except Exception:
+                    pass
+                if time.time() > deadline:
+                    raise RuntimeError('shard {} did not start'.format(url))
+                time.sleep(0.5)
+
+def parse_shard_urls(values):
+    "cluster=url[,url...] arguments to a dict of cluster -> [url]"
+    shard_urls = {}
+    for value in values:
+        cluster, _, urls = value.partition('=')
+        shard_urls.setdefault(int(cluster), []).extend(url.rstrip('/') for url in urls.split(','))
+    return shard_urls
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Route recommendation requests to the shard of their predicted cluster')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8502)
+    parser.add_argument('--workers', type=int, default=16)
+    parser.add_argument('--shards', default=shards_dir, help='directory written by code/build_cluster_shards.py')
+    parser.add_argument('--shard-urls', nargs='*', default=None,
+                        help='cluster=url[,url...] of running shard instances, several urls are used round robin')
+    parser.add_argument('--base-port', type=int, default=8600, help='first port of the shards started locally')
+    parser.add_argument('--shard-workers', type=int, default=4)
+    parser.add_argument('--stub', action='store_true', help='answer Spotify API calls locally with StubSpotify')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    start_time = datetime.now()
+    processes = []
+    if args.shard_urls:
+        shard_urls = parse_shard_urls(args.shard_urls)
+    else:
+        shard_urls, processes = start_local_shards(args.shards, args.base_port, args.stub, args.shard_workers)
+    sp = StubSpotify() if args.stub else spotipy.Spotify(client_credentials_manager=SpotifyClientCredentials())
+    router = ShardRouter(shard_urls, sp, args.shards, verbose=args.verbose)
+    wait_for_shards(shard_urls, router.http)
+    print('Shards ready in', datetime.now() - start_time)
+    server = create_server(router, args.host, args.port, args.workers)
+    print('Routing recommendations on http://{}:{} to {} clusters'.format(args.host, args.port, len(shard_urls)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        for process in processes:
+            process.terminate()
@@ -0,0 +1,89 @@
+import os
+import json
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    # No file locks on Windows, processes loading at the same time then all write the same files
+    fcntl = None
+
+# Directory of the shared model arrays, each process loads its own copy of the arrays when it is not set
+shared_arrays_dir = os.environ.get('SPR_SHARED_ARRAYS')
+
+# Changed when the arrays written by SPR_ML_Model change, so older directories are rebuilt
+layout_version = 1
+
+def source_key(paths):
+    "Size and modification time of the files the arrays are computed from, None for missing files"
+    key = {'layout_version': layout_version}
+    for path in paths:
+        stat = os.stat(path) if os.path.exists(path) else None
+        key[os.path.abspath(path)] = [stat.st_size, stat.st_mtime_ns] if stat else None
+    return key
+
+class SharedArrays():
+    """
+    Numeric arrays of the model written once as .npy files and memory mapped read-only by every process serving
+    the same model. The pages of a file are held once in the page cache and mapped by all the processes, so
+    another app or worker process only costs its own python objects and tables instead of a copy of the arrays.
+    A manifest written after the arrays holds the key of the sources they were computed from; arrays built from
+    other sources are rebuilt. The first process to load the model builds them under a file lock while the others
+    wait, then attach.
+    """
+    def __init__(self, directory, sources):
+        """
+        :param directory: directory of the arrays of one model, created when missing
+        :param sources: paths of the files the arrays are computed from
+        """
+        self.directory = directory
+        self.key = source_key(sources)
+        self.manifest_path = os.path.join(directory, 'manifest.json')
+
+    def array_path(self, name):
+        return os.path.join(self.directory, name + '.npy')
+
+    def attach(self):
+        """
+        :return: dict of name -> read-only np.memmap, None when the arrays are missing or were built from other sources
+        """
+        if not os.path.exists(self.manifest_path):
+            return None
+        with open(self.manifest_path) as f:
+            manifest = json.load(f)
+        if manifest['key'] != self.key:
+            return None
+        return {name: np.load(self.array_path(name), mmap_mode='r') for name in manifest['arrays']}
+
+    def publish(self, arrays):
+        """
+        Write the arrays, each file is written under a temporary name and renamed, so processes still mapping
+        the previous version keep reading it
+        :param arrays: dict of name -> np.array
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        for name, array in arrays.items():
+            tmp_path = self.array_path(name) + '.{}.tmp'.format(os.getpid())
+            with open(tmp_path, 'wb') as f:
+                np.save(f, np.ascontiguousarray(array))
+            os.replace(tmp_path, self.array_path(name))
+        tmp_path = self.manifest_path + '.{}.tmp'.format(os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump({'key': self.key, 'arrays': list(arrays)}, f)
+        os.replace(tmp_path, self.manifest_path)
+
+    def load_or_publish(self, build):
+        """
+        Attach the arrays, built and published first when they are missing or outdated
+        :param build: function returning the dict of arrays
+        :return: dict of name -> read-only np.memmap
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, 'lock'), 'w') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            arrays = self.attach()
+            if arrays is None:
+                self.publish(build())
+                arrays = self.attach()
+        return arrays
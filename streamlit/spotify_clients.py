@@ -0,0 +1,638 @@
+import os
+import copy
+import json
+import math
+import time
+import zlib
+import atexit
+import random
+import threading
+import numpy as np
+import pandas as pd
+import requests
+import spotipy
+from urllib.parse import urlparse, parse_qs
+from urllib3.util.retry import Retry
+from requests.adapters import HTTPAdapter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from spotipy.oauth2 import SpotifyClientCredentials
+from spotipy.exceptions import SpotifyException
+
+# Client used by SpotifyRecommendations, SpotifyAPI and create_audio_features when none is passed:
+#   live    talk to the Spotify API
+#   record  talk to the Spotify API and save every response to the fixtures file
+#   replay  answer from the fixtures file only, with simulated latency and rate limit
+spotify_mode = os.environ.get('SPR_SPOTIFY_MODE', 'live')
+default_fixtures_file = os.path.join(os.getcwd(), 'data', 'spotify_fixtures.json')
+
+# Value ranges of the Spotify audio features, in the order of feature_cols, used for tracks the stub does not know
+feature_ranges = {'danceability': (0, 1), 'energy': (0, 1), 'key': (0, 11), 'loudness': (-30, 0), 'mode': (0, 1),
+                  'speechiness': (0, 1), 'acousticness': (0, 1), 'instrumentalness': (0, 1), 'liveness': (0, 1),
+                  'valence': (0, 1), 'tempo': (60, 200), 'duration_ms': (120000, 360000), 'time_signature': (3, 5)}
+integer_features = ['key', 'mode', 'duration_ms', 'time_signature']
+stub_genres = ['pop', 'rock', 'hip hop', 'rap', 'dance pop', 'indie', 'edm', 'country', 'r&b', 'latin', 'jazz',
+               'soul', 'folk', 'metal', 'house', 'reggaeton', 'classical', 'blues', 'punk', 'k-pop']
+base62 = np.array(list('0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'))
+
+def random_uris(rng, n):
+    "n random 22 character base62 ids, which are almost surely not in the database"
+    return [''.join(chars) for chars in base62[rng.randint(0, 62, size=(n, 22))]]
+
+def call_key(method, params):
+    "Key of a recorded call, the same for the recording and the replaying client"
+    return method + ' ' + json.dumps(params, sort_keys=True)
+
+def track_id(uri):
+    return uri.split(':')[-1]
+
+class SimulatedNetwork():
+    """
+    Latency and rate limit of the Spotify Web API for the offline clients, so throughput measured against them
+    behaves like the network-bound path. The rate limit is a token bucket of burst calls refilled at rate_limit
+    calls per second.
+    Attributes:
+        - latency (float): seconds slept on every call
+        - jitter (float): each latency is drawn uniformly from latency * (1 - jitter) to latency * (1 + jitter)
+        - rate_limit (float): average calls per second allowed, None for no limit
+        - burst (int): calls allowed back to back before the rate limit applies
+        - on_rate_limit (str): 'wait' sleeps until the call is allowed, 'raise' raises the SpotifyException 429
+          with a Retry-After header that the API returns
+        - calls (int): number of calls made, calls_by_method has them by method
+        - rate_limited (int): number of calls that waited or were rejected because of the rate limit
+    """
+    def __init__(self, latency=0.0, jitter=0.0, rate_limit=None, burst=10, on_rate_limit='wait', seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.burst = burst
+        self.on_rate_limit = on_rate_limit
+        self.calls = 0
+        self.calls_by_method = {}
+        self.rate_limited = 0
+        self.tokens = float(burst)
+        self.last_refill = time.monotonic()
+        self.random = random.Random(seed)
+        self.network_lock = threading.Lock()
+
+    def take_token(self):
+        "Seconds to wait before the call is allowed, 0 when it can go now"
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate_limit)
+        self.last_refill = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        wait = (1 - self.tokens) / self.rate_limit
+        if self.on_rate_limit == 'wait':
+            # Reserve the token so concurrent callers queue up behind this one
+            self.tokens -= 1
+        return wait
+
+    def call(self, method):
+        with self.network_lock:
+            self.calls += 1
+            self.calls_by_method[method] = self.calls_by_method.get(method, 0) + 1
+            wait = self.take_token() if self.rate_limit else 0
+            if wait > 0:
+                self.rate_limited += 1
+            delay = self.latency * self.random.uniform(1 - self.jitter, 1 + self.jitter) if self.latency else 0
+        if wait > 0:
+            if self.on_rate_limit == 'raise':
+                raise SpotifyException(429, -1, method + ': API rate limit exceeded',
+                                       headers={'Retry-After': str(int(math.ceil(wait)))})
+            time.sleep(wait)
+        if delay > 0:
+            time.sleep(delay)
+
+def network_settings():
+    "SimulatedNetwork arguments from the SPR_SPOTIFY_LATENCY, _JITTER, _RATE_LIMIT, _BURST and _ON_RATE_LIMIT variables"
+    settings = {'latency': float(os.environ.get('SPR_SPOTIFY_LATENCY', 0)),
+                'jitter': float(os.environ.get('SPR_SPOTIFY_JITTER', 0)),
+                'burst': int(os.environ.get('SPR_SPOTIFY_BURST', 10)),
+                'on_rate_limit': os.environ.get('SPR_SPOTIFY_ON_RATE_LIMIT', 'wait')}
+    if os.environ.get('SPR_SPOTIFY_RATE_LIMIT'):
+        settings['rate_limit'] = float(os.environ['SPR_SPOTIFY_RATE_LIMIT'])
+    return settings
+
+def page(items, offset, limit, base):
+    "One page of a paginated response, next is base with the offset of the following page"
+    next_url = None
+    if offset + limit < len(items):
+        next_url = '{}?offset={}&limit={}'.format(base, offset + limit, limit)
+    return {'href': '{}?offset={}&limit={}'.format(base, offset, limit), 'items': items[offset:offset + limit],
+            'limit': limit, 'offset': offset, 'total': len(items), 'next': next_url}
+
+class StubSpotify(SimulatedNetwork):
+    """
+    Stand-in for spotipy.Spotify with the calls SpotifyRecommendations makes, answered locally so the service
+    can be load tested without credentials or rate limits. Audio features come from the SPR_ML_Model tables when the
+    track is in the database, otherwise they are generated from a hash of the uri so they are the same on every call.
+    Playlists, saved tracks, search results and artist genres are generated from a hash of the id the same way,
+    and paginated like the API.
+    Attributes:
+        - ml_model (SPR_ML_Model): loaded model whose lookup tables answer audio_features, optional
+        - playlist_tracks (tuple): smallest and largest number of tracks of a playlist
+        - page_size (int): items per page of a playlist
+        - latency and the other SimulatedNetwork attributes
+    """
+    def __init__(self, ml_model=None, latency=0.0, playlist_tracks=(20, 100), page_size=100, **network):
+        super().__init__(latency=latency, **network)
+        self.ml_model = ml_model
+        self.playlist_tracks = playlist_tracks
+        self.page_size = page_size
+
+    def track_features(self, uri):
+        if self.ml_model is not None:
+            row = self.ml_model.get_track_rows([uri])[0]
+            if row >= 0:
+                track_id = self.ml_model.tracks_df['track_id'].iat[row]
+                if self.ml_model.has_features[track_id]:
+                    return dict(zip(feature_ranges, self.ml_model.track_features[track_id].tolist()))
+        rng = np.random.RandomState(zlib.crc32(uri.encode()))
+        feats = {}
+        for col, (low, high) in feature_ranges.items():
+            feats[col] = int(rng.randint(low, high + 1)) if col in integer_features else float(rng.uniform(low, high))
+        return feats
+
+    def playlist_items(self, key, unknown_fraction=0.1):
+        "Tracks of a playlist (or the saved tracks) picked from the database, with unknown_fraction of new tracks"
+        rng = np.random.RandomState(zlib.crc32(key.encode()))
+        n_tracks = rng.randint(self.playlist_tracks[0], self.playlist_tracks[1] + 1)
+        n_unknown = n_tracks
+        if self.ml_model is not None:
+            n_unknown = int(round(n_tracks * unknown_fraction))
+        uris = random_uris(rng, n_unknown)
+        artists = random_uris(rng, n_unknown)
+        if self.ml_model is not None:
+            rows = rng.choice(len(self.ml_model.track_uris), min(n_tracks - n_unknown, len(self.ml_model.track_uris)), replace=False)
+            uris += self.ml_model.get_track_uris(rows).tolist()
+            artists += self.ml_model.artist_uris[rows].astype(str).tolist()
+        added_at = pd.Timestamp('2021-06-30', tz='UTC') - pd.to_timedelta(rng.randint(0, 365 * 24 * 3600, size=len(uris)), unit='s')
+        return [{'added_at': date.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                 'track': {'id': uri, 'name': uri, 'artists': [{'id': artist, 'name': artist}]}}
+                for date, uri, artist in zip(added_at, uris, artists)]
+
+    def search_items(self, q, search_type):
+        rng = np.random.RandomState(zlib.crc32((search_type + ':' + q).encode()))
+        ids = random_uris(rng, rng.randint(0, 200))
+        return [{'id': item_id, 'name': '{} {}'.format(q, i), 'type': search_type, 'uri': 'spotify:{}:{}'.format(search_type, item_id)}
+                for i, item_id in enumerate(ids)]
+
+    def collection(self, base):
+        "Items behind the next url of a page"
+        kind, _, key = base[len('stub:'):].partition(':')
+        if kind == 'playlist':
+            return self.playlist_items(key)
+        if kind == 'saved_tracks':
+            return self.playlist_items('saved_tracks')
+        search_type, _, q = key.partition(':')
+        return self.search_items(q, search_type)
+
+    def playlist(self, playlist_id, fields=None, market=None, additional_types=('track',)):
+        self.call('playlist')
+        playlist_id = track_id(playlist_id)
+        items = self.playlist_items(playlist_id)
+        return {'id': playlist_id, 'name': playlist_id,
+                'tracks': page(items, 0, self.page_size, 'stub:playlist:' + playlist_id)}
+
+    def current_user_saved_tracks(self, limit=20, offset=0, market=None):
+        self.call('current_user_saved_tracks')
+        return page(self.playlist_items('saved_tracks'), offset, limit, 'stub:saved_tracks:')
+
+    def search(self, q, limit=10, offset=0, type='track', market=None):
+        self.call('search')
+        items = self.search_items(q, type)
+        return {type + 's': page(items, offset, limit, 'stub:search:{}:{}'.format(type, q))}
+
+    def next(self, result):
+        if not result['next']:
+            return None
+        self.call('next')
+        base, _, query = result['next'].partition('?')
+        params = parse_qs(query)
+        items = self.collection(base)
+        next_page = page(items, int(params['offset'][0]), int(params['limit'][0]), base)
+        if base.startswith('stub:search:'):
+            return {base.split(':')[2] + 's': next_page}
+        return next_page
+
+    def audio_features(self, tracks=[]):
+        self.call('audio_features')
+        return [dict(self.track_features(track_id(uri)), id=track_id(uri), uri='spotify:track:' + track_id(uri)) for uri in tracks]
+
+    def artist_genres(self, artist):
+        rng = np.random.RandomState(zlib.crc32(artist.encode()))
+        return [stub_genres[i] for i in rng.choice(len(stub_genres), rng.randint(1, 4), replace=False)]
+
+    def artist(self, artist_id):
+        self.call('artist')
+        return {'id': artist_id, 'name': artist_id, 'genres': self.artist_genres(artist_id)}
+
+    def artists(self, artists):
+        self.call('artists')
+        return {'artists': [{'id': artist, 'name': artist, 'genres': self.artist_genres(artist)} for artist in artists]}
+
+    def track(self, track_uri, market=None):
+        self.call('track')
+        uri = track_id(track_uri)
+        return {'id': uri, 'name': uri, 'artists': [{'id': uri, 'name': uri}]}
+
+    def current_user(self):
+        self.call('current_user')
+        return {'id': 'stub_user', 'display_name': 'Stub User', 'followers': {'total': 1}}
+
+    me = current_user
+
+    def current_user_top_artists(self, limit=20, offset=0, time_range='medium_term'):
+        self.call('current_user_top_artists')
+        artists = [item['track']['artists'][0]['id'] for item in self.playlist_items('saved_tracks')[:limit]]
+        return {'items': [{'id': artist, 'name': artist, 'genres': self.artist_genres(artist)} for artist in artists]}
+
+    def current_user_top_tracks(self, limit=20, offset=0, time_range='medium_term'):
+        self.call('current_user_top_tracks')
+        return {'items': [item['track'] for item in self.playlist_items('saved_tracks')[:limit]]}
+
+# Fixtures files loaded in this process by path, every recording and replaying client of a path shares one dict
+fixture_stores = {}
+fixture_store_lock = threading.Lock()
+registered_saves = set()
+
+def empty_fixtures():
+    return {'audio_features': {}, 'playlists': {}, 'artists': {}, 'calls': {}, 'http': {}}
+
+def load_fixtures(fixtures_path=default_fixtures_file):
+    """
+    Recorded responses: audio features by track id, artists by id, first page of playlists by id,
+    the other calls (pages, search, user data) by call_key and the SpotifyAPI GET responses by url.
+    :return: dict shared by all the clients of the process that use fixtures_path
+    """
+    with fixture_store_lock:
+        if fixtures_path not in fixture_stores:
+            fixtures = empty_fixtures()
+            if os.path.exists(fixtures_path):
+                with open(fixtures_path) as ff:
+                    fixtures.update(json.load(ff))
+            fixture_stores[fixtures_path] = fixtures
+        return fixture_stores[fixtures_path]
+
+def save_fixtures(fixtures_path=default_fixtures_file, fixtures=None):
+    fixtures = fixtures if fixtures is not None else load_fixtures(fixtures_path)
+    os.makedirs(os.path.dirname(fixtures_path) or '.', exist_ok=True)
+    tmp_path = fixtures_path + '.tmp'
+    with fixture_store_lock:
+        with open(tmp_path, 'w') as ff:
+            json.dump(fixtures, ff)
+    os.replace(tmp_path, fixtures_path)
+
+class FixtureMissing(KeyError):
+    "The replayed call was not recorded"
+
+class RecordingSpotify():
+    """
+    Wraps a spotipy.Spotify (or any client with the same calls) and records every response in the fixtures
+    of fixtures_path, which ReplaySpotify answers from. The fixtures are saved by save() and when the process exits.
+    Pass fixtures instead of fixtures_path to record into a dict that is not saved.
+    """
+    def __init__(self, sp, fixtures_path=default_fixtures_file, fixtures=None):
+        self.sp = sp
+        self.fixtures_path = fixtures_path
+        if fixtures is None:
+            fixtures = load_fixtures(fixtures_path)
+            with fixture_store_lock:
+                if fixtures_path not in registered_saves:
+                    registered_saves.add(fixtures_path)
+                    atexit.register(save_fixtures, fixtures_path)
+        self.fixtures = fixtures
+
+    def save(self):
+        save_fixtures(self.fixtures_path, self.fixtures)
+
+    def store(self, kind, items):
+        """
+        Add copies of responses to the fixtures under fixture_store_lock, which save_fixtures holds while it writes
+        them. Callers extend the items of paginated responses, like the copies ReplaySpotify hands out, so the
+        responses returned to them are not the recorded ones.
+        :param kind: 'audio_features', 'playlists', 'artists', 'calls' or 'http'
+        :param items: list of (key, response)
+        """
+        items = copy.deepcopy(items)
+        with fixture_store_lock:
+            self.fixtures[kind].update(items)
+
+    def record(self, method, **params):
+        result = getattr(self.sp, method)(**params)
+        self.store('calls', [(call_key(method, params), result)])
+        return result
+
+    def playlist(self, playlist_id, fields=None, market=None, additional_types=('track',)):
+        result = self.sp.playlist(playlist_id, fields=fields, market=market, additional_types=additional_types)
+        self.store('playlists', [(track_id(playlist_id), result)])
+        return result
+
+    def next(self, result):
+        if not result['next']:
+            return None
+        next_result = self.sp.next(result)
+        self.store('calls', [(call_key('next', {'url': result['next']}), next_result)])
+        return next_result
+
+    def audio_features(self, tracks=[]):
+        result = self.sp.audio_features(tracks)
+        self.store('audio_features', [(track_id(uri), feats) for uri, feats in zip(tracks, result) if feats])
+        return result
+
+    def artists(self, artists):
+        result = self.sp.artists(artists)
+        self.store('artists', [(artist['id'], artist) for artist in result['artists'] if artist])
+        return result
+
+    def artist(self, artist_id):
+        result = self.sp.artist(artist_id)
+        self.store('artists', [(result['id'], result)])
+        return result
+
+    def current_user_saved_tracks(self, limit=20, offset=0, market=None):
+        return self.record('current_user_saved_tracks', limit=limit, offset=offset, market=market)
+
+    def search(self, q, limit=10, offset=0, type='track', market=None):
+        return self.record('search', q=q, limit=limit, offset=offset, type=type, market=market)
+
+    def track(self, track_uri, market=None):
+        return self.record('track', track_id=track_id(track_uri), market=market)
+
+    def current_user(self):
+        return self.record('current_user')
+
+    me = current_user
+
+    def current_user_top_artists(self, limit=20, offset=0, time_range='medium_term'):
+        return self.record('current_user_top_artists', limit=limit, offset=offset, time_range=time_range)
+
+    def current_user_top_tracks(self, limit=20, offset=0, time_range='medium_term'):
+        return self.record('current_user_top_tracks', limit=limit, offset=offset, time_range=time_range)
+
+class ReplaySpotify(SimulatedNetwork):
+    """
+    Spotify client that answers from recorded fixtures only, so benchmarks replay exactly the same data on every run
+    and every version of the code. Audio features are looked up by track and artists by id, so the replay does not
+    depend on how the calls were batched when recording. Tracks that were not recorded get None from audio_features
+    like unknown tracks on Spotify, and so do artists. Any other call that was not recorded raises FixtureMissing.
+    """
+    def __init__(self, fixtures, **network):
+        super().__init__(**network)
+        self.fixtures = fixtures
+        self.audio_features_by_uri = fixtures['audio_features']
+        self.playlists = fixtures['playlists']
+        self.artists_by_id = fixtures['artists']
+        self.recorded_calls = fixtures.setdefault('calls', {})
+
+    @classmethod
+    def from_file(cls, fixtures_path, **network):
+        return cls(load_fixtures(fixtures_path), **network)
+
+    def replay(self, method, **params):
+        self.call(method)
+        key = call_key(method, params)
+        if key not in self.recorded_calls:
+            raise FixtureMissing(key)
+        # Callers extend the items of paginated responses, do not hand out the recorded ones
+        return copy.deepcopy(self.recorded_calls[key])
+
+    def playlist(self, playlist_id, fields=None, market=None, additional_types=('track',)):
+        self.call('playlist')
+        playlist_id = track_id(playlist_id)
+        if playlist_id not in self.playlists:
+            raise FixtureMissing('playlist ' + playlist_id)
+        return copy.deepcopy(self.playlists[playlist_id])
+
+    def next(self, result):
+        if not result['next']:
+            return None
+        return self.replay('next', url=result['next'])
+
+    def audio_features(self, tracks=[]):
+        self.call('audio_features')
+        return [self.audio_features_by_uri.get(track_id(uri)) for uri in tracks]
+
+    def artists(self, artists):
+        self.call('artists')
+        return {'artists': [self.artists_by_id.get(artist) for artist in artists]}
+
+    def artist(self, artist_id):
+        self.call('artist')
+        if artist_id not in self.artists_by_id:
+            raise FixtureMissing('artist ' + artist_id)
+        return self.artists_by_id[artist_id]
+
+    def current_user_saved_tracks(self, limit=20, offset=0, market=None):
+        return self.replay('current_user_saved_tracks', limit=limit, offset=offset, market=market)
+
+    def search(self, q, limit=10, offset=0, type='track', market=None):
+        return self.replay('search', q=q, limit=limit, offset=offset, type=type, market=market)
+
+    def track(self, track_uri, market=None):
+        return self.replay('track', track_id=track_id(track_uri), market=market)
+
+    def current_user(self):
+        return self.replay('current_user')
+
+    me = current_user
+
+    def current_user_top_artists(self, limit=20, offset=0, time_range='medium_term'):
+        return self.replay('current_user_top_artists', limit=limit, offset=offset, time_range=time_range)
+
+    def current_user_top_tracks(self, limit=20, offset=0, time_range='medium_term'):
+        return self.replay('current_user_top_tracks', limit=limit, offset=offset, time_range=time_range)
+
+def record_fixtures(sp, playlist_ids=(), track_uris=(), artist_ids=()):
+    """
+    Record the responses ReplaySpotify needs for the given playlists (all pages), tracks and artists from any client,
+    live or stub, the way SpotifyRecommendations requests them
+    :return: dict of fixtures, json serializable
+    """
+    recorder = RecordingSpotify(sp, fixtures=empty_fixtures())
+    track_uris = list(track_uris)
+    artist_ids = list(artist_ids)
+    for playlist_id in playlist_ids:
+        results = recorder.playlist(playlist_id)['tracks']
+        items = list(results['items'])
+        while results['next']:
+            results = recorder.next(results)
+            items.extend(results['items'])
+        for item in items:
+            track_uris.append(item['track']['id'])
+            artist_ids.extend(artist['id'] for artist in item['track']['artists'])
+
+    track_uris = list(dict.fromkeys(track_uris))
+    for i in range(0, len(track_uris), 100):
+        recorder.audio_features(track_uris[i:i + 100])
+    artist_ids = list(dict.fromkeys(artist_ids))
+    for i in range(0, len(artist_ids), 50):
+        recorder.artists(artist_ids[i:i + 50])
+    return recorder.fixtures
+
+def make_client(sp=None, mode=None, fixtures_path=None):
+    """
+    Spotify client for the mode, spotify_mode (SPR_SPOTIFY_MODE) by default
+    :param sp: live client to use or record, a client credentials spotipy.Spotify by default
+    :param fixtures_path: fixtures file, SPR_SPOTIFY_FIXTURES or data/spotify_fixtures.json by default
+    :return: sp, RecordingSpotify or ReplaySpotify with the network_settings()
+    """
+    mode = mode or spotify_mode
+    fixtures_path = fixtures_path or os.environ.get('SPR_SPOTIFY_FIXTURES', default_fixtures_file)
+    if mode == 'replay':
+        return ReplaySpotify.from_file(fixtures_path, **network_settings())
+    if sp is None:
+        sp = spotipy.Spotify(client_credentials_manager=SpotifyClientCredentials())
+    if mode == 'record':
+        return RecordingSpotify(sp, fixtures_path)
+    if mode != 'live':
+        raise ValueError('Unknown Spotify client mode: ' + mode)
+    return sp
+
+class FixtureResponse():
+    "The part of requests.Response that SpotifyAPI uses"
+    def __init__(self, status_code, data):
+        self.status_code = status_code
+        self.data = data
+
+    def json(self):
+        return copy.deepcopy(self.data)
+
+class RecordingHTTP():
+    "requests-like object for SpotifyAPI that records the GET responses by url, token requests are not recorded"
+    def __init__(self, http=requests, fixtures_path=default_fixtures_file, fixtures=None):
+        self.http = http
+        self.recorder = RecordingSpotify(None, fixtures_path, fixtures)
+        self.fixtures = self.recorder.fixtures
+        self.fixtures.setdefault('http', {})
+
+    def post(self, url, **kwargs):
+        return self.http.post(url, **kwargs)
+
+    def get(self, url, **kwargs):
+        r = self.http.get(url, **kwargs)
+        self.recorder.store('http', [(url, {'status_code': r.status_code, 'json': r.json() if r.status_code in range(200, 299) else None})])
+        return r
+
+class ReplayHTTP(SimulatedNetwork):
+    "requests-like object for SpotifyAPI that answers the recorded GET responses and grants any token request"
+    def __init__(self, fixtures, **network):
+        super().__init__(**network)
+        self.responses = fixtures.setdefault('http', {})
+
+    def post(self, url, **kwargs):
+        self.call('token')
+        return FixtureResponse(200, {'access_token': 'replay', 'token_type': 'Bearer', 'expires_in': 3600})
+
+    def get(self, url, **kwargs):
+        self.call('get')
+        recorded = self.responses.get(url)
+        if recorded is None:
+            return FixtureResponse(404, {'error': {'status': 404, 'message': 'not recorded: ' + url}})
+        return FixtureResponse(recorded['status_code'], recorded['json'])
+
+class StubHTTP(SimulatedNetwork):
+    "requests-like object for SpotifyAPI that answers search urls with StubSpotify results"
+    def __init__(self, stub=None, **network):
+        super().__init__(**network)
+        self.stub = stub or StubSpotify()
+
+    def post(self, url, **kwargs):
+        self.call('token')
+        return FixtureResponse(200, {'access_token': 'stub', 'token_type': 'Bearer', 'expires_in': 3600})
+
+    def get(self, url, **kwargs):
+        self.call('get')
+        parsed = urlparse(url)
+        params = {key: values[0] for key, values in parse_qs(parsed.query).items()}
+        if not parsed.path.endswith('/search') or 'q' not in params:
+            return FixtureResponse(404, {'error': {'status': 404, 'message': 'no stub for ' + url}})
+        results = {}
+        for search_type in params.get('type', 'track').split(','):
+            results.update(self.stub.search(params['q'], limit=int(params.get('limit', 20)),
+                                            offset=int(params.get('offset', 0)), type=search_type))
+        return FixtureResponse(200, results)
+
+def make_session(retries=3, backoff=0.3, pool_size=16):
+    """
+    requests.Session that keeps up to pool_size connections per host alive and retries connection errors,
+    429 and 5xx responses retries times with exponential backoff, waiting for Retry-After when the API sends it.
+    The last response is returned when the retries run out, like a call without retries.
+    """
+    retry_settings = {'total': retries, 'backoff_factor': backoff, 'status_forcelist': (429, 500, 502, 503, 504),
+                      'respect_retry_after_header': True, 'raise_on_status': False}
+    try:
+        retry = Retry(allowed_methods=frozenset(['GET', 'POST']), **retry_settings)
+    except TypeError:
+        # urllib3 < 1.26
+        retry = Retry(method_whitelist=frozenset(['GET', 'POST']), **retry_settings)
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+http_session = None
+http_session_lock = threading.Lock()
+
+def shared_session():
+    "The make_session() shared by all the SpotifyAPI clients of the process, created on first use"
+    global http_session
+    with http_session_lock:
+        if http_session is None:
+            http_session = make_session()
+        return http_session
+
+def make_http(http=None, mode=None, fixtures_path=None):
+    "requests-like object for SpotifyAPI in the mode, like make_client, the shared pooled session when live"
+    mode = mode or spotify_mode
+    fixtures_path = fixtures_path or os.environ.get('SPR_SPOTIFY_FIXTURES', default_fixtures_file)
+    if mode == 'replay':
+        return ReplayHTTP(load_fixtures(fixtures_path), **network_settings())
+    http = http or shared_session()
+    if mode == 'record':
+        return RecordingHTTP(http, fixtures_path)
+    if mode != 'live':
+        raise ValueError('Unknown Spotify client mode: ' + mode)
+    return http
+
+class StubHandler(BaseHTTPRequestHandler):
+    "POST /api/token grants a token, GET /v1/search answers with the StubHTTP of the server"
+    # Keep-alive, so pooled sessions reuse their connections like with the API, without Nagle delaying the
+    # body written after the headers
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def send_json(self, r):
+        body = json.dumps(r.json()).encode()
+        self.send_response(r.status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.send_json(self.server.stub_http.post(self.path))
+
+    def do_GET(self):
+        self.send_json(self.server.stub_http.get(self.path))
+
+    def log_message(self, format, *args):
+        pass
+
+def start_stub_server(port=0, host='127.0.0.1', stub=None, **network):
+    """
+    Serve a StubHTTP on a local port from a daemon thread, so SpotifyAPI can be tested over real connections
+    with SpotifyAPI(..., api_url=server.api_url, token_url=server.token_url). Port 0 picks a free port.
+    :return: the server, server.stub_http has the call counts
+    """
+    server = ThreadingHTTPServer((host, port), StubHandler)
+    server.daemon_threads = True
+    server.stub_http = StubHTTP(stub, **network)
+    host, port = server.server_address[:2]
+    server.api_url = 'http://{}:{}/v1'.format(host, port)
+    server.token_url = 'http://{}:{}/api/token'.format(host, port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
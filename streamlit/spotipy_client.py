@@ -1,5 +1,7 @@
 import os
 import re
+import io
+import json
 import base64
 import datetime
 import platform
@@ -8,20 +10,30 @@ import requests
 import spotipy
 import time
 import random
+import threading
 import pickle
-import sqlite3
 from sqlite3 import Error
 import numpy as np
 import pandas as pd
 import plotly.express as px
 from urllib.parse import urlencode
 from urllib.request import urlopen
+from concurrent.futures import ThreadPoolExecutor
 from spotipy.oauth2 import SpotifyOAuth, SpotifyClientCredentials
-from scipy.spatial.distance import cdist
+from spotipy.exceptions import SpotifyException
+from scipy.sparse import load_npz, csr_matrix
 import seaborn as sns
 
 from wordcloud import WordCloud
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+
+from tracing import span, count, traced
+from spotify_clients import make_client, make_http, spotify_mode
+from distance_kernels import PlaylistDistances, build_cluster_distances
+from title_index import TitleIndex, title_index_path
+from db_access import PlaylistsDB, ConnectionPool, connect_wal
+from shared_arrays import SharedArrays, shared_arrays_dir
 
 cwd = os.getcwd()
 
@@ -35,6 +47,7 @@ cwd = os.getcwd()
 #print("STS", st.secrets["SPOTIPY_CLIENT_ID"])
 
 log_filename = os.path.join(cwd, 'data', 'read_spotify_mpd_log.txt')
+ingest_metrics_filename = os.path.join(cwd, 'data', 'read_spotify_mpd_metrics.csv')
 feedback_db_file = os.path.join(cwd, 'data', 'user_feedback.db')
 
 # Pickled models
@@ -44,6 +57,69 @@ scaler_path = os.path.join(cwd, 'models', 'StdScaler.sav')
 playlists_db_path = os.path.join(cwd, 'data', 'spotify_20K_playlists.db')
 train_data_scaled_path = os.path.join(cwd, 'data' , 'scaled_data.csv')
 openTSNE_path = os.path.join(cwd, 'data' , 'openTSNE_20000.csv')
+# Written by code/embed_tsne.py for all playlists, used with its transformer instead of openTSNE_path and tsne_path
+# when it matches the model
+openTSNE_full_path = os.path.join(cwd, 'data', 'openTSNE_MPD.npy')
+tsne_full_path = os.path.join(cwd, 'models', 'openTSNETransformer_MPD.sav')
+# Written by code/build_cooccurrence.py, used by rec_method='cooccurrence' when it exists
+cooccurrence_path = os.path.join(cwd, 'data', 'cooccurrence_topk.npz')
+# Summary statistics of the Million Playlist Dataset written by code/dataset_stats.py
+dataset_stats_path = os.path.join(cwd, 'data', 'stats.json')
+tsne_display_points = 20000
+
+feature_cols = ['danceability', 'energy', 'key', 'loudness', 'mode', 'speechiness', 'acousticness', 'instrumentalness',
+                'liveness', 'valence', 'tempo', 'duration_ms', 'time_signature']
+
+# Time windows of the user favorites by len_of_favs, all_time uses every track
+favorite_windows = {'last_month': pd.offsets.MonthEnd(1), '6_months': pd.offsets.MonthEnd(6)}
+
+def window_start(added_at, offset):
+    """
+    Position of the first time within offset of the last one in the sorted DatetimeIndex added_at, found by binary
+    search. Same as DataFrame.last(offset) of pandas 1.2.5: the window starts after added_at[-1] - offset, also
+    when the last time is on a month end, see benchmarks/check_favorite_windows.py
+    :return: int, the window is added_at[start:]
+    """
+    if len(added_at) == 0 or pd.isnull(added_at[-1]):
+        return 0
+    return int(added_at.searchsorted(added_at[-1] - offset, side='right'))
+
+def use_full_tsne(labels):
+    """
+    Whether the embedding of all playlists and its transformer written by code/embed_tsne.py are used, they must
+    both exist and the embedding must have a row per playlist of the model. The user is placed with the transformer
+    that fitted the displayed embedding, so they always switch together.
+    :param labels: cluster label of every playlist (model.labels_)
+    """
+    if not (os.path.exists(openTSNE_full_path) and os.path.exists(tsne_full_path)):
+        return False
+    return len(np.load(openTSNE_full_path, mmap_mode='r')) == len(labels)
+
+def load_tsne_transformer(full):
+    ":param full: use_full_tsne() of the model"
+    return pickle.load(open(tsne_full_path if full else tsne_path, 'rb'))
+
+def load_tsne_display_df(labels, max_points=tsne_display_points, full=None):
+    """
+    t-SNE coordinates of the playlists for the cluster figures with their cluster labels.
+    The full embedding is memory mapped and only a fixed random subset of max_points rows is read.
+    :param labels: cluster label of every playlist (model.labels_)
+    :param full: use_full_tsne(labels) when None, must match the transformer loaded with load_tsne_transformer
+    :return: DataFrame with X, Y and cluster columns
+    """
+    if full is None:
+        full = use_full_tsne(labels)
+    if full:
+        coords = np.load(openTSNE_full_path, mmap_mode='r')
+        rows = np.arange(len(coords))
+        if len(coords) > max_points:
+            rows = np.sort(np.random.RandomState(0).choice(len(coords), max_points, replace=False))
+        tsne_df = pd.DataFrame(np.asarray(coords[rows]), columns=['X', 'Y'])
+        tsne_df['cluster'] = pd.Categorical(np.asarray(labels)[rows])
+        return tsne_df
+    tsne_df = pd.read_csv(openTSNE_path)
+    tsne_df['cluster'] = pd.Categorical(labels)
+    return tsne_df
 
 def get_public_ip():
     try:
@@ -54,38 +130,131 @@ def get_public_ip():
         ip = ''
     return ip
 
+class IngestMetrics():
+    """
+    Per-slice ingestion metrics written by code/read_spotify_million_playlists.py.
+    The csv is only ever appended to, so each refresh parses just the bytes added since the previous one
+    and the table is kept indexed by slice_start for range queries.
+    The instance is shared by the sessions of the app, refreshes are serialized by a lock.
+    """
+    def __init__(self, metrics_file=ingest_metrics_filename):
+        self.metrics_file = metrics_file
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.offset = 0
+        self.columns = None
+        self.metrics_df = pd.DataFrame()
+
+    def refresh(self):
+        # Reading, parsing and moving the offset is one step, two sessions must not parse the same bytes
+        with self.lock:
+            if not os.path.exists(self.metrics_file):
+                return
+            size = os.path.getsize(self.metrics_file)
+            if size < self.offset:
+                # File was rewritten (e.g. backfilled from the log), start over
+                self.reset()
+            if size == self.offset:
+                return
+            with open(self.metrics_file, 'rb') as mf:
+                mf.seek(self.offset)
+                data = mf.read()
+            # Leave a partially written last row for the next refresh
+            data = data[:data.rfind(b'\n') + 1]
+            if len(data) == 0:
+                # Not even the header is complete yet
+                return
+            if self.columns is None:
+                header, data = data.split(b'\n', 1)
+                self.columns = header.decode().strip().split(',')
+                self.offset += len(header) + 1
+            if len(data) == 0:
+                return
+            new_df = pd.read_csv(io.BytesIO(data), names=self.columns, header=None, index_col='slice_start')
+            self.offset += len(data)
+            metrics_df = pd.concat([self.metrics_df, new_df])
+            # Replaced in one assignment, readers see the previous table or the new one
+            self.metrics_df = metrics_df[~metrics_df.index.duplicated(keep='last')].sort_index()
+
+    def get_slices(self, start=None, end=None):
+        """
+        Metrics of the slices whose first pid is in [start, end]
+        :param start: first pid of the first slice, None for the first slice
+        :param end: first pid of the last slice, None for the last slice
+        :return: DataFrame indexed by slice_start
+        """
+        self.refresh()
+        metrics_df = self.metrics_df
+        if len(metrics_df) == 0:
+            return metrics_df
+        return metrics_df.loc[start:end]
+
+ingest_metrics = IngestMetrics()
+
+dataset_stats_cache = {}
+
+def load_dataset_stats(path=dataset_stats_path):
+    """
+    Summary statistics of the dataset, counts and top lists of [value, count], read again only when the file changes
+    :return: dict, None if code/dataset_stats.py has not written the file
+    """
+    if not os.path.exists(path):
+        return None
+    mtime = os.path.getmtime(path)
+    if dataset_stats_cache.get('key') != (path, mtime):
+        with open(path) as sf:
+            dataset_stats_cache['stats'] = json.load(sf)
+        dataset_stats_cache['key'] = (path, mtime)
+    return dataset_stats_cache['stats']
+
 def get_num_tracks_fig(opt='total', rows=200):
-    with open(log_filename) as log_file:
-        playlist_files = []
-        new_tracks = []
-        req_tracks = []
-        for line in log_file:
-            line = line.strip()
-            if 'File: data/mpd.slice' in line:
-                playlist_files.append(line.split('.')[-2])
-            if 'Created new track_ids' in line:
-                new_tracks.append(int(line.split(':')[1].rstrip()))
-            if opt == 'total':
-                mode = 'overlay'
-                if 'Total tracks/ratings in this file' in line:
-                    req_tracks.append(int(line.split(':')[1].rstrip()))
-            else:
-                mode = 'stack'
-                if 'Tracks already exist' in line:
-                    req_tracks.append(int(line.split(':')[1].rstrip()))
-
-        req_tracks_df = pd.DataFrame(zip(playlist_files, req_tracks), columns=['files', 'num of tracks'])
-        req_tracks_df['tracks'] = opt
-        new_tracks_df = pd.DataFrame(zip(playlist_files, new_tracks), columns=['files', 'num of tracks'])
-        new_tracks_df['tracks'] = 'new'
-        tracks_df = pd.concat([req_tracks_df.iloc[:rows], new_tracks_df.iloc[:rows]])
-        
-        fig = px.bar(tracks_df,
-                    x='files',
-                    y='num of tracks',
-                    color='tracks',
-                    barmode=mode)
-        return fig
+    metrics_df = ingest_metrics.get_slices().iloc[:rows]
+    files = metrics_df.index.astype(str) + '-' + metrics_df['slice_end'].astype(str)
+    if opt == 'total':
+        mode = 'overlay'
+        req_tracks = metrics_df['num_ratings']
+    else:
+        mode = 'stack'
+        req_tracks = metrics_df['existing_tracks']
+
+    req_tracks_df = pd.DataFrame({'files': files, 'num of tracks': req_tracks.values})
+    req_tracks_df['tracks'] = opt
+    new_tracks_df = pd.DataFrame({'files': files, 'num of tracks': metrics_df['new_tracks'].values})
+    new_tracks_df['tracks'] = 'new'
+    tracks_df = pd.concat([req_tracks_df, new_tracks_df])
+
+    fig = px.bar(tracks_df,
+                x='files',
+                y='num of tracks',
+                color='tracks',
+                barmode=mode)
+    return fig
+
+def create_feedback_table(conn):
+    """ create a feedback table
+    :return: None
+    """
+    try:
+        sql_create_table_feedback = """ CREATE TABLE IF NOT EXISTS feedback (
+                                        hostname text NOT NULL,
+                                        user_ip text NOT NULL,
+                                        feedback text NOT NULL,
+                                        rec_type text NOT NULL,
+                                        rec_name text NOT NULL,
+                                        ml_model_options text,
+                                        username text
+                                        ); """
+        cur = conn.cursor()
+        cur.execute(sql_create_table_feedback)
+    except Error as e:
+        print(e)
+        print('Failed to create feedback table')
+
+# Connection of each thread to the feedback database, opened (and the table created) once and reused by every
+# User_FeedbackDB of the thread
+feedback_pool = ConnectionPool(feedback_db_file, connect_wal, setup=create_feedback_table)
 
 class User_FeedbackDB():
     db_file = None
@@ -95,36 +264,18 @@ class User_FeedbackDB():
         super().__init__(*args, **kwargs)
         self.db_file = feedback_db_file
         self.create_connection()
-        self.create_table()
 
     def create_connection(self):
-        """ create a database connection to the SQLite database specified by db_file
+        """ get the connection of this thread to the SQLite database specified by db_file
         :return: None
         """
         try:
-            self.conn = sqlite3.connect(self.db_file)
+            self.conn = feedback_pool.connection()
         except Error as e:
             print(e)
 
     def create_table(self):
-        """ create a feedback table
-        :return: None
-        """
-        try:
-            sql_create_table_feedback = """ CREATE TABLE IF NOT EXISTS feedback (
-                                            hostname text NOT NULL,
-                                            user_ip text NOT NULL,
-                                            feedback text NOT NULL,
-                                            rec_type text NOT NULL,
-                                            rec_name text NOT NULL,
-                                            ml_model_options text,
-                                            username text
-                                            ); """
-            cur = self.conn.cursor()
-            cur.execute(sql_create_table_feedback)
-        except Error as e:
-            print(e)
-            print('Failed to create feedback table')
+        create_feedback_table(self.conn)
 
     def check_feedback_exists(self, feedback):
         """
@@ -182,32 +333,265 @@ class User_FeedbackDB():
         feedback_df.to_sql(name='feedback', con=self.conn, if_exists='replace', index=False)
 
 class SPR_ML_Model():
-    def __init__(self):
+    # Arrays of the model attached from shared_dir, with the arrays of cluster_distances, title_index and cooccurrence
+    shared_arrays = ['train_scaled_data', 'track_uris', 'artist_uris', 'album_uris', 'track_uri_order', 'sorted_track_uris',
+                     'track_id_rows', 'track_features', 'has_features', 'playlist_track_ids', 'playlist_pids', 'playlist_offsets']
+
+    def __init__(self, shard_dir=None, shared_dir=shared_arrays_dir):
         """
         Inits class with hard coded values for the Spotify instance and gets the paths for all the models and data
+        :param shard_dir: directory written by code/build_cluster_shards.py, only the playlists of its cluster and
+                          the tracks they use are loaded instead of the whole database. Shards serve recommendations
+                          only, the t-SNE transformer and figures data are not loaded.
+        :param shared_dir: directory of the numeric arrays shared by the processes serving this model (SPR_SHARED_ARRAYS),
+                           built by the first process and memory mapped by all of them, see shared_arrays.py.
+                           Each process builds its own arrays when None.
         """
         # Model loading
         self.model = pickle.load(open(model_path, 'rb'))
-        self.tsne_transformer = pickle.load(open(tsne_path, 'rb'))
         self.scaler = pickle.load(open(scaler_path, 'rb'))
+        self.shard_cluster = None
+        if shard_dir is None:
+            full_tsne = use_full_tsne(self.model.labels_)
+            self.tsne_transformer = load_tsne_transformer(full_tsne)
+            db_path = playlists_db_path
+            labels = self.model.labels_
+            pids = None
+            sources = [model_path, db_path, train_data_scaled_path, cooccurrence_path, title_index_path]
+            load_scaled_data = lambda: np.loadtxt(train_data_scaled_path, delimiter=',')
+        else:
+            self.tsne_transformer = None
+            db_path = os.path.join(shard_dir, 'playlists.db')
+            shard = np.load(os.path.join(shard_dir, 'shard.npz'))
+            self.shard_cluster = int(shard['cluster'])
+            pids = shard['pids']
+            labels = np.full(len(pids), self.shard_cluster)
+            sources = [model_path, db_path, os.path.join(shard_dir, 'shard.npz'), title_index_path]
+            load_scaled_data = lambda: shard['scaled_data']
+            if shared_dir is not None:
+                shared_dir = os.path.join(shared_dir, 'shard_{}'.format(self.shard_cluster))
 
         # Data loading
-        self.playlists_db = playlists_db_path
-        conn = sqlite3.connect(playlists_db_path)
-        self.tracks_df = pd.read_sql('select * from tracks', conn)
-        self.playlists_df = pd.read_sql('select * from playlists', conn)
-        self.playlists_df['cluster'] = pd.Categorical(self.model.labels_)
-        self.features_df = pd.read_sql('select * from features', conn)
-        self.ratings_df = pd.read_sql('select * from ratings', conn)
-        if conn:
-            conn.close()
-        
-        self.train_scaled_data = np.loadtxt(train_data_scaled_path, delimiter=',')
-        self.train_data_scaled_feats_df = pd.DataFrame(self.train_scaled_data)
-        self.train_data_scaled_feats_df['cluster'] = pd.Categorical(self.model.labels_)
-        self.openTSNE_df = pd.read_csv(openTSNE_path)
-        self.openTSNE_df['cluster'] = pd.Categorical(self.model.labels_)
-        
+        self.playlists_db = db_path
+        # Read-only prepared queries, features and ratings are only read to build the lookup tables
+        self.db = PlaylistsDB(db_path)
+        self.tracks_df = self.db.read_table('tracks')
+        self.playlists_df = self.db.read_table('playlists')
+        self.playlists_df['cluster'] = pd.Categorical(labels)
+
+        def build_arrays():
+            self.build_arrays(load_scaled_data(), labels, pids, with_cooccurrence=shard_dir is None)
+            return self.get_arrays()
+        if shared_dir is None:
+            build_arrays()
+        else:
+            self.set_arrays(SharedArrays(shared_dir, sources).load_or_publish(build_arrays))
+
+        # Indexed by pid, which is the row number in the whole database
+        self.train_data_scaled_feats_df = pd.DataFrame(self.train_scaled_data, index=pids, copy=False)
+        self.train_data_scaled_feats_df['cluster'] = pd.Categorical(labels)
+        self.openTSNE_df = load_tsne_display_df(self.model.labels_, full=full_tsne) if shard_dir is None else None
+        self.memory_report_df = self.compact_tables()
+
+    def build_arrays(self, scaled_data, labels, pids, with_cooccurrence=True):
+        """
+        Numeric arrays of the model computed from the loaded tables, before they are compacted
+        :param scaled_data: scaled features of the playlists
+        """
+        self.train_scaled_data = scaled_data
+        # The 22 character base62 uris are kept in fixed-width bytes arrays aligned with the rows of tracks_df
+        self.track_uris = np.array(self.tracks_df['track_uri'].to_numpy(), dtype='S22')
+        self.artist_uris = np.array(self.tracks_df['artist_uri'].fillna('').to_numpy(), dtype='S22')
+        self.album_uris = np.array(self.tracks_df['album_uri'].fillna('').to_numpy(), dtype='S22')
+        self.build_lookup_tables()
+        # float32 features and norms of the playlists of each cluster for the distance search
+        self.cluster_distances = build_cluster_distances(scaled_data, labels, pids)
+        self.cooccurrence = self.load_cooccurrence() if with_cooccurrence else None
+        self.title_index = self.load_title_index()
+
+    def get_arrays(self):
+        "Every array set by build_arrays by name, the arrays of the objects prefixed by their attribute"
+        arrays = {name: getattr(self, name) for name in self.shared_arrays}
+        for cluster, distances in self.cluster_distances.items():
+            arrays.update({'distances_{}_{}'.format(cluster, name): getattr(distances, name) for name in distances.arrays})
+        arrays.update({'title_index_' + name: getattr(self.title_index, name) for name in TitleIndex.arrays})
+        if self.cooccurrence is not None:
+            arrays.update(cooccurrence_data=self.cooccurrence.data, cooccurrence_indices=self.cooccurrence.indices,
+                          cooccurrence_indptr=self.cooccurrence.indptr, cooccurrence_shape=np.array(self.cooccurrence.shape))
+        return arrays
+
+    def set_arrays(self, arrays):
+        "The attributes set by build_arrays over the arrays of get_arrays, without copying them"
+        for name in self.shared_arrays:
+            setattr(self, name, arrays[name])
+        clusters = sorted({int(name.split('_')[1]) for name in arrays if name.startswith('distances_')})
+        self.cluster_distances = {cluster: PlaylistDistances.from_arrays(**{name: arrays['distances_{}_{}'.format(cluster, name)]
+                                                                            for name in PlaylistDistances.arrays})
+                                  for cluster in clusters}
+        self.title_index = TitleIndex(*[arrays['title_index_' + name] for name in TitleIndex.arrays])
+        self.cooccurrence = None
+        if 'cooccurrence_data' in arrays:
+            self.cooccurrence = csr_matrix((arrays['cooccurrence_data'], arrays['cooccurrence_indices'], arrays['cooccurrence_indptr']),
+                                           shape=tuple(arrays['cooccurrence_shape']))
+
+    def compact_tables(self):
+        """
+        Convert the tables kept in memory to compact dtypes: repeated strings to categoricals, ids and counts to int32.
+        The uris are dropped from tracks_df, they are in the track_uris, artist_uris and album_uris arrays.
+        :return: DataFrame with the memory footprint of each table before and after in MB
+        """
+        tables = {'tracks': self.tracks_df, 'playlists': self.playlists_df}
+        before = {name: df.memory_usage(deep=True).sum() for name, df in tables.items()}
+
+        self.tracks_df = self.tracks_df.drop(columns=['track_uri', 'artist_uri', 'album_uri'])
+        self.tracks_df = self.tracks_df.astype({'artist_name': 'category', 'track_name': 'category', 'album_name': 'category', 'track_id': np.int32})
+
+        int_cols = ['pid', 'modified_at', 'num_tracks', 'num_albums', 'num_followers', 'num_edits', 'duration_ms', 'num_artists']
+        self.playlists_df = self.playlists_df.astype({col: 'category' for col in ['name', 'nname', 'collaborative'] if col in self.playlists_df})
+        self.playlists_df = self.playlists_df.astype({col: np.int32 for col in int_cols if col in self.playlists_df})
+
+        tables = {'tracks': self.tracks_df, 'playlists': self.playlists_df}
+        after = {name: df.memory_usage(deep=True).sum() for name, df in tables.items()}
+        after['tracks'] += self.track_uris.nbytes + self.artist_uris.nbytes + self.album_uris.nbytes
+        report_df = pd.DataFrame({'before_mb': pd.Series(before), 'after_mb': pd.Series(after)}) / 2**20
+        report_df.loc['total'] = report_df.sum()
+        report_df['ratio'] = report_df['before_mb'] / report_df['after_mb']
+        return report_df.round(2)
+
+    def build_lookup_tables(self):
+        """
+        Indexes built once at load time so a request only gathers the rows of its own tracks and playlists:
+            - sorted_track_uris/track_uri_order: track_uris sorted for binary search, and the tracks_df row of each
+            - track_id_rows: row in tracks_df addressed by track_id, -1 if there is no such track
+            - track_features: dense features array addressed by track_id, has_features masks the ids without features
+            - playlist_track_ids: track_ids of all playlists in (pid, pos) order, playlist_offsets[i]:playlist_offsets[i+1]
+              are the tracks of playlist_pids[i]
+        The features and ratings are read for these arrays and not kept, self.db queries them on demand.
+        """
+        self.track_uri_order = np.argsort(self.track_uris, kind='stable')
+        self.sorted_track_uris = self.track_uris[self.track_uri_order]
+        track_ids = self.tracks_df['track_id'].to_numpy()
+        features_df = self.db.read_table('features')
+        max_track_id = int(max(track_ids.max(), features_df['track_id'].max()))
+        self.track_id_rows = np.full(max_track_id + 1, -1, dtype=np.int32)
+        self.track_id_rows[track_ids] = np.arange(len(track_ids))
+
+        self.track_features = np.full((max_track_id + 1, len(feature_cols)), np.nan, dtype=np.float32)
+        self.has_features = np.zeros(max_track_id + 1, dtype=bool)
+        feature_ids = features_df['track_id'].to_numpy()
+        self.track_features[feature_ids] = features_df[feature_cols].to_numpy()
+        self.has_features[feature_ids] = True
+        del features_df
+
+        # From the ratings table or from the packed layout of code/pack_ratings.py
+        self.playlist_pids, self.playlist_offsets, self.playlist_track_ids = self.db.read_ratings()
+
+    def get_track_rows(self, track_uris):
+        """
+        Binary search of the uris in the sorted fixed-width uri array
+        :param track_uris: list of track uris
+        :return: np.array of rows in tracks_df, -1 for uris that are not in the database
+        """
+        uris = np.asarray(track_uris, dtype=str)
+        if len(uris) == 0:
+            return np.array([], dtype=np.int64)
+        valid = np.char.str_len(uris) <= self.sorted_track_uris.itemsize
+        uris = uris.astype(self.sorted_track_uris.dtype)
+        pos = np.minimum(np.searchsorted(self.sorted_track_uris, uris), len(self.sorted_track_uris) - 1)
+        found = valid & (self.sorted_track_uris[pos] == uris)
+        return np.where(found, self.track_uri_order[pos], -1)
+
+    def get_track_uris(self, rows):
+        """
+        :param rows: rows in tracks_df
+        :return: np.array of track uris as str
+        """
+        return self.track_uris[rows].astype(str)
+
+    def load_cooccurrence(self):
+        """
+        Top-k track to track co-occurrence matrix addressed by track_id
+        :return: csr_matrix, None when it was not built or was built for another database
+        """
+        if not os.path.exists(cooccurrence_path):
+            return None
+        cooccurrence = load_npz(cooccurrence_path).tocsr()
+        if cooccurrence.shape[0] <= self.tracks_df['track_id'].max():
+            print('Ignoring', cooccurrence_path, 'built for another database')
+            return None
+        return cooccurrence
+
+    def load_title_index(self):
+        """
+        Index of the playlist titles for mood search, from title_index_path when it was built for these playlists
+        by streamlit/title_index.py, built here otherwise
+        :return: TitleIndex
+        """
+        pids = self.playlists_df['pid'].to_numpy()
+        if os.path.exists(title_index_path):
+            title_index = TitleIndex.load(title_index_path)
+            if np.array_equal(title_index.pids, pids):
+                return title_index
+        return TitleIndex.from_titles(pids, self.playlists_df['name'])
+
+    def get_cooccurring_tracks(self, track_ids):
+        """
+        Neighbours of the seed tracks in the co-occurrence matrix, each scored by the sum of its scores with the seeds.
+        Only the rows of the seeds are read, so the cost depends on the number of seeds and k.
+        :param track_ids: seed track_ids
+        :return: np.array of candidate track_ids without the seeds, by descending score, and np.array of their scores
+        """
+        track_ids = np.unique(np.asarray(track_ids, dtype=np.int64))
+        track_ids = track_ids[(track_ids >= 0) & (track_ids < self.cooccurrence.shape[0])]
+        starts = self.cooccurrence.indptr[track_ids]
+        lengths = self.cooccurrence.indptr[track_ids + 1] - starts
+        entries = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths - starts, lengths)
+        candidates, inverse = np.unique(self.cooccurrence.indices[entries], return_inverse=True)
+        scores = np.bincount(inverse, weights=self.cooccurrence.data[entries], minlength=len(candidates))
+        new = ~np.isin(candidates, track_ids)
+        candidates, scores = candidates[new], scores[new]
+        order = np.argsort(-scores, kind='stable')
+        return candidates[order], scores[order]
+
+    def get_playlist_track_ids(self, pids):
+        """
+        :param pids: list of playlist ids
+        :return: np.array of the track_ids of these playlists, in position order within each playlist
+        """
+        idx = np.searchsorted(self.playlist_pids, pids)
+        idx = idx[(idx < len(self.playlist_pids)) & (self.playlist_pids[np.minimum(idx, len(self.playlist_pids) - 1)] == pids)]
+        if len(idx) == 0:
+            return np.array([], dtype=self.playlist_track_ids.dtype)
+        return np.concatenate([self.playlist_track_ids[self.playlist_offsets[i]:self.playlist_offsets[i + 1]] for i in idx])
+
+class PipelineCache():
+    """
+    Results of the SpotifyRecommendations stages, each stored with the key of the inputs it was computed from.
+    A stage is recomputed only when its key changes, so changing an input recomputes the stages that depend on it
+    and reuses the ones that do not. Each stage has its own lock because the app builds figures in threads.
+    """
+    def __init__(self):
+        self.stages = {}
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    def get(self, stage, key, compute):
+        with self.lock:
+            stage_lock = self.locks.setdefault(stage, threading.RLock())
+        with stage_lock:
+            cached = self.stages.get(stage)
+            if cached is not None and cached[0] == key:
+                count('cache_hits')
+                return cached[1]
+            count('cache_misses')
+            value = compute()
+            self.stages[stage] = (key, value)
+            return value
+
+    def clear(self):
+        with self.lock:
+            self.stages = {}
+
 class SpotifyRecommendations():
     """
     This Class will provide music recommendations in a form of Playlists
@@ -233,22 +617,52 @@ class SpotifyRecommendations():
             - indices (np.array): indices of the top n playlists based on the train_data_scaled_feats_df dataframe
 
     """
-    def __init__(self, playlist_uri=None, sp_user=None):
+    def __init__(self, playlist_uri=None, sp_user=None, sp=None, track_uris=None, feature_vector=None, rec_method='clusters',
+                 mood=None):
         """
         Inits class with hard coded values for the Spotify instance and gets the paths for all the models and data
+        Parameters:
+            - sp: Spotify client to use instead of creating one, e.g. a shared client or spotify_clients.StubSpotify
+            - track_uris (list): recommend for these tracks instead of a playlist or the user favorites
+            - feature_vector (list): recommend for these raw audio features (in feature_cols order) instead of tracks
+            - mood (str): recommend for the tracks of the playlists whose titles best match these words, e.g. 'chill'
+            - rec_method (str): how songs are ranked, 'clusters' by distance to the user vector of the songs of the
+              nearest playlists in the user cluster, 'cooccurrence' by how often they appear in playlists with the
+              user tracks (falls back to 'clusters' without the co-occurrence matrix or user tracks in the database)
         """
-        self.feat_cols_user = ['danceability', 'energy', 'key', 'loudness', 'mode', 'speechiness', 'acousticness', 'instrumentalness',
-                               'liveness', 'valence', 'tempo', 'duration_ms', 'time_signature']
+        self.feat_cols_user = list(feature_cols)
 
         self.playlist_uri = playlist_uri
+        self.sp_user = sp_user
+        self.track_uris = tuple(track_uris) if track_uris is not None else None
+        self.feature_vector = tuple(feature_vector) if feature_vector is not None else None
+        self.mood = mood
+        # Playlists matching the mood whose tracks are the user tracks
+        self.mood_playlists = 10
         self.len_of_favs = 'all_time'
+        # Tuning of get_top_n_playlists and get_songs_recommendations, set by their arguments
+        self.top_n = 10
+        self.metric = 'cityblock'
+        self.similar = True
+        self.n_songs = 30
+        self.rec_method = rec_method
+        # Playlists never returned by get_top_n_playlists, e.g. the held-out playlist in an offline evaluation
+        self.excluded_pids = ()
+        self.ml_model = None
+        self.cache = PipelineCache()
+        # Audio features (or None when Spotify has none) by track uri, shared by the time windows of the favorites
+        self.feature_cache = {}
         self.log_output = None
         sequential =['Greys', 'Purples', 'Blues', 'Greens', 'Oranges', 'Reds','YlOrBr', 'YlOrRd', 'OrRd', 'PuRd', 
                     'RdPu', 'BuPu', 'GnBu', 'PuBu', 'YlGnBu', 'PuBuGn', 'BuGn', 'YlGn']
         self.color = random.choice(sequential)
         
-        if self.playlist_uri is not None:
-            self.sp = spotipy.Spotify(client_credentials_manager = SpotifyClientCredentials())
+        if sp is not None:
+            self.sp = sp
+        elif spotify_mode == 'replay':
+            self.sp = make_client()
+        elif self.playlist_uri is not None or self.mood is not None:
+            self.sp = make_client(spotipy.Spotify(client_credentials_manager = SpotifyClientCredentials()))
         else:
             # Hardcoded init variables
             # Defining scope to read user playlist and write playlist to user
@@ -258,7 +672,7 @@ class SpotifyRecommendations():
             try:            
                 token_info = self.sp_oauth.get_cached_token()
                 access_token = token_info['access_token']
-                self.sp = spotipy.Spotify(access_token)
+                self.sp = make_client(spotipy.Spotify(access_token))
                 #token = spotipy.util.prompt_for_user_token(sp_user, self.scope)
                 #self.sp = spotipy.Spotify(auth=token)
                 #self.sp_oauth = SpotifyOAuth(scope = self.scope, requests_session=True, requests_timeout=10, username=sp_user)
@@ -272,13 +686,48 @@ class SpotifyRecommendations():
         #print(self.sp_oauth.get_access_token(code))
         token_info = self.sp_oauth.get_access_token(code, check_cache=False)
         access_token = token_info['access_token']
-        self.sp = spotipy.Spotify(access_token)
+        self.sp = make_client(spotipy.Spotify(access_token))
 
     def get_html_for_login(self):
         auth_url = self.sp_oauth.get_authorize_url()
         return auth_url
 
+    # Inputs of each pipeline stage, including the inputs of the stages it uses
+    stage_inputs = {
+        'tracks': ('playlist_uri', 'sp_user', 'track_uris', 'mood'),
+        'songs_feats': ('playlist_uri', 'sp_user', 'track_uris', 'mood', 'len_of_favs'),
+        'raw_y': ('playlist_uri', 'sp_user', 'track_uris', 'mood', 'len_of_favs', 'feature_vector'),
+        'scaled_y': ('playlist_uri', 'sp_user', 'track_uris', 'mood', 'len_of_favs', 'feature_vector'),
+        'user_cluster': ('playlist_uri', 'sp_user', 'track_uris', 'mood', 'len_of_favs', 'feature_vector'),
+        'user_tsne': ('playlist_uri', 'sp_user', 'track_uris', 'mood', 'len_of_favs', 'feature_vector'),
+        'top_playlists': ('playlist_uri', 'sp_user', 'track_uris', 'mood', 'len_of_favs', 'feature_vector', 'top_n', 'metric', 'similar',
+                          'excluded_pids'),
+        'song_uris': ('playlist_uri', 'sp_user', 'track_uris', 'mood', 'len_of_favs', 'feature_vector', 'top_n', 'metric', 'similar',
+                      'excluded_pids', 'n_songs', 'rec_method'),
+    }
+
+    # Tracing span of each stage computation, cache hits are counted in the span that asked for the stage
+    stage_spans = {'tracks': 'spotify_fetch', 'songs_feats': 'track_features', 'raw_y': 'user_vector', 'scaled_y': 'scaling',
+                   'user_cluster': 'cluster_predict', 'user_tsne': 'tsne_transform', 'top_playlists': 'distance_search',
+                   'song_uris': 'song_ranking'}
+
+    def get_stage(self, stage, compute):
+        key = tuple(getattr(self, name) for name in self.stage_inputs[stage])
+        def traced_compute():
+            with span(self.stage_spans[stage]):
+                return compute()
+        return self.cache.get(stage, key, traced_compute)
+
     def set_ml_model(self, ml_model):
+        # Every stage after the tracks depends on the model and its data
+        if ml_model is not self.ml_model:
+            tracks = self.cache.stages.get('tracks')
+            self.cache.clear()
+            if tracks is not None:
+                self.cache.stages['tracks'] = tracks
+            self.feature_cache = {}
+        self.ml_model = ml_model
+
         # Model loading
         self.model = ml_model.model
         self.tsne_transformer = ml_model.tsne_transformer
@@ -287,33 +736,40 @@ class SpotifyRecommendations():
         # Data loading
         self.tracks_df = ml_model.tracks_df
         self.playlists_df = ml_model.playlists_df
-        self.features_df = ml_model.features_df
-        self.ratings_df = ml_model.ratings_df
         self.train_data_scaled_feats_df = ml_model.train_data_scaled_feats_df
         self.openTSNE_df = ml_model.openTSNE_df
 
     def get_audio_features_df(self, track_uris_list=None, playlist_pids_list=None):
+        with span('feature_lookup') as lookup_span:
+            return self.lookup_audio_features(lookup_span, track_uris_list, playlist_pids_list)
+
+    def lookup_audio_features(self, lookup_span, track_uris_list=None, playlist_pids_list=None):
         self.log_output('Getting Audio features for the tracks')
         # Get all track_uri for playlists
         if playlist_pids_list is not None:
             self.log_output('Getting audio features for tracks in Top Playlists in the Cluster\n' + ','.join([str(pid) for pid in playlist_pids_list]))
-            ratings_df = self.ratings_df[self.ratings_df['pid'].isin(playlist_pids_list)].copy()
-            tracks_df = self.tracks_df[self.tracks_df['track_id'].isin(ratings_df['track_id'].values)].copy()
-            track_uris_list = tracks_df['track_uri'].values
+            track_ids = pd.unique(self.ml_model.get_playlist_track_ids(np.asarray(playlist_pids_list)))
+            track_rows = self.ml_model.track_id_rows[track_ids]
+            track_uris_list = self.ml_model.get_track_uris(track_rows[track_rows >= 0])
             self.log_output('Tracks in this list: ' + str(len(track_uris_list)))
         
-        self.log_output('Unique tracks in this list: ' + str(len(set(track_uris_list))))
+        track_uris_list = pd.unique(np.asarray(track_uris_list, dtype=object))
+        self.log_output('Unique tracks in this list: ' + str(len(track_uris_list)))
+        lookup_span.count('tracks', len(track_uris_list))
         # Find audio features if track_uri is already in the database:
-        tracks_df = self.tracks_df[self.tracks_df['track_uri'].isin(set(track_uris_list))][['track_id', 'track_uri']].copy()
-        exist_audio_feats_df = self.features_df[self.features_df['track_id'].isin(tracks_df['track_id'].values)].copy()
-        exist_audio_feats_df = exist_audio_feats_df.merge(tracks_df, on='track_id')
-        exist_audio_feats_df.drop(columns='track_id', inplace=True)
-        exist_audio_feats_df.rename(columns={'track_uri':'uri'}, inplace=True)
-        if len(exist_audio_feats_df) == len(set(track_uris_list)):
+        track_rows = self.ml_model.get_track_rows(track_uris_list)
+        in_db = track_rows >= 0
+        lookup_span.count('db_tracks', int(in_db.sum()))
+        track_ids = self.tracks_df['track_id'].to_numpy()[track_rows[in_db]]
+        has_features = self.ml_model.has_features[track_ids]
+        # float64 like the features from Spotify, the scaler and model expect it
+        exist_audio_feats_df = pd.DataFrame(self.ml_model.track_features[track_ids[has_features]].astype(np.float64), columns=self.feat_cols_user)
+        exist_audio_feats_df['uri'] = track_uris_list[in_db][has_features]
+        if in_db.all():
             self.log_output('Got all audio features from database for tracks: ' + str(len(exist_audio_feats_df)))
             return exist_audio_feats_df
         
-        track_uris_list = list(set(track_uris_list) - set(tracks_df['track_uri'].tolist()))
+        track_uris_list = list(track_uris_list[~in_db])
 
         # Extract audio features from Spotify
         audio_feats = []
@@ -321,17 +777,23 @@ class SpotifyRecommendations():
         for chunk in  chunks_uris:
             for _ in range(5):
                 try:
+                    lookup_span.count('api_calls')
                     chunk_audio_feats = self.sp.audio_features(chunk)
                     audio_feats.append(chunk_audio_feats)
                 except Exception as e: 
                     print(e)
                     print('chunk: {}'.format(chunk))
+                    if isinstance(e, SpotifyException) and e.http_status == 429:
+                        time.sleep(int((e.headers or {}).get('Retry-After', 1)))
                 else:
                     break
             else:
                 print('Everything failed')
         
         audio_feats_df = pd.DataFrame([item for sublist in audio_feats for item in sublist if item])
+        if len(audio_feats_df) == 0:
+            self.log_output('No audio features from Spotify, got audio features from database for tracks: ' + str(len(exist_audio_feats_df)))
+            return exist_audio_feats_df
         track_uris_list = audio_feats_df['id'].tolist()
         audio_feats_df = audio_feats_df[self.feat_cols_user]
         audio_feats_df['uri'] = track_uris_list
@@ -339,25 +801,44 @@ class SpotifyRecommendations():
         self.log_output('Extracted audio features from Spotify: ' + str(len(audio_feats_df)))
         if len(exist_audio_feats_df) > 0:
             self.log_output('Got some audio features from database for tracks: ' + str(len(exist_audio_feats_df)))
-            audio_feats_df = pd.concat([exist_audio_feats_df, audio_feats_df])
+            audio_feats_df = pd.concat([exist_audio_feats_df, audio_feats_df], ignore_index=True)
         return audio_feats_df
 
     def get_tracks_from_playlist_or_user_favorites(self):
+        songs_df = self.get_stage('tracks', self.fetch_tracks)
+        self.artist_uri = songs_df['artist_uri'].tolist()
+        return songs_df
+
+    def fetch_tracks(self):
+        if self.track_uris is not None:
+            self.log_output('---\nGetting tracks from the list of track uris')
+            return self.get_tracks_from_uris(self.track_uris)
+        if self.mood is not None:
+            self.log_output('---\nGetting tracks of the playlists matching the mood: ' + self.mood)
+            pids, scores = self.ml_model.title_index.search(self.mood, self.mood_playlists)
+            self.log_output('Matching playlists: ' + str(len(pids)))
+            track_rows = self.ml_model.track_id_rows[self.ml_model.get_playlist_track_ids(pids)]
+            track_rows = track_rows[track_rows >= 0]
+            return self.get_tracks_from_uris(self.ml_model.get_track_uris(track_rows))
         if self.playlist_uri:
             self.log_output('---\nGetting all tracks for Playlist')
             # Get all tracks in the playlist
             results = self.sp.playlist(self.playlist_uri)['tracks']
+            count('api_calls')
             tracks = results['items']
             while results['next']:
                 results = self.sp.next(results)
+                count('api_calls')
                 tracks.extend(results['items'])
         else:
             self.log_output('Getting all tracks for User Favorites')
             "Get all favorite tracks from current user and return them in a dataframe"
             results = self.sp.current_user_saved_tracks()
+            count('api_calls')
             tracks = results['items']
             while results['next']:
                 results = self.sp.next(results)
+                count('api_calls')
                 tracks.extend(results['items'])
 
         songs_df = pd.json_normalize(tracks, record_path=['track', 'artists'], meta=[['added_at'], ['track', 'id'], ['track', 'name']])
@@ -366,44 +847,83 @@ class SpotifyRecommendations():
         songs_df = songs_df.sort_values(by='added_at', ascending=True).set_index('added_at')
         songs_df = songs_df[['name', 'id', 'track.id', 'track.name']]
         songs_df.rename(columns={'track.id':'uri', 'track.name': 'song', 'name': 'artist', 'id': 'artist_uri'}, inplace=True)
-        self.artist_uri = songs_df['artist_uri'].tolist()
         self.log_output('Found unique tracks: ' + str(len(songs_df)))
+        count('tracks', len(songs_df))
+        return songs_df
+
+    def get_tracks_from_uris(self, track_uris):
+        "Tracks given by uri in the same dataframe as fetch_tracks, with artist and song names from the database when known"
+        uris = pd.unique(np.asarray([uri.split(':')[-1] for uri in track_uris], dtype=object))
+        rows = self.ml_model.get_track_rows(uris)
+        known = rows >= 0
+        artists = np.full(len(uris), None, dtype=object)
+        artist_uris = np.full(len(uris), None, dtype=object)
+        songs = np.full(len(uris), None, dtype=object)
+        artists[known] = self.tracks_df['artist_name'].to_numpy()[rows[known]]
+        artist_uris[known] = self.ml_model.artist_uris[rows[known]].astype(str)
+        songs[known] = self.tracks_df['track_name'].to_numpy()[rows[known]]
+        songs_df = pd.DataFrame({'artist': artists, 'artist_uri': artist_uris, 'uri': uris, 'song': songs},
+                                index=pd.DatetimeIndex([pd.NaT] * len(uris), name='added_at'))
+        self.log_output('Found unique tracks: ' + str(len(songs_df)) + ', in database: ' + str(int(known.sum())))
         return songs_df
 
     def get_tracks_audio_features(self): 
         "Extract audio features from each track from the user's favorite tracks and return a dataframe"
+        self.songs_feats_df = self.get_stage('songs_feats', self.compute_tracks_audio_features)
+        return self.songs_feats_df
+
+    def get_tracks_window(self, len_of_favs=None):
+        """
+        Tracks added in the time window, a slice of the fetched tracks which are sorted by added_at
+        :param len_of_favs: 'last_month', '6_months' or 'all_time', self.len_of_favs when None
+        """
         songs_df = self.get_tracks_from_playlist_or_user_favorites()
-        if self.len_of_favs == 'last_month':
-            songs_df = songs_df.last('1M')
-        elif self.len_of_favs == '6_months':
-            songs_df = songs_df.last('6M')
-        else:
-            pass
+        offset = favorite_windows.get(len_of_favs or self.len_of_favs)
+        if offset is None:
+            return songs_df
+        return songs_df.iloc[window_start(songs_df.index, offset):]
 
-        track_uris = songs_df['uri'].tolist()
-        audio_feats_df = self.get_audio_features_df(track_uris_list=track_uris)
-        self.songs_feats_df = songs_df.merge(audio_feats_df, how='right', on="uri")
+    def get_cached_audio_features(self, track_uris):
+        """
+        Audio features of the tracks like get_audio_features_df, but only the uris never seen before are looked up
+        :return: dataframe with feat_cols_user and uri for the tracks that have features
+        """
+        track_uris = pd.unique(np.asarray(track_uris, dtype=object))
+        missing = [uri for uri in track_uris if uri not in self.feature_cache]
+        count('feature_cache_hits', len(track_uris) - len(missing))
+        if missing:
+            audio_feats_df = self.get_audio_features_df(track_uris_list=missing)
+            self.feature_cache.update(dict.fromkeys(missing))
+            self.feature_cache.update(zip(audio_feats_df['uri'], audio_feats_df[self.feat_cols_user].to_numpy(dtype=np.float64)))
+        uris = [uri for uri in track_uris if self.feature_cache[uri] is not None]
+        feats = np.vstack([self.feature_cache[uri] for uri in uris]) if uris else np.empty((0, len(self.feat_cols_user)))
+        audio_feats_df = pd.DataFrame(feats, columns=self.feat_cols_user)
+        audio_feats_df['uri'] = uris
+        return audio_feats_df
+
+    def compute_tracks_audio_features(self):
+        songs_df = self.get_tracks_window()
+        audio_feats_df = self.get_cached_audio_features(songs_df['uri'].tolist())
+        return songs_df.merge(audio_feats_df, how='right', on="uri")
 
     def get_raw_y(self):
         "Get user 'y' vector without scaling"
-        try:
-            self.songs_feats_df
-        except:
-            self.get_tracks_audio_features()
-
-        self.raw_y = self.songs_feats_df[self.feat_cols_user].mean()
+        if self.feature_vector is not None:
+            self.raw_y = self.get_stage('raw_y', lambda: pd.Series(self.feature_vector, index=self.feat_cols_user, dtype=float))
+        else:
+            self.raw_y = self.get_stage('raw_y', lambda: self.get_tracks_audio_features()[self.feat_cols_user].mean())
         return self.raw_y
 
     def get_scaled_y_vector(self):
         "Get user 'y' vector after scaling in a numpy array with shape of (1,n)"
-        try:
-            self.raw_y # Checks if it exist else runs the function to get the variable
-        except:
-            self.get_raw_y()
-            
-        self.scaled_y = self.scaler.transform(np.array(self.raw_y).reshape(1,-1))
+        self.scaled_y = self.get_stage('scaled_y', lambda: self.scaler.transform(np.array(self.get_raw_y()).reshape(1,-1)))
         return self.scaled_y
 
+    def get_user_cluster(self):
+        "Predict the cluster of the user 'y' vector"
+        self.user_cluster = self.get_stage('user_cluster', lambda: self.model.predict(self.get_scaled_y_vector()))
+        return self.user_cluster
+
     def get_top_n_playlists(self, n=10, metric='cityblock', similar=True, printing=False):
         """
         This function will compute the most similar or disimilar playlists given a target vector 'y' which represents the mean
@@ -421,38 +941,29 @@ class SpotifyRecommendations():
             - top_playlists (np.array): indices of the top n playlists based on the train_data_scaled_feats_df dataframe
         
         """
-        try:
-            self.scaled_y
-        except:
-            self.get_scaled_y_vector()
+        self.top_n, self.metric, self.similar = n, metric, similar
+        self.top_playlists = self.get_stage('top_playlists', lambda: self.compute_top_n_playlists(printing))
+        return self.top_playlists
 
-        # Get labels from model and predict user cluster
-        self.user_cluster = self.model.predict(self.scaled_y)
-        
-        # Slice df for the predicted cluster and get Playlist IDs (PIDs)
-        df_slice = self.train_data_scaled_feats_df[self.train_data_scaled_feats_df['cluster']==self.user_cluster[0]]
-        df_slice = df_slice.drop(['cluster'], axis=1)
-        indices = self.train_data_scaled_feats_df[self.train_data_scaled_feats_df['cluster']==self.user_cluster[0]].reset_index()['index'].to_numpy() # PIDs for the cluster
-        
-        # Convert df slice to numpy, compute similarities and grab the top n PIDs
-        sliced_data_array = df_slice.to_numpy()
-        if similar:
-            simi = cdist(sliced_data_array, self.scaled_y, metric=metric).argsort(axis=None)[:n]
-        else:
-            simi = cdist(sliced_data_array, self.scaled_y, metric=metric).argsort(axis=None)[-n:]
-        self.top_playlists = indices[simi]
+    def compute_top_n_playlists(self, printing=False):
+        scaled_y = self.get_scaled_y_vector()
+        user_cluster = self.get_user_cluster()
+
+        # Playlists of the predicted cluster with their norms precomputed, see distance_kernels.py
+        distances = self.ml_model.cluster_distances[int(user_cluster[0])]
+        count('playlists', len(distances))
+        top_playlists = distances.nearest(scaled_y, self.top_n, self.metric, self.similar, self.excluded_pids)
         
         if printing:
-            for idx in self.top_playlists:
+            for idx in top_playlists:
                 self.log_output('---')
                 self.log_output('Playlist: {}\tpid:{}'.format(self.playlists_df[self.playlists_df['pid'] == idx]['name'].iloc[0], idx))
-                ratings_df = self.ratings_df[self.ratings_df['pid'] == idx].copy()
-                tracks_df = self.tracks_df[self.tracks_df['track_id'].isin(ratings_df['track_id'].values)].copy()
-                for _, song in tracks_df.iloc[0:3].iterrows():
+                track_rows = self.ml_model.track_id_rows[self.ml_model.get_playlist_track_ids([idx])[:3]]
+                for _, song in self.tracks_df.iloc[track_rows[track_rows >= 0]].iterrows():
                     self.log_output('Artist: {}\t Song:{}'.format(song['artist_name'], song['track_name']))
             self.log_output('---')
         
-        return self.top_playlists
+        return top_playlists
 
     def get_songs_recommendations(self, n=30, printing=False):
         """
@@ -461,19 +972,8 @@ class SpotifyRecommendations():
             - n (int): number of songs to recommend, default to 30.
             - printing (bool): Flag to print or not the song recommendations, default to False.
         """
-        try:
-            self.top_playlists
-        except:
-            self.get_top_n_playlists(printing=True)
-
-        playlist_audio_features_df = self.get_audio_features_df(playlist_pids_list=self.top_playlists)
-        array_audio_feats = playlist_audio_features_df[self.feat_cols_user].to_numpy()
-        
-        y_vector = np.array(self.raw_y).reshape(1,-1)
-        low_variance_indices = np.sum(np.square((y_vector-array_audio_feats)),axis=1).argsort(axis=None)
-        self.song_uris = playlist_audio_features_df.loc[low_variance_indices]['uri']
-        self.song_uris.drop_duplicates(inplace=True)
-        self.song_uris = self.song_uris[:n]
+        self.n_songs = n
+        self.song_uris = self.get_stage('song_uris', self.compute_songs_recommendations)
 
         if printing:
             for uri in self.song_uris:
@@ -482,6 +982,43 @@ class SpotifyRecommendations():
 
         return self.song_uris
 
+    def compute_songs_recommendations(self):
+        if self.rec_method == 'cooccurrence':
+            song_uris = self.compute_cooccurrence_recommendations()
+            if song_uris is not None:
+                return song_uris
+            self.log_output('No co-occurrence neighbours for these tracks, recommending by clusters')
+        # Playlists from the last get_top_n_playlists tuning, the defaults otherwise
+        top_playlists = self.get_top_n_playlists(self.top_n, self.metric, self.similar, printing=True)
+        raw_y = self.get_raw_y()
+
+        playlist_audio_features_df = self.get_audio_features_df(playlist_pids_list=top_playlists)
+        array_audio_feats = playlist_audio_features_df[self.feat_cols_user].to_numpy()
+        count('candidate_tracks', len(array_audio_feats))
+        
+        y_vector = np.array(raw_y).reshape(1,-1)
+        low_variance_indices = np.sum(np.square((y_vector-array_audio_feats)),axis=1).argsort(axis=None)
+        song_uris = playlist_audio_features_df.loc[low_variance_indices]['uri']
+        song_uris = song_uris.drop_duplicates()
+        return song_uris[:self.n_songs]
+
+    def compute_cooccurrence_recommendations(self):
+        "Songs that appear most in playlists with the user tracks, None when there is nothing to score them with"
+        if self.ml_model.cooccurrence is None or self.feature_vector is not None:
+            return None
+        songs_df = self.get_tracks_window()
+        rows = self.ml_model.get_track_rows(songs_df['uri'].astype(str).to_numpy())
+        track_ids = self.tracks_df['track_id'].to_numpy()[rows[rows >= 0]]
+        candidates, scores = self.ml_model.get_cooccurring_tracks(track_ids)
+        count('seed_tracks', len(track_ids))
+        count('candidate_tracks', len(candidates))
+        rows = self.ml_model.track_id_rows[candidates]
+        rows = rows[rows >= 0][:self.n_songs]
+        if len(rows) == 0:
+            return None
+        self.log_output('Ranked {} co-occurring songs of {} user tracks'.format(len(candidates), len(track_ids)))
+        return pd.Series(self.ml_model.get_track_uris(rows), name='uri')
+
     def build_spotify_playlist(self, playlist_name='Machine Learning Playlist', 
                                description='Hell yeah, this is a Machine Learning Playlist generated on {}'.format(datetime.date.today().strftime("%B %d, %Y"))):
         """
@@ -491,25 +1028,31 @@ class SpotifyRecommendations():
             - decription (str): Description of playlist.
             - target (str): 'user' or 'playlist', user will use user's favorite tracks and playlist will 
         """
-        try:
-            self.song_uris
-        except:
-            self.get_songs_recommendations()
-
-        items = self.song_uris.to_list()
+        items = self.get_songs_recommendations(self.n_songs).to_list()
         #user_id = self.sp.current_user()['id']
         #new_playlist = self.sp.user_playlist_create(user_id, playlist_name, description=description)
         #self.sp.playlist_add_items(new_playlist['id'],items=items)
         return items
 
+    def get_artist_genres(self):
+        "Genres of the artist of each track, one call per 50 unique artists instead of one call per track artist"
+        self.get_tracks_from_playlist_or_user_favorites()
+        # Tracks given by uri that are not in the database have no artist
+        unique_artists = [artist for artist in dict.fromkeys(self.artist_uri) if artist]
+        artist_genres = {}
+        for i in range(0, len(unique_artists), 50):
+            count('api_calls')
+            for artist in self.sp.artists(unique_artists[i:i + 50])['artists']:
+                if artist:
+                    artist_genres[artist['id']] = artist['genres']
+        return [artist_genres.get(artist, []) for artist in self.artist_uri]
+
+    @traced('figure.genre_wordcloud')
     def get_genre_wordcloud_fig(self):
         "Get Spotify Wrapped for current user"
-        try:
-            self.artist_uri
-        except:
-            self.get_tracks_from_playlist_or_user_favorites()
+        self.get_tracks_from_playlist_or_user_favorites()
 
-        if self.playlist_uri is None:
+        if self.playlist_uri is None and self.track_uris is None and self.mood is None:
             user = self.sp.current_user()['display_name']
             followers = self.sp.current_user()['followers']['total']
             self.log_output("Hello {}!".format(user))
@@ -540,70 +1083,62 @@ class SpotifyRecommendations():
             except:
                 self.log_output("Ooops, it seems that you don't have top tracks at the moment.\n")
 
-        genres = []
-        for artist in self.artist_uri:
-            genres.append(self.sp.artist(artist)['genres'])
+        genres = self.get_artist_genres()
 
         text = [item for sublist in genres for item in sublist]
         text = ' '.join(text)
         wc = WordCloud(background_color ='white',relative_scaling=0, width=500, height=500, colormap=self.color).generate(text)
-        fig, ax = plt.subplots(1, 1, figsize=(5, 5))
+        # Figure instead of plt.subplots, pyplot's global state is not thread safe
+        fig = Figure(figsize=(5, 5))
+        ax = fig.subplots(1, 1)
         ax.imshow(wc, interpolation='bilinear')
         ax.axis("off")
         ax.title.set_text('Genres you listen to the most\n')
         return fig
 
+    @traced('figure.playlist_wordcloud')
     def get_playlist_wordcloud_fig(self):        
         # User Playlist Cluster
-        text = ' '.join(self.playlists_df[self.playlists_df['cluster']==self.user_cluster[0]]["name"])
+        user_cluster = self.get_user_cluster()
+        text = ' '.join(self.playlists_df[self.playlists_df['cluster']==user_cluster[0]]["name"])
         wc = WordCloud(background_color ='white',relative_scaling=0, width=500, height=500, colormap=self.color).generate(text)
-        fig, ax = plt.subplots(1, 1, figsize=(5, 5))
+        fig = Figure(figsize=(5, 5))
+        ax = fig.subplots(1, 1)
         ax.imshow(wc, interpolation='bilinear')
         ax.axis("off")
-        ax.title.set_text('Playlist names in your cluster {}\n'.format(self.user_cluster))
+        ax.title.set_text('Playlist names in your cluster {}\n'.format(user_cluster))
         return fig
 
+    def get_user_tsne(self):
+        "User fav songs transformed to TSNE to plot in vector space, shared by both cluster figures"
+        self.user_tsne = self.get_stage('user_tsne', lambda: self.tsne_transformer.transform(self.get_scaled_y_vector())[0])
+        return self.user_tsne
+
+    @traced('figure.user_cluster_all')
     def get_user_cluster_all_fig(self):
-        # Transform user fav songs to TSNE to plot in vector space
-        try:
-            self.scaled_y
-        except:
-            self.get_scaled_y_vector()
-        try:
-            self.user_cluster
-        except:
-            self.user_cluster = self.model.predict(self.scaled_y)
-            
-        user_tsne = self.tsne_transformer.transform(self.scaled_y)[0]
+        user_tsne = self.get_user_tsne()
 
         # Blob all clusters
-        fig, ax = plt.subplots(1, 1, figsize=(5, 5))
+        fig = Figure(figsize=(5, 5))
+        ax = fig.subplots(1, 1)
         sns.scatterplot(ax=ax, x='X', y='Y', hue='cluster', style='cluster', data=self.openTSNE_df, legend=None)
         ax.scatter(x=user_tsne[0], y=user_tsne[1], color='yellow', marker='*', s=500)
         ax.title.set_text('You (Star) are here in the 17 Clusters')
         return fig
-        #plt.show()
 
+    @traced('figure.user_cluster_single')
     def get_user_cluster_single_fig(self):
-        try:
-            self.scaled_y
-        except:
-            self.get_scaled_y_vector()
-        try:
-            self.user_cluster
-        except:
-            self.user_cluster = self.model.predict(self.scaled_y)
-            
-        user_tsne = self.tsne_transformer.transform(self.scaled_y)[0]
+        user_tsne = self.get_user_tsne()
+        user_cluster = self.get_user_cluster()
 
         # Blob user cluster
-        palette = {c:'purple' if c==self.user_cluster else 'darkgrey' for c in self.openTSNE_df.cluster.unique()}
-        fig, ax = plt.subplots(1, 1, figsize=(5, 5))
+        palette = {c:'purple' if c==user_cluster else 'darkgrey' for c in self.openTSNE_df.cluster.unique()}
+        fig = Figure(figsize=(5, 5))
+        ax = fig.subplots(1, 1)
         sns.scatterplot(ax=ax, x='X', y='Y', hue='cluster', style='cluster', data=self.openTSNE_df, legend=None, palette=palette)
         ax.scatter(x=user_tsne[0], y=user_tsne[1], color='yellow', marker='*', s=500)
-        ax.title.set_text('You are in cluster {}'.format(self.user_cluster))
+        ax.title.set_text('You are in cluster {}'.format(user_cluster))
         return fig
-        #plt.show()
 
     def __str__(self):
         return 'Spotify Recommender System with model: {} on {} playlists.'.format(self.model, len(self.train_data_scaled_feats_df))
@@ -635,17 +1170,49 @@ class SpotifyRecommendations():
 #x.get_genre_wordcloud_fig()
 
 class SpotifyAPI(object):
-    access_token = None
-    access_token_expires = datetime.datetime.now()
-    access_token_did_expire = True
+    """
+    Client credentials client of the Spotify Web API search
+    Attributes:
+        - api_url (str): base url of the API, SPR_SPOTIFY_API_URL or the Spotify one, e.g. the api_url of
+          spotify_clients.start_stub_server() for tests
+        - token_url (str): url of the token requests, SPR_SPOTIFY_TOKEN_URL or the Spotify one
+        - timeout (tuple): connect and read timeouts in seconds of every request
+        - refresh_margin (int): seconds before the expiry at which the token is renewed
+    Tokens are cached at class level by token url and client id, so the instances created for each search
+    share one token, and only one thread renews it while the others wait for the new one.
+    """
+    tokens = {}
+    token_locks = {}
     client_id = None
     client_secret = None
-    token_url = "https://accounts.spotify.com/api/token"
+    token_url = os.environ.get('SPR_SPOTIFY_TOKEN_URL', "https://accounts.spotify.com/api/token")
+    api_url = os.environ.get('SPR_SPOTIFY_API_URL', "https://api.spotify.com/v1")
+    timeout = (3.05, 10)
+    refresh_margin = 60
 
-    def __init__(self, client_id, client_secret, *args, **kwargs):
+    def __init__(self, client_id, client_secret, http=None, api_url=None, token_url=None, timeout=None, *args, **kwargs):
+        """
+        :param http: object with the requests post and get functions used for all calls, e.g. a recording or replaying
+                     one from spotify_clients, the session with connection pooling and retries of make_http() by default
+        """
         super().__init__(*args, **kwargs)
         self.client_id = client_id
         self.client_secret = client_secret
+        self.http = http if http is not None else make_http()
+        self.api_url = (api_url or self.api_url).rstrip('/')
+        self.token_url = token_url or self.token_url
+        self.timeout = timeout or self.timeout
+        self.token_key = (self.token_url, client_id)
+
+    @property
+    def access_token(self):
+        token = self.tokens.get(self.token_key)
+        return token['access_token'] if token else None
+
+    @property
+    def access_token_expires(self):
+        token = self.tokens.get(self.token_key)
+        return token['expires'] if token else None
 
     def get_client_credentials(self):
         #Returns a base64 encoded string
@@ -672,34 +1239,32 @@ class SpotifyAPI(object):
         token_url = self.token_url
         token_data = self.get_token_data()
         token_headers = self.get_token_headers()
-        r = requests.post(token_url, data=token_data, headers=token_headers)
+        r = self.http.post(token_url, data=token_data, headers=token_headers, timeout=self.timeout)
         if r.status_code not in range(200, 299): 
             raise Exception("Could not authenticate client")
             #return False
         data = r.json()
         now = datetime.datetime.now()
-        access_token = data['access_token']
         expires_in = data['expires_in'] # seconds
-        expires = now + datetime.timedelta(seconds=expires_in)
-        self.access_token = access_token
-        self.access_token_expires = expires 
-        self.access_token_did_expire = expires < now
+        self.tokens[self.token_key] = {'access_token': data['access_token'],
+                                       'expires': now + datetime.timedelta(seconds=expires_in)}
         return True
-    
-    def get_access_token(self):
-        token = self.access_token
-        expires = self.access_token_expires
-        now = datetime.datetime.now()
-        if expires < now:
-            self.perform_auth()
-            return self.get_access_token()
-        elif token == None:
-            self.perform_auth()
-            return self.get_access_token()
-        return token
-
-    def get_resource_header(self):
-        access_token = self.get_access_token()
+
+    def get_access_token(self, renew=False):
+        """
+        The cached token, renewed first when it expires within refresh_margin seconds
+        :param renew: renew it anyway, after the API rejected it
+        """
+        lock = self.token_locks.setdefault(self.token_key, threading.Lock())
+        with lock:
+            token = self.tokens.get(self.token_key)
+            refresh_at = datetime.datetime.now() + datetime.timedelta(seconds=self.refresh_margin)
+            if renew or token is None or token['expires'] < refresh_at:
+                self.perform_auth()
+            return self.tokens[self.token_key]['access_token']
+
+    def get_resource_header(self, renew=False):
+        access_token = self.get_access_token(renew)
         headers = {
             "Authorization": f"Bearer {access_token}"
         }      
@@ -707,17 +1272,17 @@ class SpotifyAPI(object):
 
     def base_search(self, query_params):
         headers = self.get_resource_header()
-        #print(headers)
-        endpoint = "https://api.spotify.com/v1/search"
+        endpoint = f"{self.api_url}/search"
         lookup_url = f"{endpoint}?{query_params}"
-        #print(lookup_url)
-        r = requests.get(lookup_url, headers=headers)
+        r = self.http.get(lookup_url, headers=headers, timeout=self.timeout)
+        if r.status_code == 401:
+            # Revoked or expired early, renew once
+            r = self.http.get(lookup_url, headers=self.get_resource_header(renew=True), timeout=self.timeout)
         if r.status_code not in range(200, 299):
             return {}
-        #print(r.json())
         return r.json()
 
-    def search(self, query=None, operator=None, operator_query=None, search_type='playlist'):
+    def get_query(self, query=None, operator=None, operator_query=None):
         if query == None:
             raise Exception("A query is required")
         if isinstance(query, dict):
@@ -727,7 +1292,41 @@ class SpotifyAPI(object):
                 operator = operator.upper()
                 if isinstance(operator_query, str):
                     query = f"{query} {operator} {operator_query}"
-        query_params = urlencode({"q": query, "type": search_type.lower()})
-        #print(query_params)
+        return query
+
+    def search(self, query=None, operator=None, operator_query=None, search_type='playlist', limit=None, offset=None):
+        """
+        One page of results
+        :param limit: results per page, up to 50, the API returns 20 when None
+        :param offset: index of the first result
+        """
+        params = {"q": self.get_query(query, operator, operator_query), "type": search_type.lower()}
+        if limit is not None:
+            params["limit"] = limit
+        if offset:
+            params["offset"] = offset
+        query_params = urlencode(params)
         return self.base_search(query_params)
+
+    def search_all(self, query=None, operator=None, operator_query=None, search_type='playlist', limit=50, max_items=1000, workers=4):
+        """
+        Results of all the pages up to max_items, the API stops at 1000. The first page gives the totals and
+        the other pages are fetched concurrently on the pooled connections.
+        :return: dict like search with the items of every page in the one page of each type
+        """
+        results = self.search(query, operator, operator_query, search_type, limit)
+        if not results:
+            return results
+        total = min(max(page['total'] for page in results.values()), max_items, 1000)
+        offsets = list(range(limit, total, limit))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            pages = list(pool.map(lambda offset: self.search(query, operator, operator_query, search_type, limit, offset), offsets))
+        for more in pages:
+            for key, page in more.items():
+                results[key]['items'].extend(page['items'])
+        for page in results.values():
+            page['items'] = page['items'][:max_items]
+            page['limit'] = len(page['items'])
+            page['next'] = None
+        return results
    
@@ -0,0 +1,156 @@
+import os
+import time
+import sqlite3
+import argparse
+import numpy as np
+import pandas as pd
+from datetime import datetime
+
+from varint_codec import varint_lengths, encode_varints, decode_varints, encode_gaps, decode_gaps
+from tracing import count
+
+cwd = os.getcwd()
+title_index_path = os.path.join(cwd, 'data', 'title_index.npz')
+
+# Runs of letters and digits, punctuation, symbols and emojis separate the words
+token_pattern = r"[^\W_]+"
+
+def tokenize_titles(names):
+    """
+    Lower case words of each title, each distinct title is tokenized once
+    :param names: Series of titles
+    :return: distinct titles' word lists (Series), and the position of each title in them (-1 for None)
+    """
+    codes, titles = pd.factorize(pd.Series(names, dtype=object))
+    words = pd.Series(titles, dtype=object).str.lower().str.findall(token_pattern)
+    return words, codes
+
+class TitleIndex():
+    """
+    Inverted index of the playlist titles scored with BM25, to find playlists by words such as a mood.
+    The postings of each word are the rows of the playlists whose title has it, stored as varints of the gaps
+    between the rows (one byte for most of them with 1M playlists), and the word count in each title as varints.
+    A search only decodes the postings of the words of the query.
+    Attributes:
+        - pids (np.array): pid of each indexed playlist, postings address them by row
+        - terms (np.array): sorted vocabulary
+        - doc_freqs (np.array): playlists of each term
+        - doc_postings, doc_offsets: gaps of the rows, term i is doc_postings[doc_offsets[i]:doc_offsets[i + 1]]
+        - tf_postings, tf_offsets: word counts in the same order
+        - doc_lengths (np.array): words of each title
+    """
+    k1 = 1.2
+    b = 0.75
+    arrays = ['pids', 'terms', 'doc_freqs', 'doc_postings', 'doc_offsets', 'tf_postings', 'tf_offsets', 'doc_lengths']
+
+    def __init__(self, pids, terms, doc_freqs, doc_postings, doc_offsets, tf_postings, tf_offsets, doc_lengths):
+        self.pids = pids
+        self.terms = terms
+        self.doc_freqs = doc_freqs
+        self.doc_postings = doc_postings
+        self.doc_offsets = doc_offsets
+        self.tf_postings = tf_postings
+        self.tf_offsets = tf_offsets
+        self.doc_lengths = doc_lengths
+        self.avg_length = float(doc_lengths.mean()) if len(doc_lengths) else 0.0
+        n = len(pids)
+        self.idf = np.log(1 + (n - doc_freqs + 0.5) / (doc_freqs + 0.5))
+
+    @classmethod
+    def from_titles(cls, pids, names):
+        """
+        Index the titles of the playlists, the (word, count) pairs of each distinct title are computed once
+        and repeated for the playlists sharing it
+        """
+        pids = np.asarray(pids)
+        words, codes = tokenize_titles(names)
+        title_words = words.explode().dropna()
+        terms, term_ids = np.unique(title_words.to_numpy(dtype=str), return_inverse=True)
+        keys, tfs = np.unique(title_words.index.to_numpy(dtype=np.int64) * len(terms) + term_ids.reshape(-1), return_counts=True)
+        pair_titles, pair_terms = keys // len(terms), keys % len(terms)
+        title_pairs = np.bincount(pair_titles, minlength=len(words))
+        title_starts = np.cumsum(title_pairs) - title_pairs
+        title_lengths = np.bincount(pair_titles, weights=tfs, minlength=len(words)).astype(np.int64)
+
+        # Pairs of every playlist from the pairs of its title
+        known = codes >= 0
+        doc_pairs = np.where(known, title_pairs[np.maximum(codes, 0)], 0)
+        docs = np.repeat(np.arange(len(codes)), doc_pairs)
+        within = np.arange(len(docs)) - np.repeat(np.cumsum(doc_pairs) - doc_pairs, doc_pairs)
+        pair_index = np.repeat(title_starts[np.maximum(codes, 0)], doc_pairs) + within
+        doc_terms, doc_tfs = pair_terms[pair_index], tfs[pair_index]
+
+        # Postings sorted by term, then by row since docs are increasing
+        order = np.argsort(doc_terms, kind='stable')
+        docs, doc_terms, doc_tfs = docs[order], doc_terms[order], doc_tfs[order]
+        doc_freqs = np.bincount(doc_terms, minlength=len(terms))
+        term_starts = np.cumsum(doc_freqs) - doc_freqs
+        doc_postings, doc_offsets = encode_gaps(docs, term_starts)
+        tf_ends = np.append(np.cumsum(varint_lengths(doc_tfs)), 0)
+        tf_offsets = np.append(tf_ends[term_starts - 1], tf_ends[-2] if len(doc_tfs) else 0)
+        doc_lengths = np.where(known, title_lengths[np.maximum(codes, 0)], 0).astype(np.uint16)
+        return cls(pids, terms, doc_freqs, doc_postings, doc_offsets, encode_varints(doc_tfs), tf_offsets, doc_lengths)
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in self.arrays)
+
+    def save(self, path=title_index_path):
+        np.savez(path, **{name: getattr(self, name) for name in self.arrays})
+
+    @classmethod
+    def load(cls, path=title_index_path):
+        index = np.load(path)
+        return cls(*[index[name] for name in cls.arrays])
+
+    def get_postings(self, term):
+        "Rows of the playlists with the term and its count in their titles"
+        docs = decode_gaps(self.doc_postings[self.doc_offsets[term]:self.doc_offsets[term + 1]])
+        tfs = decode_varints(self.tf_postings[self.tf_offsets[term]:self.tf_offsets[term + 1]])
+        return docs, tfs.astype(np.float64)
+
+    def search(self, query, n=10):
+        """
+        Playlists whose titles best match the words of the query by BM25, ties in row order
+        :return: np.array of pids, np.array of their scores
+        """
+        words = list(dict.fromkeys(tokenize_titles([query])[0].iloc[0])) if query else []
+        all_docs, all_scores = [], []
+        for term, word in zip(np.searchsorted(self.terms, words), words):
+            if term >= len(self.terms) or self.terms[term] != word:
+                continue
+            docs, tfs = self.get_postings(term)
+            norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[docs] / self.avg_length)
+            all_docs.append(docs)
+            all_scores.append(self.idf[term] * tfs * (self.k1 + 1) / (tfs + norm))
+        if not all_docs:
+            return np.array([], dtype=self.pids.dtype), np.array([], dtype=np.float64)
+        docs, inverse = np.unique(np.concatenate(all_docs), return_inverse=True)
+        scores = np.bincount(inverse.reshape(-1), weights=np.concatenate(all_scores))
+        count('postings', len(inverse))
+        top = np.lexsort((docs, -scores))[:n]
+        return self.pids[docs[top]], scores[top]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the playlist title index used by mood search')
+    parser.add_argument('--db', default=os.path.join('data', 'spotify_20K_playlists.db'))
+    parser.add_argument('--output', default=title_index_path)
+    parser.add_argument('--queries', nargs='*', default=['chill', 'workout', 'sleep', 'summer vibes', 'christmas party'])
+    args = parser.parse_args()
+
+    start_time = datetime.now()
+    conn = sqlite3.connect(args.db)
+    playlists_df = pd.read_sql('select pid, name from playlists', conn)
+    conn.close()
+    title_index = TitleIndex.from_titles(playlists_df['pid'].to_numpy(), playlists_df['name'])
+    title_index.save(args.output)
+    postings = int(title_index.doc_freqs.sum())
+    print('Indexed', len(title_index.pids), 'playlists,', len(title_index.terms), 'words,', postings, 'postings in', datetime.now() - start_time)
+    print('Postings: {:.2f} MB as varints, {:.2f} MB as int32 rows and counts, index {:.2f} MB'.format(
+        (title_index.doc_postings.nbytes + title_index.tf_postings.nbytes) / 2**20, postings * 8 / 2**20, title_index.nbytes / 2**20))
+    for query in args.queries:
+        start = time.perf_counter()
+        pids, scores = title_index.search(query)
+        print('{:<20} {:7.2f} ms  pids: {}'.format(query, (time.perf_counter() - start) * 1000, pids[:5].tolist()))
+    print('Saved to', args.output)
+    print('Total Time:', datetime.now() - start_time)
@@ -0,0 +1,203 @@
+import json
+import time
+import functools
+import threading
+import numpy as np
+from collections import deque
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+class Span():
+    """
+    One timed section of the hot path
+    Attributes:
+        - name (str): what was timed, e.g. 'scaling' or 'figure.genre_wordcloud'
+        - parent (str): name of the enclosing span in the same thread, None at the top level
+        - start (float): time.time() when the span started
+        - seconds (float): duration, set when the span ends
+        - counts (dict): counters recorded while the span was open, e.g. tracks, api_calls, cache_hits
+    """
+    __slots__ = ['name', 'parent', 'start', 'seconds', 'counts', 'perf_start']
+
+    def __init__(self, name, parent=None, counts=None):
+        self.name = name
+        self.parent = parent
+        self.start = time.time()
+        self.perf_start = time.perf_counter()
+        self.seconds = None
+        self.counts = dict(counts) if counts else {}
+
+    def count(self, key, n=1):
+        self.counts[key] = self.counts.get(key, 0) + n
+
+    def to_dict(self):
+        return {'name': self.name, 'parent': self.parent, 'start': self.start, 'ms': round(self.seconds * 1000, 3),
+                'counts': dict(self.counts)}
+
+class SpanStats():
+    "Totals of all the spans with one name and the durations of the last window of them for the percentiles"
+    def __init__(self, window=1000):
+        self.count = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.recent = deque(maxlen=window)
+        self.counts = {}
+
+    def add(self, span):
+        self.count += 1
+        self.total_seconds += span.seconds
+        self.max_seconds = max(self.max_seconds, span.seconds)
+        self.recent.append(span.seconds)
+        for key, n in span.counts.items():
+            self.counts[key] = self.counts.get(key, 0) + n
+
+    def quantiles(self, qs=(50, 95, 99)):
+        return np.percentile(np.asarray(self.recent), qs) if self.recent else [np.nan] * len(qs)
+
+class Tracer():
+    """
+    In-process collector of spans. Spans nest per thread, counts go to the innermost open span of the
+    calling thread, or to the global counters when no span is open.
+    Attributes:
+        - enabled (bool): when False span() only yields and nothing is recorded
+        - spans (deque): the last max_spans finished spans
+        - stats (dict): SpanStats by span name
+        - counters (dict): counts recorded outside of any span
+    """
+    def __init__(self, max_spans=2000, window=1000):
+        self.enabled = True
+        self.window = window
+        self.spans = deque(maxlen=max_spans)
+        self.stats = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def current(self):
+        stack = self.stack()
+        return stack[-1] if stack else None
+
+    @contextmanager
+    def span(self, name, **counts):
+        if not self.enabled:
+            yield Span(name)
+            return
+        stack = self.stack()
+        span = Span(name, stack[-1].name if stack else None, counts)
+        stack.append(span)
+        try:
+            yield span
+        finally:
+            span.seconds = time.perf_counter() - span.perf_start
+            stack.pop()
+            self.record(span)
+
+    def record(self, span):
+        with self.lock:
+            self.spans.append(span)
+            if span.name not in self.stats:
+                self.stats[span.name] = SpanStats(self.window)
+            self.stats[span.name].add(span)
+
+    def count(self, key, n=1):
+        span = self.current()
+        if span is not None:
+            span.count(key, n)
+        elif self.enabled:
+            with self.lock:
+                self.counters[key] = self.counters.get(key, 0) + n
+
+    def traced(self, name):
+        "Decorator that runs the function in a span"
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def summary(self):
+        """
+        :return: list with a dict per span name: count, mean/p50/p95/p99/max in ms, total seconds and summed counts
+        """
+        with self.lock:
+            rows = []
+            for name, stats in self.stats.items():
+                p50, p95, p99 = stats.quantiles()
+                row = {'span': name, 'count': stats.count, 'mean_ms': 1000 * stats.total_seconds / stats.count,
+                       'p50_ms': 1000 * p50, 'p95_ms': 1000 * p95, 'p99_ms': 1000 * p99,
+                       'max_ms': 1000 * stats.max_seconds, 'total_s': stats.total_seconds}
+                row.update(stats.counts)
+                rows.append(row)
+        return sorted(rows, key=lambda row: -row['total_s'])
+
+    def recent(self, n=100):
+        with self.lock:
+            return [span.to_dict() for span in list(self.spans)[-n:]]
+
+    def reset(self):
+        with self.lock:
+            self.spans.clear()
+            self.stats = {}
+            self.counters = {}
+
+    def prometheus_text(self, prefix='spr'):
+        "Stats in the Prometheus text exposition format"
+        lines = ['# TYPE {}_span_seconds summary'.format(prefix)]
+        count_lines = ['# TYPE {}_span_counts_total counter'.format(prefix)]
+        with self.lock:
+            for name, stats in self.stats.items():
+                for q, value in zip((0.5, 0.95, 0.99), stats.quantiles()):
+                    lines.append('{}_span_seconds{{span="{}",quantile="{}"}} {:.6f}'.format(prefix, name, q, value))
+                lines.append('{}_span_seconds_sum{{span="{}"}} {:.6f}'.format(prefix, name, stats.total_seconds))
+                lines.append('{}_span_seconds_count{{span="{}"}} {}'.format(prefix, name, stats.count))
+                for key, n in stats.counts.items():
+                    count_lines.append('{}_span_counts_total{{span="{}",count="{}"}} {}'.format(prefix, name, key, n))
+            counter_lines = ['# TYPE {}_counts_total counter'.format(prefix)]
+            counter_lines += ['{}_counts_total{{count="{}"}} {}'.format(prefix, key, n) for key, n in self.counters.items()]
+        return '\n'.join(lines + count_lines + counter_lines) + '\n'
+
+tracer = Tracer()
+span = tracer.span
+count = tracer.count
+traced = tracer.traced
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    "GET /metrics in the Prometheus text format, GET /spans for the recent spans as JSON"
+    def do_GET(self):
+        if self.path == '/metrics':
+            body, content_type = tracer.prometheus_text().encode(), 'text/plain; version=0.0.4'
+        elif self.path.startswith('/spans'):
+            body, content_type = json.dumps(tracer.recent()).encode(), 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+metrics_server = None
+
+def start_metrics_server(port=9108, host='127.0.0.1'):
+    """
+    Serve the tracer stats on http://host:port/metrics from a daemon thread. Only the first call starts a
+    server, the app module is rerun by Streamlit on every interaction.
+    :return: the server
+    """
+    global metrics_server
+    if metrics_server is None:
+        metrics_server = ThreadingHTTPServer((host, port), MetricsHandler)
+        metrics_server.daemon_threads = True
+        threading.Thread(target=metrics_server.serve_forever, daemon=True).start()
+    return metrics_server
@@ -0,0 +1,114 @@
+import numpy as np
+
+# Variable length integers (LEB128): 7 bits per byte, low bits first, the high bit set on every byte but the last.
+# Sorted ids are stored as the gaps between them, so most take one byte instead of four or eight. Ids in another
+# order, like the tracks of a playlist by position, are stored as zigzag encoded differences, which map the small
+# negative and positive differences to small values: 0, -1, 1, -2, 2... to 0, 1, 2, 3, 4...
+
+def varint_lengths(values):
+    "Bytes of each non negative value once encoded"
+    values = np.asarray(values, dtype=np.uint64)
+    lengths = np.ones(len(values), dtype=np.int64)
+    for shift in range(7, 64, 7):
+        lengths += values >= np.uint64(1 << shift)
+    return lengths
+
+def encode_varints(values):
+    """
+    :param values: non negative integers
+    :return: np.array (uint8) of the concatenated varints
+    """
+    values = np.asarray(values, dtype=np.uint64)
+    lengths = varint_lengths(values)
+    starts = np.cumsum(lengths) - lengths
+    out = np.empty(int(lengths.sum()), dtype=np.uint8)
+    for k in range(int(lengths.max()) if len(lengths) else 0):
+        has_byte = lengths > k
+        byte = (values[has_byte] >> np.uint64(7 * k)) & np.uint64(0x7f)
+        more = (lengths[has_byte] > k + 1).astype(np.uint64) << np.uint64(7)
+        out[starts[has_byte] + k] = (byte | more).astype(np.uint8)
+    return out
+
+def decode_varints(data):
+    """
+    :param data: np.array (uint8) of concatenated varints
+    :return: np.array (uint64) of the values
+    """
+    data = np.asarray(data, dtype=np.uint8)
+    if len(data) == 0:
+        return np.array([], dtype=np.uint64)
+    ends = data < 0x80
+    starts = np.flatnonzero(np.concatenate(([True], ends[:-1])))
+    # Position of each byte within its varint gives its shift
+    position = np.arange(len(data)) - np.repeat(starts, np.diff(np.append(starts, len(data))))
+    parts = (data & np.uint8(0x7f)).astype(np.uint64) << (np.uint64(7) * position.astype(np.uint64))
+    return np.add.reduceat(parts, starts)
+
+def zigzag_encode(values):
+    "Signed integers to non negative ones, small magnitudes to small values"
+    values = np.asarray(values, dtype=np.int64)
+    return ((values << 1) ^ (values >> 63)).astype(np.uint64)
+
+def zigzag_decode(values):
+    values = np.asarray(values, dtype=np.uint64)
+    return (values >> np.uint64(1)).astype(np.int64) ^ -(values & np.uint64(1)).astype(np.int64)
+
+def encode_segments(values, segment_starts):
+    """
+    Varints of non negative values split in segments
+    :return: np.array (uint8) of the varints, np.array of the byte offset of each segment with the total at the end
+    """
+    segment_starts = np.asarray(segment_starts, dtype=np.int64)
+    if len(values) == 0:
+        return np.array([], dtype=np.uint8), np.zeros(len(segment_starts) + 1, dtype=np.int64)
+    # Cumulative bytes with a 0 at the end, so the offset of the segment starting at 0 is ends[-1]
+    ends = np.append(np.cumsum(varint_lengths(values)), 0)
+    return encode_varints(values), np.append(ends[segment_starts - 1], ends[-2])
+
+def encode_gaps(ids, segment_starts=(0,)):
+    """
+    Varints of sorted ids as the gaps between consecutive ids, each segment starting again from 0
+    :param segment_starts: first index of each independently sorted segment, e.g. the postings of each term
+    :return: np.array (uint8) of the varints, np.array of the byte offset of each segment with the total at the end
+    """
+    ids = np.asarray(ids, dtype=np.int64)
+    segment_starts = np.asarray(segment_starts, dtype=np.int64)
+    if len(ids) == 0:
+        return encode_segments(ids, segment_starts)
+    gaps = np.diff(ids, prepend=0)
+    gaps[segment_starts] = ids[segment_starts]
+    return encode_segments(gaps, segment_starts)
+
+def decode_gaps(data):
+    "Sorted ids of one segment encoded by encode_gaps"
+    return np.cumsum(decode_varints(data)).astype(np.int64)
+
+def encode_deltas(values, segment_starts=(0,)):
+    """
+    Varints of integers in any order as the zigzag encoded differences between consecutive values, each segment
+    starting again from 0
+    :param segment_starts: first index of each segment, e.g. the tracks of each playlist
+    :return: np.array (uint8) of the varints, np.array of the byte offset of each segment with the total at the end
+    """
+    values = np.asarray(values, dtype=np.int64)
+    segment_starts = np.asarray(segment_starts, dtype=np.int64)
+    if len(values) == 0:
+        return encode_segments(values, segment_starts)
+    deltas = np.diff(values, prepend=0)
+    deltas[segment_starts] = values[segment_starts]
+    return encode_segments(zigzag_encode(deltas), segment_starts)
+
+def decode_deltas(data, counts=None):
+    """
+    Values encoded by encode_deltas
+    :param data: varints of one segment, or of consecutive segments with counts
+    :param counts: values in each segment, the differences start again from 0 at each of them
+    :return: np.array (int64)
+    """
+    deltas = zigzag_decode(decode_varints(data))
+    totals = np.concatenate(([0], np.cumsum(deltas)))
+    if counts is None:
+        return totals[1:]
+    counts = np.asarray(counts, dtype=np.int64)
+    starts = np.cumsum(counts) - counts
+    return totals[1:] - np.repeat(totals[starts], counts)